@@ -0,0 +1,128 @@
+"""
+Microbenchmarks of the codecs on the hot path: varints of every length, `UDPTunnel` Opus
+packets of realistic sizes, and framing common control messages. Prints nanoseconds per
+call (the best of several runs) and the peak bytes allocated by one call, and compares
+against a saved baseline, exiting with an error if anything got slower by more than the
+threshold.
+
+Use with:
+$ benchmark_codecs.py --save baseline.json
+$ benchmark_codecs.py --compare baseline.json --threshold 0.1
+"""
+
+import argparse
+import collections
+import json
+import sys
+import timeit
+import tracemalloc
+
+from trumble import messages
+from trumble import _varint
+
+
+REPEAT = 5
+ALLOCATION_CALLS = 20
+
+def _varint_cases():
+    for name, value in (
+        ('7bit', 2 ** 6),
+        ('14bit', 2 ** 13),
+        ('21bit', 2 ** 20),
+        ('28bit', 2 ** 27),
+        ('32bit', 2 ** 31),
+        ('64bit', 2 ** 63),
+        ('negative', -2 ** 20),
+        ('small_negative', -2),
+    ):
+        encoded = _varint.encode(value)
+        yield 'varint.encode.' + name, lambda value=value: _varint.encode(value)
+        yield 'varint.decode.' + name, lambda encoded=encoded: _varint.decode(encoded)
+
+def _udp_tunnel_cases():
+    # 20 ms of Opus at roughly 8, 24, 48 and 96 kbit/s
+    for size in (20, 60, 120, 240):
+        packet = messages.UDPTunnel(session_id=17, sequence_number=12345, voice_frames=[bytes([0x78]) + bytes(size - 1)])
+        outgoing = packet.SerializeToString()
+        # what the server relays has the speaker's session after the header
+        incoming = outgoing[:1] + _varint.encode(packet.session_id) + outgoing[1:]
+        prepared = packet.prepare()
+        prepared.sequence_number = packet.sequence_number
+        yield 'UDPTunnel.serialize.{}B'.format(size), packet.SerializeToString
+        yield 'UDPTunnel.serialize_prepared.{}B'.format(size), prepared.SerializeToString
+        yield 'UDPTunnel.parse.{}B'.format(size), lambda incoming=incoming: messages.UDPTunnel().ParseFromString(incoming)
+
+def _message_cases():
+    for name, message in (
+        ('Ping', messages.Ping(timestamp=1234567890, tcp_packets=100, tcp_ping_avg=12.5, tcp_ping_var=1.5)),
+        ('UserState', messages.UserState(session=1234, name='Somebody', channel_id=12, self_mute=True, hash='0' * 40)),
+        ('ChannelState', messages.ChannelState(channel_id=12, parent=0, name='Some Channel', position=3, description='x' * 100)),
+        ('TextMessage', messages.TextMessage(actor=1234, channel_id=[12], message='Hello, this is a message of typical length')),
+    ):
+        data = messages._serialize(message)
+        message_id, body = messages.get_id_by_class(type(message)), data[6:]
+        yield 'serialize.' + name, lambda message=message: messages._serialize(message)
+        yield 'deserialize.' + name, lambda message_id=message_id, body=body: messages._deserialize(message_id, body)
+
+def _nanoseconds_per_call(function):
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(REPEAT, number)) / number * 1e9
+
+def _allocated_bytes(function):
+    """ Peak bytes allocated during one call, the smallest of a few (for caches and free lists) """
+    function()
+    peaks = []
+    for _ in range(ALLOCATION_CALLS):
+        tracemalloc.start()
+        function()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return min(peaks)
+
+def run(pattern=None):
+    results = collections.OrderedDict()
+    for cases in (_varint_cases, _udp_tunnel_cases, _message_cases):
+        for name, function in cases():
+            if pattern and pattern not in name:
+                continue
+            results[name] = {'ns': _nanoseconds_per_call(function), 'bytes': _allocated_bytes(function)}
+    return results
+
+def compare(results, baseline, threshold):
+    """ Names of the benchmarks more than `threshold` (a fraction) slower than the baseline """
+    return [
+        name for name, result in results.items()
+        if name in baseline and result['ns'] > baseline[name]['ns'] * (1 + threshold)
+    ]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filter', help='only run benchmarks with this in their name')
+    parser.add_argument('--save', help='write the results to this file, as a new baseline')
+    parser.add_argument('--compare', help='compare against the baseline in this file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown that counts as a regression')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    results = run(args.filter)
+    regressions = compare(results, baseline, args.threshold)
+    for name, result in results.items():
+        line = '{:<40} {:>10.0f} ns/op {:>8} B/op'.format(name, result['ns'], result['bytes'])
+        if name in baseline:
+            line += ' {:>+7.1%}'.format(result['ns'] / baseline[name]['ns'] - 1)
+            if name in regressions:
+                line += '  REGRESSION'
+        print(line)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': sys.version, 'results': results}, f, indent=2)
+    if regressions:
+        print('{} benchmarks regressed by more than {:.0%}'.format(len(regressions), args.threshold), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
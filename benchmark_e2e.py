@@ -0,0 +1,149 @@
+"""
+End-to-end benchmarks of a `SimpleTrumble` against the in-process `FakeServer`, over
+loopback TLS, so they include everything the codec benchmarks don't: a task per message,
+handler dispatch, the send queue and TLS. Measures inbound throughput when flooded, echo
+latency, time to `ServerSync` on big servers, outbound voice timing and peak RSS, and
+writes them to a JSON report. The server runs in the same process, so CPU time and RSS
+include its share.
+
+Use with:
+$ benchmark_e2e.py --output report.json
+"""
+
+import argparse
+import functools
+import json
+import logging
+import resource
+import statistics
+import sys
+import time
+
+import trio
+
+from trumble import FakeServer, SimpleTrumble
+from trumble import messages
+
+
+class _Bot(SimpleTrumble):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, verify=False, **kwargs)
+        self.started = None
+        self.synced_at = None
+        self.synced = trio.Event()
+        self.texts = 0
+        self.texts_expected = None
+        self.texts_done = trio.Event()
+        self.echo = False
+
+    async def run_async(self):
+        self.started = trio.current_time()
+        await super().run_async()
+
+    async def on_server_sync(self, message):
+        await super().on_server_sync(message)
+        self.synced_at = trio.current_time()
+        self.synced.set()
+
+    def on_text_message(self, message):
+        if self.echo:
+            return messages.TextMessage(message=message.message)
+        self.texts += 1
+        if self.texts == self.texts_expected:
+            self.texts_done.set()
+
+class _EchoServer(FakeServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.echoed = trio.Event()
+
+    def on_text_message(self, client, message):
+        self.echoed.set()
+
+def _percentiles(values, percentiles=(50, 90, 99)):
+    values = sorted(values)
+    return {'p{}'.format(p): values[min(len(values) - 1, len(values) * p // 100)] for p in percentiles}
+
+async def _connected(server, scenario, **kwargs):
+    """ Runs a bot against `server` until it's synced, then `scenario(server, bot, client)` """
+    bot = _Bot('127.0.0.1', 0, **kwargs)
+    async with trio.open_nursery() as nursery:
+        bot.port = await server.start(nursery)
+        nursery.spawn(bot.run_async)
+        await bot.synced.wait()
+        result = await scenario(server, bot, server.clients[0])
+        nursery.cancel_scope.cancel()
+    return result
+
+async def _time_to_sync(server, bot, client):
+    return {'users': len(server.users) - 1, 'seconds': bot.synced_at - bot.started}
+
+async def _flood(count):
+    async def scenario(server, bot, client):
+        data = messages._serialize(messages.TextMessage(actor=1, channel_id=[0], message='Flooding the bot with text'))
+        bot.texts_expected = count
+        start, cpu = trio.current_time(), time.process_time()
+        for _ in range(count):
+            await server.send(client, data)
+        await bot.texts_done.wait()
+        elapsed, cpu = trio.current_time() - start, time.process_time() - cpu
+        return {'messages': count, 'per_second': count / elapsed, 'cpu_per_message_us': cpu / count * 1e6}
+    return await _connected(FakeServer(), scenario)
+
+async def _echo_latency(count):
+    async def scenario(server, bot, client):
+        bot.echo = True
+        latencies = []
+        for number in range(count):
+            server.echoed.clear()
+            start = trio.current_time()
+            await server.send(client, messages.TextMessage(actor=1, channel_id=[0], message=str(number)))
+            await server.echoed.wait()
+            latencies.append((trio.current_time() - start) * 1e6)
+        return dict(_percentiles(latencies), messages=count, unit='us')
+    return await _connected(_EchoServer(), scenario)
+
+async def _voice_jitter(seconds):
+    async def packets():
+        for _ in range(int(seconds / .02)):
+            yield bytes([0x78]) + bytes(59) # 20 ms of Opus
+    async def scenario(server, bot, client):
+        stream = await bot.stream_audio(packets())
+        await trio.sleep(.1)
+        gaps = [(b - a) * 1e3 for a, b in zip(client.voice_arrivals, client.voice_arrivals[1:])]
+        deviations = [abs(gap - 20) for gap in gaps]
+        return dict(
+            _percentiles(deviations), packets=len(client.voice_arrivals), unit='ms from 20 ms',
+            stdev=statistics.pstdev(gaps) if gaps else 0., underruns=stream.underruns, resyncs=stream.resyncs,
+        )
+    return await _connected(FakeServer(), scenario)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='benchmark.json', help='where to write the report')
+    parser.add_argument('--sync-users', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--flood', type=int, default=20000, help='messages to flood the bot with')
+    parser.add_argument('--echoes', type=int, default=1000)
+    parser.add_argument('--voice-seconds', type=float, default=5.)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results = {}
+    for users in args.sync_users:
+        results['time_to_sync_{}'.format(users)] = trio.run(_connected, FakeServer(users=users), _time_to_sync)
+        results['time_to_sync_{}_fast'.format(users)] = trio.run(
+            functools.partial(_connected, FakeServer(users=users), _time_to_sync, fast_sync=True),
+        )
+    results['inbound_throughput'] = trio.run(_flood, args.flood)
+    results['echo_latency'] = trio.run(_echo_latency, args.echoes)
+    results['voice_jitter'] = trio.run(_voice_jitter, args.voice_seconds)
+    # kilobytes on Linux, bytes on macOS
+    results['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+    report = {'python': sys.version, 'time': time.time(), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
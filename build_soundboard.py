@@ -0,0 +1,18 @@
+"""
+Builds a clip library for `trumble.SoundboardTrumble` from Ogg Opus files.
+Each clip is named after its file, without the extension.
+
+Use with:
+$ build_soundboard.py clips.trumble airhorn.opus rimshot.opus ...
+"""
+
+import os
+import sys
+
+from trumble._soundboard import build_library
+
+
+output_path, input_paths = sys.argv[1], sys.argv[2:]
+clips = [(os.path.splitext(os.path.basename(path))[0], path) for path in input_paths]
+build_library(output_path, clips)
+print('Wrote {} clips to {}'.format(len(clips), output_path), file=sys.stderr)
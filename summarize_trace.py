@@ -0,0 +1,23 @@
+"""
+Summarizes a trace file written by `TrumbleCore(trace=...)`: for each kind of received
+message (and reply to it), how long each stage took, in microseconds.
+
+Use with:
+$ summarize_trace.py trumble.trace
+"""
+
+import sys
+
+from trumble._trace import STAGES, summarize
+
+
+PERCENTILES = (50, 90, 99)
+
+summary = summarize(sys.argv[1], PERCENTILES)
+for (message_type, reply_type), stages in sorted(summary.items(), key=lambda item: -item[1]['count']):
+    print('{} -> {} ({} records)'.format(message_type, reply_type or 'no reply', stages['count']))
+    for stage in STAGES[1:]:
+        if stage in stages:
+            print('  {:<12}'.format(stage) + ''.join(
+                '  p{}={:>8}'.format(p, stages[stage][p]) for p in PERCENTILES
+            ))
@@ -1,3 +1,28 @@
 from . import _messages as messages
+from . import _opus as opus
 from ._core import TrumbleCore
+from ._broadcast import TextBroadcaster
+from ._capture import CaptureReader, CaptureWriter, Replay
+from ._encoder import EncoderPool
+from ._fake_server import FakeServer
+from ._flight import FlightRecorder
+from ._jitter import JitterBuffer, JitterBuffers
+from ._metrics import Histogram, Metrics
+from ._mixer import Mixer
+from ._moderation import BulkModerator
+from ._ogg import OggOpusReader, OggOpusWriter
+from ._ping import PingStats, RunningStats
+from ._profiling import SlowHandlerDetector
+from ._ratelimit import TokenBucket
+from ._recorder import Recorder
+from ._soundboard import ClipLibrary
+from ._stream import AudioStream
+from ._sync import SyncSnapshot
+from ._talk import TalkStats
+from ._trace import Tracer
+from ._udp import CryptState, UDPTransport
+from ._vad import SilenceGate
+from ._voice_target import VoiceTargets, VoiceTargetsFull, WhisperChannel
 from ._bots._simple import SimpleTrumble
+from ._bots._music import MusicTrumble
+from ._bots._soundboard import SoundboardTrumble
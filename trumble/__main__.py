@@ -5,7 +5,7 @@ from . import SimpleTrumble
 
 def get_args(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument('--log-level', type=(lambda x: getattr(logging, x)), default='DEBUG')
+    parser.add_argument('--log-level', type=(lambda x: getattr(logging, x)), default='INFO')
     parser.add_argument('--access-token', action='append')
     parser.add_argument('--no-verify', action='store_true', default=False)
     parser.add_argument('host')
@@ -0,0 +1,221 @@
+import bisect
+import collections
+import logging
+import threading
+
+import trio
+
+from .._ogg import OggOpusReader
+from .._opus import SAMPLE_RATE, packet_samples
+from .._stream import AudioStream
+from ._simple import SimpleTrumble
+
+
+logger = logging.getLogger(__name__)
+
+class Track:
+    """
+    A queued file and a bounded buffer of its demuxed packets. Everything that touches the
+    file (`fill`, `seek`, `close`) is blocking and meant to run in a worker thread, while the
+    player only ever pops packets from the buffer. Once closed, filling and seeking do nothing,
+    so a prefetch that finishes late can't reopen the file.
+    """
+
+    def __init__(self, path, buffer_packets=250):
+        self.path = path
+        self.buffer_packets = buffer_packets
+        self.buffer = collections.deque()
+        self.exhausted = False
+        self.closed = False
+        self.granule_position = 0
+        self._reader = None
+        self._packets = None
+        self._page_index = None
+        self._lock = threading.Lock()
+        self._filling = None
+
+    def __repr__(self):
+        return '<Track {!r}>'.format(self.path)
+
+    def _open(self):
+        if self._reader is None:
+            self._reader = OggOpusReader(self.path)
+            self._packets = self._skip_pre_roll(self._reader.packets())
+
+    def _skip_pre_roll(self, packets):
+        """
+        Drops the packets at the start that are mostly the encoder's pre-roll (`pre_skip` in the
+        header). Packets can't be cut without re-encoding them, so this is to the nearest packet.
+        """
+        for packet in packets:
+            if packet.granule_position - packet_samples(packet.data) / 2 >= self._reader.head.pre_skip:
+                yield packet
+                break
+        yield from packets
+
+    @property
+    def position(self):
+        """ Seconds into the track of the last packet handed to the player """
+        pre_skip = self._reader.head.pre_skip if self._reader and self._reader.head else 0
+        return max(0, self.granule_position - pre_skip) / SAMPLE_RATE
+
+    def fill(self):
+        """
+        Demuxes packets until the buffer is full or the file ends. The first fill also indexes
+        the file's pages once the buffer is full, so that seeking never has to scan the file.
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self._open()
+            while len(self.buffer) < self.buffer_packets:
+                packet = next(self._packets, None)
+                if packet is None:
+                    self.exhausted = True
+                    break
+                self.buffer.append(packet)
+            self._build_page_index()
+
+    def _build_page_index(self):
+        if self._page_index is None:
+            index = [
+                (page.granule_position, page.offset)
+                for page in self._reader.pages() if page.granule_position != -1
+            ]
+            self._page_index = ([granule for granule, _ in index], [offset for _, offset in index])
+        return self._page_index
+
+    def seek(self, seconds):
+        """ Restarts the buffer at `seconds`, using the index of page granule positions """
+        with self._lock:
+            if self.closed:
+                return
+            self._open()
+            if self._reader.head is None:
+                # the headers come first, this makes the reader parse them
+                next(self._reader.packets(), None)
+            granules, offsets = self._build_page_index()
+            target = self._reader.head.pre_skip + int(seconds * SAMPLE_RATE)
+            # start after the last page that ends before the target
+            idx = bisect.bisect_right(granules, target) - 1
+            offset = offsets[idx] if idx >= 0 else 0
+            self._packets = (p for p in self._reader.packets(offset) if p.granule_position > target)
+            self.buffer.clear()
+            self.exhausted = False
+        self.fill()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+class MusicTrumble(SimpleTrumble):
+    """
+    Plays a queue of Ogg Opus files by sending the packets already in them, with no decoding
+    or re-encoding. Files are memory-mapped, so bots playing the same file share its pages.
+
+    The current track and the next `prefetch` tracks are opened and demuxed ahead of time
+    in worker threads, so skipping and seeking are instant and consecutive tracks play
+    gaplessly as one transmission, each without its encoder pre-roll.
+    """
+
+    def __init__(self, *args, prefetch=2, buffer_packets=250, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prefetch = prefetch
+        self.buffer_packets = buffer_packets
+        self.queue = []
+        self.current = None
+        self._stream = None
+        self._skip = False
+
+    @property
+    def playing(self):
+        return self._stream is not None
+
+    def enqueue(self, path):
+        """ Adds a file to the end of the queue and starts prefetching it if it's up soon """
+        track = Track(path, self.buffer_packets)
+        self.queue.append(track)
+        if self._nursery is not None:
+            self._prefetch()
+        return track
+
+    async def play(self, path=None, **kwargs):
+        """
+        Queues `path`, if given, and plays the queue until it runs out (or until `stop`).
+        If the queue is already playing, this just queues the file.
+        See `AudioStream` for the options.
+        """
+        if path is not None:
+            self.enqueue(path)
+        if self.playing:
+            return
+        self._stream = AudioStream(self.send, self._queue_packets(), **kwargs)
+        try:
+            await self._stream.run()
+        finally:
+            self._stream = None
+
+    def skip(self):
+        """ Moves on to the next track in the queue """
+        self._skip = True
+
+    async def seek(self, seconds):
+        """ Jumps to `seconds` into the current track """
+        if self.current is not None:
+            await trio.run_sync_in_worker_thread(self.current.seek, seconds)
+
+    def stop(self):
+        """ Stops playing and empties the queue """
+        playing = [self.current] if self.current is not None else []
+        for track in playing + self.queue:
+            if self._nursery is None:
+                track.close()
+            else:
+                self.spawn(trio.run_sync_in_worker_thread, track.close)
+        self.queue.clear()
+        self._skip = True
+        if self._stream:
+            self._stream.stop()
+
+    def _prefetch(self):
+        for track in self.queue[:self.prefetch]:
+            if not track.buffer and not track.exhausted and track._filling is None:
+                self.spawn(self._fill, track)
+
+    async def _fill(self, track):
+        """ Refills a track's buffer in a worker thread, or waits for the refill in progress """
+        if track._filling is not None:
+            await track._filling.wait()
+            return
+        track._filling = trio.Event()
+        try:
+            await trio.run_sync_in_worker_thread(track.fill)
+        finally:
+            track._filling.set()
+            track._filling = None
+
+    async def _queue_packets(self):
+        while self.queue:
+            track = self.current = self.queue.pop(0)
+            self._skip = False
+            self._prefetch()
+            logger.info('Playing %s', track.path)
+            try:
+                while not self._skip:
+                    if len(track.buffer) < track.buffer_packets // 2 and not track.exhausted and track._filling is None:
+                        self.spawn(self._fill, track)
+                    if track.buffer:
+                        packet = track.buffer.popleft()
+                        track.granule_position = packet.granule_position
+                        yield packet.data
+                    elif track.exhausted or track.closed:
+                        break
+                    else:
+                        # the prefetch didn't keep up, nothing to do but wait for it
+                        await self._fill(track)
+            finally:
+                self.spawn(trio.run_sync_in_worker_thread, track.close)
+        self.current = None
@@ -5,6 +5,10 @@ import trio
 
 from .. import TrumbleCore
 from .. import messages
+from .._broadcast import TextBroadcaster
+from .._moderation import BulkModerator
+from .._talk import TalkStats
+from .._voice_target import VoiceTargets
 
 
 logger = logging.getLogger(__name__)
@@ -18,11 +22,20 @@ class SimpleTrumble(TrumbleCore):
         self.version = version
         self.sessions = collections.defaultdict(dict)
         self.channels = collections.defaultdict(dict)
+        self.voice_targets = VoiceTargets()
+        self.add_listener(self.voice_targets)
+        self.broadcaster = TextBroadcaster(self.send)
+        self.add_listener(self.broadcaster)
+        self.moderation = BulkModerator(self.send)
+        self.add_listener(self.moderation)
+        self.talk_stats = TalkStats()
+        self.add_listener(self.talk_stats)
 
         self.buffer = []
 
     async def on_connect(self):
         """ Immediately after connecting, both client and server exchange version info """
+        self.spawn(self.broadcaster.run)
         version = messages.Version()
         version.version = (self.version[0] << 16) + (self.version[1] << 8) + self.version[2]
         return version
@@ -36,13 +49,33 @@ class SimpleTrumble(TrumbleCore):
         authenticate.opus = True
         return authenticate
 
-    async def on_channel_state(self, message):
-        """ When a channel is updated, update our list """
+    def _update_channel(self, message):
         self.channels[message.channel_id].update({
             'name': message.name,
             'parent': message.parent,
         })
 
+    def _update_user(self, message):
+        """ Returns whether this is the first time we've seen the user """
+        new = message.session not in self.sessions
+        self.sessions[message.session].update({
+            'name': message.name,
+            'user_id': message.user_id,
+            'channel_id': message.channel_id,
+        })
+        return new
+
+    def _request_stats(self, session):
+        # a query for a user's "stats" (includes certificate chain)
+        # this requires the "Register User" ACL
+        user_stats = messages.UserStats()
+        user_stats.session = session
+        return user_stats
+
+    async def on_channel_state(self, message):
+        """ When a channel is updated, update our list """
+        self._update_channel(message)
+
     async def on_channel_remove(self, message):
         """ When a channel is removed, remove it from our list """
         if message.channel_id in self.channels:
@@ -50,18 +83,21 @@ class SimpleTrumble(TrumbleCore):
 
     async def on_user_state(self, message):
         """ When we connect or a user connects or changes state, we receive their current info """
-        if message.session not in self.sessions:
-            # if this is the first time we've seen this session,
-            # also kick off a query for their "stats" (includes certificate chain)
-            # this requires the "Register User" ACL
-            user_stats = messages.UserStats()
-            user_stats.session = message.session
-            yield user_stats
-        self.sessions[message.session].update({
-            'name': message.name,
-            'user_id': message.user_id,
-            'channel_id': message.channel_id,
-        })
+        if self._update_user(message):
+            # if this is the first time we've seen this session, also kick off a query for their stats
+            return self._request_stats(message.session)
+
+    async def on_synced(self, snapshot):
+        """ With `fast_sync=True`, every channel and user there was at `ServerSync`, all at once """
+        for message in snapshot.channels.values():
+            self._update_channel(message)
+        new_sessions = [session for session, message in snapshot.users.items() if self._update_user(message)]
+        # asking for everyone's stats takes a while on a big server, and needn't hold up `on_server_sync`
+        self.spawn(self._request_all_stats, new_sessions)
+
+    async def _request_all_stats(self, sessions):
+        for session in sessions:
+            await self.send(self._request_stats(session))
 
     async def on_user_remove(self, message):
         """ When a user is kicked or disconnects, remove their session """
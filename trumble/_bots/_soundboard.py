@@ -0,0 +1,40 @@
+import logging
+
+import trio
+
+from .._soundboard import ClipLibrary
+from .._stream import AudioStream, iterate
+from ._simple import SimpleTrumble
+
+
+logger = logging.getLogger(__name__)
+
+class SoundboardTrumble(SimpleTrumble):
+    """
+    Plays clips from a clip library (see `trumble._soundboard`). A new clip cuts off
+    the one currently playing.
+    """
+
+    def __init__(self, *args, library, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.library = library if isinstance(library, ClipLibrary) else ClipLibrary(library)
+        self._stream = None
+        self._sequence_number = 0
+        self._lock = trio.Lock()
+
+    async def play_clip(self, name, **kwargs):
+        """ Plays a clip by name, see `AudioStream` for the options """
+        if name not in self.library:
+            raise KeyError('No clip named {!r}'.format(name))
+        if self._stream:
+            self._stream.stop()
+        async with self._lock:
+            logger.debug('Playing clip %s', name)
+            self._stream = AudioStream(
+                self.send, iterate(self.library.packets(name)), sequence_number=self._sequence_number, **kwargs
+            )
+            try:
+                await self._stream.run()
+            finally:
+                self._sequence_number = self._stream.sequence_number
+                self._stream = None
@@ -0,0 +1,120 @@
+import collections
+import logging
+import re
+
+import trio
+
+from . import messages
+from ._ratelimit import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+# what a message can be split between: whole tags, whole entities, or single characters
+_ATOM = re.compile(r'<[^>]*>|&#?\w+;|[\s\S]')
+
+def _utf16_length(text):
+    """ Length as Murmur measures it, in the UTF-16 code units of a QString """
+    return len(text.encode('utf-16-le')) // 2
+
+class TextBroadcaster:
+    """
+    Queues text messages and sends them as few `TextMessage`s as possible: pending messages
+    with identical bodies are merged into one message with all of their recipients, long
+    bodies are split to fit the server's `message_length`, and sends are paced to stay within
+    Murmur's message rate limit (`messagelimit`/`messageburst`, 1/s and 5 by default).
+
+    Add an instance as a listener to pick up the server's limits, and spawn `run` to send.
+    """
+
+    def __init__(self, send, *, rate=1, burst=5, message_length=5000, image_message_length=131072):
+        self._send = send
+        self.bucket = TokenBucket(rate, burst)
+        self.message_length = message_length
+        self.image_message_length = image_message_length
+        self._pending = collections.OrderedDict() # body -> (sessions, channels, trees)
+        self._wakeup = trio.Event()
+
+    def broadcast(self, text, *, sessions=(), channels=(), trees=()):
+        """ Queues `text` for the given recipients, merging it with any identical pending message """
+        if text not in self._pending:
+            self._pending[text] = (set(), set(), set())
+        pending_sessions, pending_channels, pending_trees = self._pending[text]
+        pending_sessions.update(sessions)
+        pending_channels.update(channels)
+        pending_trees.update(trees)
+        self._wakeup.set()
+
+    @property
+    def pending(self):
+        """ Number of distinct message bodies waiting to be sent """
+        return len(self._pending)
+
+    def _length_limit(self, text):
+        # "image_message_length" applies instead to messages with embedded images
+        limit = self.image_message_length if '<img' in text else self.message_length
+        return limit or None # 0 means unlimited
+
+    @staticmethod
+    def _split(text, limit):
+        """
+        Splits text into chunks of at most `limit` UTF-16 code units, preferring line and word
+        breaks, and never cutting into an HTML tag or entity
+        """
+        if not limit or _utf16_length(text) <= limit:
+            return [text]
+        atoms = _ATOM.findall(text)
+        sizes = [_utf16_length(atom) for atom in atoms]
+        chunks = []
+        start = 0
+        while start < len(atoms):
+            end, length, cut = start, 0, None
+            while end < len(atoms) and length + sizes[end] <= limit:
+                if atoms[end] in '\n ' and end > start:
+                    cut = end
+                length += sizes[end]
+                end += 1
+            if end == len(atoms):
+                chunks.append(''.join(atoms[start:]))
+                break
+            if atoms[end] in '\n ':
+                cut = end
+            elif cut is None:
+                # a tag longer than the limit goes out on its own, there's no better place to cut it
+                cut = max(end, start + 1)
+            chunks.append(''.join(atoms[start:cut]))
+            start = cut
+            while start < len(atoms) and atoms[start] in '\n ':
+                start += 1
+        return chunks
+
+    async def run(self):
+        """ Sends pending messages forever, waiting for rate limit tokens in between """
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            # wait for a token before picking a message, so anything queued in the meantime
+            # still has a chance to be merged into it
+            await self.bucket.acquire()
+            text, (sessions, channels, trees) = self._pending.popitem(last=False)
+            chunks = self._split(text, self._length_limit(text))
+            for idx, chunk in enumerate(chunks):
+                if idx:
+                    await self.bucket.acquire()
+                text_message = messages.TextMessage()
+                text_message.message = chunk
+                text_message.session.extend(sorted(sessions))
+                text_message.channel_id.extend(sorted(channels))
+                text_message.tree_id.extend(sorted(trees))
+                await self._send(text_message)
+            logger.debug(
+                'Broadcast %d message(s) to %d sessions, %d channels, %d trees',
+                len(chunks), len(sessions), len(channels), len(trees),
+            )
+
+    def on_server_config(self, message):
+        if message.HasField('message_length'):
+            self.message_length = message.message_length
+        if message.HasField('image_message_length'):
+            self.image_message_length = message.image_message_length
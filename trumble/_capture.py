@@ -0,0 +1,373 @@
+"""
+Captures of raw inbound frames, and replaying them into a bot without a server.
+
+A capture file starts with a header, followed by every frame as it came in:
+
+    header:  magic (8s) | version (H) | wall clock (d) | monotonic clock (d)
+    frame:   monotonic timestamp (d) | message id (H) | length (I) | body (length bytes)
+
+The clocks in the header are read together when the capture starts, to turn frame
+timestamps into wall clock times. Alongside it, in the same path plus `.idx`, is an index
+with an entry per frame, for finding frames without reading the capture. Entries are
+written in blocks of up to `INDEX_BLOCK`, a column at a time, so loading the index is a
+copy per column rather than a parse per entry:
+
+    header:  magic (8s) | version (H)
+    block:   entry count (I) | frame offsets (Q * count) | monotonic timestamps (d * count)
+             | message ids (H * count) | sessions (I * count)
+
+The session is whose the frame is (the user in a `UserState`, the speaker of voice, the
+sender of a `TextMessage`...), or 0xffffffff for frames that aren't about a user. The index
+is written after the capture, so it can lag behind it but is never ahead. All integers are
+little-endian.
+"""
+
+import array
+import bisect
+import mmap
+import os
+import struct
+import sys
+import time
+
+import attr
+import trio
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import messages
+from ._sync import SyncSnapshot
+
+
+MAGIC = b'TRMBCAPT'
+VERSION = 1
+
+_FILE_HEADER = struct.Struct('<8sHdd')
+_FRAME_HEADER = struct.Struct('<dHI')
+
+INDEX_MAGIC = b'TRMBCIDX'
+NO_SESSION = 0xffffffff
+
+INDEX_BLOCK = 4096
+
+_INDEX_HEADER = struct.Struct('<8sH')
+_INDEX_BLOCK_HEADER = struct.Struct('<I')
+# offset, timestamp, message id, session
+_INDEX_COLUMNS = 'QdHI'
+
+# the first of these a message has as an int is its session (`TextMessage.session` is a list of recipients)
+_SESSION_FIELDS = ('session_id', 'session', 'actor')
+
+class CaptureError(Exception):
+    pass
+
+def _session_of(message):
+    if message is None:
+        return NO_SESSION
+    for field in _SESSION_FIELDS:
+        value = getattr(message, field, None)
+        if isinstance(value, int):
+            return value
+    return NO_SESSION
+
+@attr.s(slots=True)
+class Frame:
+    timestamp = attr.ib()
+    message_id = attr.ib()
+    body = attr.ib()
+
+class CaptureWriter:
+    """
+    Appends frames to a new capture file, and their entries to its index, through large
+    write buffers. `TrumbleCore` writes every frame it receives to one when created with
+    `capture='path'` (and voice received over UDP too, as `UDPTunnel` frames). Index entries
+    are held back until there's a block of them, or the writer is flushed.
+    """
+
+    def __init__(self, path, *, index=True, buffering=1 << 20):
+        self.path = path
+        self.frames = 0
+        self.bytes = 0
+        self._file = open(path, 'wb', buffering=buffering)
+        self._file.write(_FILE_HEADER.pack(MAGIC, VERSION, time.time(), time.perf_counter()))
+        self._offset = _FILE_HEADER.size
+        self._index = None
+        if index:
+            self._index = open(path + '.idx', 'wb', buffering=buffering // 4)
+            self._index.write(_INDEX_HEADER.pack(INDEX_MAGIC, VERSION))
+            self._entries = tuple(array.array(typecode) for typecode in _INDEX_COLUMNS)
+
+    def write(self, message_id, body, message=None, timestamp=None):
+        """ Appends a frame; `message` is what `body` parses to, if it's been parsed, for the index """
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        self._file.write(_FRAME_HEADER.pack(timestamp, message_id, len(body)))
+        self._file.write(body)
+        if self._index is not None:
+            offsets, timestamps, message_ids, sessions = self._entries
+            offsets.append(self._offset)
+            timestamps.append(timestamp)
+            message_ids.append(message_id)
+            sessions.append(_session_of(message))
+            if len(offsets) >= INDEX_BLOCK:
+                self._write_index_block()
+        self._offset += _FRAME_HEADER.size + len(body)
+        self.frames += 1
+        self.bytes += len(body)
+
+    def _write_index_block(self):
+        if not self._entries[0]:
+            return
+        self._index.write(_INDEX_BLOCK_HEADER.pack(len(self._entries[0])))
+        for column in self._entries:
+            if sys.byteorder == 'big':
+                column.byteswap()
+            self._index.write(column.tobytes())
+            del column[:]
+
+    def flush(self):
+        self._file.flush()
+        if self._index is not None:
+            self._write_index_block()
+            self._index.flush()
+
+    def close(self):
+        self._file.close()
+        if self._index is not None:
+            self._write_index_block()
+            self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_header(data):
+    """ Returns `(wall clock, monotonic clock)` from the start of a capture """
+    if len(data) < _FILE_HEADER.size:
+        raise CaptureError('Capture is too short')
+    magic, version, wall_clock, monotonic_clock = _FILE_HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise CaptureError('Not a version {} capture'.format(VERSION))
+    return wall_clock, monotonic_clock
+
+def read_capture(path):
+    """ Yields every `Frame` in a capture, reading it from start to end, skipping a truncated last frame """
+    with open(path, 'rb') as f:
+        read_header(f.read(_FILE_HEADER.size))
+        while True:
+            header = f.read(_FRAME_HEADER.size)
+            if len(header) < _FRAME_HEADER.size:
+                return
+            timestamp, message_id, length = _FRAME_HEADER.unpack(header)
+            body = f.read(length)
+            if len(body) < length:
+                return
+            yield Frame(timestamp, message_id, body)
+
+class CaptureReader:
+    """
+    Random access into a capture, through its index. The capture is memory-mapped and frame
+    bodies are memoryviews of the map, so nothing is read or copied that isn't used (and the
+    reader can't be closed while any of them are still around). Frames past the end of the
+    index, or all of them when there's no index, are found by scanning and parsing them once.
+    Filtering by message type or session only reads the index columns of the time range
+    asked for, which takes a vectorised pass with numpy (and a loop without it).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.wall_clock, self.monotonic_clock = read_header(self._map)
+        self._offsets = array.array('Q')
+        self._timestamps = array.array('d')
+        self._message_ids = array.array('H')
+        self._sessions = array.array('I')
+        self._load_index(path + '.idx')
+
+    def _load_index(self, index_path):
+        end = _FILE_HEADER.size
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                data = memoryview(f.read())
+            if data[:_INDEX_HEADER.size] == _INDEX_HEADER.pack(INDEX_MAGIC, VERSION):
+                self._load_index_blocks(data, _INDEX_HEADER.size)
+                if self._offsets:
+                    end = self._frame_end(self._offsets[-1])
+        self._scan(end)
+
+    def _frame_end(self, offset):
+        return offset + _FRAME_HEADER.size + _FRAME_HEADER.unpack_from(self._map, offset)[2]
+
+    def _load_index_blocks(self, data, position):
+        columns = (self._offsets, self._timestamps, self._message_ids, self._sessions)
+        entry_size = sum(column.itemsize for column in columns)
+        while position + _INDEX_BLOCK_HEADER.size <= len(data):
+            count, = _INDEX_BLOCK_HEADER.unpack_from(data, position)
+            position += _INDEX_BLOCK_HEADER.size
+            if position + count * entry_size > len(data):
+                break # the last block is still being written
+            for column in columns:
+                column.frombytes(data[position:position + count * column.itemsize])
+                position += count * column.itemsize
+        if sys.byteorder == 'big':
+            for column in columns:
+                column.byteswap()
+        # the index can get to disk before the capture does, so drop entries past its end,
+        # including those of frames whose header has made it but whose body hasn't yet
+        kept = bisect.bisect_right(self._offsets, len(self._map) - _FRAME_HEADER.size)
+        while kept and self._frame_end(self._offsets[kept - 1]) > len(self._map):
+            kept -= 1
+        for column in columns:
+            del column[kept:]
+
+    def _append(self, offset, timestamp, message_id, session):
+        self._offsets.append(offset)
+        self._timestamps.append(timestamp)
+        self._message_ids.append(message_id)
+        self._sessions.append(session)
+
+    def _scan(self, offset):
+        while offset + _FRAME_HEADER.size <= len(self._map):
+            timestamp, message_id, length = _FRAME_HEADER.unpack_from(self._map, offset)
+            body_offset = offset + _FRAME_HEADER.size
+            if body_offset + length > len(self._map):
+                break
+            try:
+                message = messages._deserialize(message_id, self._map[body_offset:body_offset + length])
+            except Exception:
+                message = None
+            self._append(offset, timestamp, message_id, _session_of(message))
+            offset = body_offset + length
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, number):
+        offset = self._offsets[number]
+        _, message_id, length = _FRAME_HEADER.unpack_from(self._map, offset)
+        body_offset = offset + _FRAME_HEADER.size
+        body = memoryview(self._map)[body_offset:body_offset + length]
+        return Frame(self._timestamps[number], message_id, body)
+
+    def wall_time(self, timestamp):
+        """ The wall clock time of a frame timestamp """
+        return timestamp - self.monotonic_clock + self.wall_clock
+
+    def _select(self, first, last, message_ids, sessions):
+        """ Numbers of the entries from `first` up to `last` with any of the message ids and sessions """
+        if numpy is None:
+            return [
+                number for number in range(first, last)
+                if (message_ids is None or self._message_ids[number] in message_ids)
+                and (sessions is None or self._sessions[number] in sessions)
+            ]
+        if first >= last:
+            return []
+        selected = numpy.ones(last - first, bool)
+        for column, values in ((self._message_ids, message_ids), (self._sessions, sessions)):
+            if values is not None:
+                window = numpy.frombuffer(column, column.typecode)[first:last]
+                wanted = numpy.fromiter(values, column.typecode, len(values))
+                selected &= numpy.isin(window, wanted)
+        return (numpy.flatnonzero(selected) + first).tolist()
+
+    def frames(self, *, start=None, end=None, message_types=None, sessions=None):
+        """
+        Yields the frames received from `start` up to `end` (monotonic timestamps, as in
+        `Frame.timestamp`), of the given message classes and about the given sessions, in order
+        """
+        first = 0 if start is None else bisect.bisect_left(self._timestamps, start)
+        last = len(self) if end is None else bisect.bisect_left(self._timestamps, end)
+        if message_types is None and sessions is None:
+            numbers = range(first, last)
+        else:
+            message_ids = None
+            if message_types is not None:
+                message_ids = {messages.get_id_by_class(message_type) for message_type in message_types}
+            numbers = self._select(first, last, message_ids, None if sessions is None else set(sessions))
+        for number in numbers:
+            yield self[number]
+
+class _NullStream:
+    """ Stands in for the server connection when replaying, throwing away what's sent """
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    async def send_all(self, data):
+        self.messages += 1
+        self.bytes += len(data)
+        await trio.sleep(0)
+
+class Replay:
+    """
+    Feeds the frames of a capture (its path, or frames from a `CaptureReader`) into a bot's
+    handlers, as its receive loop would, with no network: what the handlers send goes
+    through the bot's send loop into a sink that counts it. `speed` is how many times faster
+    than it was captured to replay, with `None` meaning as fast as the handlers can go.
+    Background tasks the bot spawns are cancelled once every frame has been handled and
+    every reply sent.
+    """
+
+    def __init__(self, core, frames, *, speed=1., connect=True):
+        self.core = core
+        self.frames = read_capture(frames) if isinstance(frames, str) else frames
+        self.speed = speed
+        self.connect = connect
+        self.replayed = 0
+        self.skipped = 0 # frames that didn't parse
+        self.elapsed = None
+        self.sink = _NullStream()
+
+    async def _drain(self):
+        while self.core._send_queue.qsize():
+            await trio.sleep(0)
+        await trio.sleep(0) # for the send loop to finish with the last one
+
+    async def run(self):
+        start = trio.current_time()
+        async with trio.open_nursery() as nursery:
+            self.core._nursery = nursery
+            nursery.spawn(self.core._send_loop, nursery, self.sink)
+            if self.connect:
+                await self.core._dispatch_event('connect')
+            self.core._syncing = SyncSnapshot() if self.core.fast_sync else None
+            async with trio.open_nursery() as dispatch_nursery:
+                first = None
+                for frame in self.frames:
+                    if self.speed:
+                        if first is None:
+                            first = frame.timestamp
+                        await trio.sleep_until(start + max(0, frame.timestamp - first) / self.speed)
+                    else:
+                        await trio.sleep(0)
+                    try:
+                        message = messages._deserialize(frame.message_id, bytes(frame.body))
+                    except Exception:
+                        self.skipped += 1
+                        continue
+                    self.core._dispatch_received(dispatch_nursery, message)
+                    self.replayed += 1
+            await self._drain()
+            if self.connect:
+                await self.core._dispatch_event('disconnect')
+                await self._drain()
+            nursery.cancel_scope.cancel()
+        self.elapsed = trio.current_time() - start
+        return self
@@ -1,10 +1,21 @@
 import collections
 import inspect
 import logging
+import signal
+import time
 
 import trio
 
 from . import messages
+from . import _flight
+from . import _trace
+from ._capture import CaptureWriter
+from ._metrics import Metrics
+from ._ping import PingStats
+from ._profiling import SlowHandlerDetector
+from ._stream import AudioStream
+from ._sync import SyncSnapshot
+from ._udp import UDPTransport
 
 
 logger = logging.getLogger(__name__)
@@ -16,12 +27,48 @@ class TrumbleCore:
     See `SimpleTrumble` for a subclass that implements a client that actually does things.
     """
 
-    def __init__(self, host, port, *, certificate_key_pair=None, verify=True):
+    RECEIVE_SIZE = 65536
+
+    def __init__(self, host, port, *, certificate_key_pair=None, verify=True, udp=False, ping_interval=10, ping_timeout=None, metrics=False, slow_handlers=False, trace=None, flight_recorder=True, capture=None, fast_sync=False):
         self.host = host
         self.port = port
         self.certificate_key_pair = certificate_key_pair
         self.verify = verify
         self._send_queue = trio.Queue(1024) # TODO why this number?
+        # VoiceTarget ids queued to go over TCP but not sent yet, whose voice has to queue up behind them
+        self._registering = collections.Counter()
+        self._receive_buffer = bytearray()
+        self._listeners = []
+        self._nursery = None
+        # voice goes over UDP when this is set up and working, and through the TCP tunnel otherwise
+        self.udp = UDPTransport(self) if udp else None
+        if self.udp is not None:
+            self.add_listener(self.udp)
+        # with a `ping_timeout`, the connection is given up on when pings go unanswered that long
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.ping_stats = PingStats(self.udp)
+        self.add_listener(self.ping_stats)
+        # `True` for the defaults, or a `Metrics` to export them to a file
+        self.metrics = Metrics() if metrics is True else (metrics or None)
+        if self.metrics is not None:
+            self.metrics.gauge('send_queue_depth', self._send_queue.qsize, 'Messages waiting to be sent over TCP')
+            if self.udp is not None:
+                self.metrics.gauge('udp_send_queue_depth', self.udp._queue.qsize, 'Messages waiting to be sent over UDP')
+                self.metrics.gauge('udp_active', lambda: int(self.udp.active), 'Whether voice is going over UDP')
+        # `True` for the defaults, or a `SlowHandlerDetector` with a different budget
+        self.slow_handlers = SlowHandlerDetector() if slow_handlers is True else (slow_handlers or None)
+        # a trace file path, or a `Tracer`
+        self.tracer = _trace.Tracer(trace) if isinstance(trace, str) else trace
+        # `True` for the defaults, or a `FlightRecorder` of a different size or dump location
+        self.flight_recorder = _flight.FlightRecorder() if flight_recorder is True else (flight_recorder or None)
+        # a capture file path, or a `CaptureWriter`, to record every frame received for `Replay`
+        self.capture = CaptureWriter(capture) if isinstance(capture, str) else capture
+        # with `fast_sync`, the channels and users the server sends before `ServerSync` are
+        # collected without dispatching them, and handed over all at once in a `synced` event
+        # (or one by one as usual, to handlers of their own that have no `on_synced`)
+        self.fast_sync = fast_sync
+        self._syncing = None
 
     async def _connect(self):
         """ Connects to the server and negotiates the TLS connection """
@@ -37,26 +84,56 @@ class TrumbleCore:
         return stream
 
     async def _receive_exactly(self, stream, length):
-        """ Reads exactly `length` bytes from `stream` """
-        data = bytearray()
-        while len(data) < length:
-            chunk = await stream.receive_some(length - len(data))
+        """
+        Reads exactly `length` bytes from `stream`, through a buffer that's filled up to
+        `RECEIVE_SIZE` at a time, so that a burst of small messages (like the state sent
+        before `ServerSync`) takes a few reads rather than three per message
+        """
+        buffer = self._receive_buffer
+        while len(buffer) < length:
+            chunk = await stream.receive_some(max(length - len(buffer), self.RECEIVE_SIZE))
             if not len(chunk):
                 # TODO
                 raise EOFError('Oops')
-            data += chunk
-        return bytes(data)
+            buffer += chunk
+        data = bytes(buffer[:length])
+        del buffer[:length]
+        return data
 
     async def _receive(self, stream):
         """ Receives a message and deserializes it """
         message_id = int.from_bytes(await self._receive_exactly(stream, 2), byteorder='big')
         length = int.from_bytes(await self._receive_exactly(stream, 4), byteorder='big')
+        if self.tracer is not None:
+            header_time = time.perf_counter()
         message_data = await self._receive_exactly(stream, length)
-        return messages._deserialize(message_id, message_data)
+        if self.metrics is not None:
+            self.metrics.message_received(message_id, 6 + length)
+        if self.flight_recorder is not None:
+            self.flight_recorder.record(_flight.RECEIVED, message_id, 6 + length)
+        if self.tracer is None and self.capture is None:
+            return messages._deserialize(message_id, message_data)
+        read_time = time.perf_counter()
+        try:
+            message = messages._deserialize(message_id, message_data)
+        except Exception:
+            if self.capture is not None:
+                self.capture.write(message_id, message_data, None, read_time)
+            raise
+        if self.capture is not None:
+            self.capture.write(message_id, message_data, message, read_time)
+        if self.tracer is not None:
+            self.tracer.received(message, message_id, 6 + length, header_time, read_time)
+        return message
 
     async def _send(self, stream, message):
         """ Serializes a message and sends it on the given (TCP) stream """
-        await stream.send_all(messages._serialize(message))
+        data = messages._serialize(message)
+        if self.metrics is not None:
+            self.metrics.message_sent(int.from_bytes(data[:2], byteorder='big'), len(data))
+        await stream.send_all(data)
+        if self.flight_recorder is not None:
+            self.flight_recorder.record(_flight.SENT, int.from_bytes(data[:2], byteorder='big'), len(data))
 
     async def _get_messages(self, result):
         """
@@ -88,51 +165,251 @@ class TrumbleCore:
         Handlers can be async or sync, generators or normal methods,
         and can return a message or an iterable of messages
         """
+        await self._dispatch_to((self, *self._listeners), event_name, args, kwargs)
+
+    async def _dispatch_to(self, targets, event_name, args, kwargs):
+        """ Dispatches an event to the handlers of the given targets, see `_dispatch_event` """
         event_handler_name = 'on_{}'.format(event_name)
+        trace = self.tracer.dispatched(args[0]) if self.tracer is not None and args else None
+        recorder = self.flight_recorder
+        if recorder is not None:
+            message_id = messages._MESSAGE_ID_FROM_CLASS.get(type(args[0]), _flight.NO_MESSAGE) if args else _flight.NO_MESSAGE
+
+        handled = False
+        replies = 0
+        for target in targets:
+            if hasattr(target, event_handler_name):
+                event_handler = getattr(target, event_handler_name)
+                try:
+                    if self.metrics is None and self.slow_handlers is None and trace is None:
+                        result = event_handler(*args, **kwargs)
+                        async for message in self._get_messages(result):
+                            await self.send(message)
+                    else:
+                        replies += await self._measured_handler(target, event_handler_name, event_handler, args, kwargs, trace)
+                except BaseException:
+                    if recorder is not None:
+                        recorder.record(_flight.FAILED, message_id, 0, recorder.handler_id(target, event_handler_name))
+                    raise
+                if recorder is not None:
+                    recorder.record(_flight.HANDLED, message_id, 0, recorder.handler_id(target, event_handler_name))
+                handled = True
+        if not handled and recorder is not None:
+            recorder.record(_flight.UNHANDLED, message_id)
+        if trace is not None and not replies:
+            trace.stamp(_trace.HANDLED)
+            self.tracer.finish(trace)
 
-        if hasattr(self, event_handler_name):
-            logger.debug('Dispatching %s', event_handler_name)
-            event_handler = getattr(self, event_handler_name)
-            result = event_handler(*args, **kwargs)
+    async def _measured_handler(self, target, event_handler_name, event_handler, args, kwargs, trace):
+        """
+        Runs a handler, and sends what it produces, for `_dispatch_event` when it's being
+        measured or traced. Returns how many messages it produced.
+        """
+        replies = 0
+        start = time.perf_counter()
+        listener = type(target).__name__
+        invocation = None
+        if self.slow_handlers is not None:
+            message_type = type(args[0]).__name__ if args else '-'
+            invocation = self.slow_handlers.start(listener, event_handler_name, message_type)
+        failed = True
+        try:
+            if invocation is None:
+                result = event_handler(*args, **kwargs)
+            else:
+                result = self.slow_handlers.call(invocation, event_handler, args, kwargs)
             async for message in self._get_messages(result):
-                await self.send(message)
-        else:
-            logger.debug('No handler found for %s', event_handler_name)
+                await self._send_reply(message, trace)
+                replies += 1
+            failed = False
+        finally:
+            if invocation is not None:
+                self.slow_handlers.finish(invocation)
+            if self.metrics is not None:
+                self.metrics.handler_finished(listener, event_handler_name, time.perf_counter() - start, failed)
+        return replies
 
     async def _receive_loop(self, nursery, stream):
         """ Receives messages from the server and dispatches the events in coroutines """
+        self._syncing = SyncSnapshot() if self.fast_sync else None
         while True:
             message = await self._receive(stream)
-            nursery.spawn(self._dispatch_event, messages.get_name_by_class(message.__class__), message)
+            self._dispatch_received(nursery, message)
+
+    def _dispatch_received(self, nursery, message):
+        """ Dispatches a received message in a coroutine, or folds it into the sync snapshot until `ServerSync` """
+        syncing = self._syncing
+        if syncing is not None:
+            if syncing.apply(message):
+                if self.tracer is not None:
+                    # it won't be dispatched, so there's nothing more to trace
+                    self.tracer.dispatched(message)
+                return
+            if type(message) is messages.ServerSync:
+                syncing.server_sync = message
+                self._syncing = None
+                nursery.spawn(self._dispatch_synced, syncing)
+                return
+        nursery.spawn(self._dispatch_event, messages.get_name_by_class(message.__class__), message)
+
+    async def _dispatch_synced(self, snapshot):
+        """
+        Dispatches the `synced` event to those that handle it, and the snapshot's channels and
+        users one at a time to those that handle them but not `synced`, so that they keep their
+        state the usual way. Then `ServerSync` goes to everyone as usual.
+        """
+        targets = (self, *self._listeners)
+        await self._dispatch_to([target for target in targets if hasattr(target, 'on_synced')], 'synced', (snapshot,), {})
+        for event_name, states in (('channel_state', snapshot.channels), ('user_state', snapshot.users)):
+            stateful = [
+                target for target in targets
+                if not hasattr(target, 'on_synced') and hasattr(target, 'on_{}'.format(event_name))
+            ]
+            if stateful:
+                for message in states.values():
+                    await self._dispatch_to(stateful, event_name, (message,), {})
+        await self._dispatch_event('server_sync', snapshot.server_sync)
 
     async def _send_loop(self, nursery, stream):
         """ Pulls from the outbound queue and sends messages to the server """
         while True:
             message = await self._send_queue.get()
-            await self._send(stream, message)
+            if self.tracer is not None and isinstance(message, _trace.Traced):
+                message.trace.stamp(_trace.DEQUEUED)
+                await self._send(stream, message.message)
+                message.trace.stamp(_trace.SENT)
+                self.tracer.finish(message.trace)
+                message = message.message
+            else:
+                await self._send(stream, message)
+            if isinstance(message, messages.VoiceTarget):
+                self._registering[message.id] -= 1
+                if not self._registering[message.id]:
+                    del self._registering[message.id]
 
     async def _ping_loop(self):
         """ Send regular Ping messages. Murmur disconnects clients after 30 seconds of no pings. """
+        connected = trio.current_time()
         while True:
-            await trio.sleep(10)
-            ping = messages.Ping()
-            await self.send(ping)
+            await trio.sleep(self.ping_interval)
+            if self.ping_timeout is not None:
+                silence = trio.current_time() - (self.ping_stats.last_reply or connected)
+                if silence > self.ping_timeout:
+                    logger.warning('No ping replies for %.1f seconds, giving up on the connection', silence)
+                    raise TimeoutError('Server stopped answering pings')
+            await self.send(self.ping_stats.ping())
+
+    def add_listener(self, listener):
+        """
+        Registers a helper object whose `on_*` methods receive the same events as this instance.
+        Listener handlers run after the instance's own handler and can also produce messages.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """ Stops dispatching events to a listener added with `add_listener` """
+        self._listeners.remove(listener)
+
+    def spawn(self, async_fn, *args):
+        """ Runs a background task alongside the connection, for as long as it stays up """
+        self._nursery.spawn(async_fn, *args)
+
+    def _over_udp(self, message):
+        """
+        Whether to send `message` over UDP. Voice to a target whose `VoiceTarget` is still
+        waiting to go over TCP goes through the TCP tunnel too, so the server sees them in order.
+        """
+        return (
+            self.udp is not None and self.udp.carries(message)
+            and getattr(message, 'target', 0) not in self._registering
+        )
+
+    async def _queue(self, message, queued=None):
+        """ Puts `message` (or `queued`, which wraps it) on the queue for the TCP connection """
+        if isinstance(message, messages.VoiceTarget):
+            self._registering[message.id] += 1
+        await self._send_queue.put(message if queued is None else queued)
 
     async def send(self, message):
         """ Sends a message to the Mumble server (eventually) """
-        await self._send_queue.put(message)
+        if self._over_udp(message):
+            await self.udp.send(message)
+        else:
+            await self._queue(message)
+            if self.metrics is not None:
+                self.metrics.send_queue_peak = max(self.metrics.send_queue_peak, self._send_queue.qsize())
+
+    async def _send_reply(self, message, trace):
+        """ `send` for what handlers produce, carrying the trace of the message they handled """
+        if trace is None:
+            await self.send(message)
+            return
+        reply = trace.reply(message)
+        if self._over_udp(message):
+            await self.udp.send(_trace.Traced(message, reply))
+            reply.stamp(_trace.QUEUED)
+            return
+        await self._queue(message, _trace.Traced(message, reply))
+        reply.stamp(_trace.QUEUED)
+        if self.metrics is not None:
+            self.metrics.send_queue_peak = max(self.metrics.send_queue_peak, self._send_queue.qsize())
+
+    async def stream_audio(self, source, **kwargs):
+        """
+        Sends one voice transmission from an async iterator of Opus packets
+        (or PCM frames, given an `encoder`). See `AudioStream` for the options.
+        """
+        return await AudioStream(self.send, source, **kwargs).run()
+
+    async def _dump_on_signal(self):
+        """ Dumps the flight recorder on SIGUSR1, where there is one and we're in the main thread """
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+        try:
+            with trio.catch_signals({signal.SIGUSR1}) as batches:
+                async for _ in batches:
+                    self.flight_recorder.dump('SIGUSR1')
+        except RuntimeError:
+            logger.debug('Not in the main thread, the flight recorder can only be dumped on disconnect')
 
     async def run_async(self):
         """ Start this instance of Trumble in an async context """
+        reason = 'disconnect'
         try:
             async with trio.open_nursery() as nursery:
+                self._nursery = nursery
+                self._receive_buffer = bytearray()
                 stream = await self._connect()
+                if self.metrics is not None:
+                    self.metrics.connects += 1
+                    if self.metrics.path:
+                        nursery.spawn(self.metrics.export)
+                if self.slow_handlers is not None:
+                    nursery.spawn(self.slow_handlers.monitor)
+                if self.flight_recorder is not None:
+                    nursery.spawn(self._dump_on_signal)
                 nursery.spawn(self._dispatch_event, 'connect')
                 nursery.spawn(self._ping_loop)
                 nursery.spawn(self._receive_loop, nursery, stream)
                 nursery.spawn(self._send_loop, nursery, stream)
+        except trio.Cancelled:
+            # being stopped on purpose is nothing to look into later
+            reason = None
+            raise
+        except EOFError:
+            # the server hanging up, dumped as a plain disconnect
+            raise
+        except BaseException as exc:
+            reason = 'crash: {!r}'.format(exc)
+            raise
         finally:
             await self._dispatch_event('disconnect')
+            if self.tracer is not None:
+                self.tracer.flush()
+            if self.capture is not None:
+                self.capture.flush()
+            if self.flight_recorder is not None and reason is not None:
+                self.flight_recorder.dump(reason)
 
     def run(self):
         """ Use trio.run to start this instance of Trumble from a sync context """
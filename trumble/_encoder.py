@@ -0,0 +1,76 @@
+import itertools
+import os
+
+import attr
+import trio
+
+from ._opus import Encoder
+
+
+@attr.s
+class EncodeStats:
+    """ Per-stream encoder timings, in seconds """
+
+    frames = attr.ib(default=0)
+    total_latency = attr.ib(default=0.)
+    max_latency = attr.ib(default=0.)
+    # encodes (including waiting for a free worker) that took longer than the audio they encoded
+    deadline_misses = attr.ib(default=0)
+
+    @property
+    def mean_latency(self):
+        return self.total_latency / self.frames if self.frames else 0.
+
+class PooledEncoder:
+    """
+    One stream's Opus encoder, run in the pool's worker threads. It has the same `encode`
+    as `trumble.opus.Encoder`, except that it's async, and can be passed to `AudioStream`
+    as its `encoder` the same way. Frames are encoded one at a time and in order,
+    so PCM buffers mustn't be reused until `encode` returns.
+    """
+
+    def __init__(self, pool, name, **encoder_kwargs):
+        self.pool = pool
+        self.name = name
+        self.encoder = Encoder(**encoder_kwargs)
+        self.stats = EncodeStats()
+
+    async def encode(self, pcm):
+        start = trio.current_time()
+        packet = await trio.run_sync_in_worker_thread(self.encoder.encode, pcm, limiter=self.pool.limiter)
+        latency = trio.current_time() - start
+        self.stats.frames += 1
+        self.stats.total_latency += latency
+        self.stats.max_latency = max(self.stats.max_latency, latency)
+        samples = len(pcm) // (2 if isinstance(pcm, (bytes, bytearray, memoryview)) else 1)
+        if latency > samples / (self.encoder.rate * self.encoder.channels):
+            self.stats.deadline_misses += 1
+        return packet
+
+class EncoderPool:
+    """
+    A fixed number of worker threads shared by many streams' encoders. libopus doesn't hold
+    the GIL while encoding, so the streams really do encode in parallel, and the trio thread
+    is left free to keep sending on time. `AudioStream` only reads (and so encodes) a few
+    frames ahead of what it's sending, which keeps a slow pool from piling up work.
+    """
+
+    def __init__(self, workers=None):
+        self.limiter = trio.CapacityLimiter(workers or os.cpu_count() or 1)
+        self.encoders = {}
+        self._names = itertools.count()
+
+    def encoder(self, name=None, **encoder_kwargs):
+        """ Creates an encoder for one stream, see `trumble.opus.Encoder` for the options """
+        if name is None:
+            name = 'stream-{}'.format(next(self._names))
+        encoder = self.encoders[name] = PooledEncoder(self, name, **encoder_kwargs)
+        return encoder
+
+    def release(self, encoder):
+        """ Forgets an encoder (and its stats) once its stream is finished """
+        self.encoders.pop(encoder.name, None)
+
+    @property
+    def stats(self):
+        return {name: encoder.stats for name, encoder in self.encoders.items()}
@@ -0,0 +1,346 @@
+"""
+A stand-in for Murmur that runs in the same process, for testing and benchmarking bots
+without a real server. It speaks the same TLS framing, with a self-signed certificate it
+makes on start (needs cryptography), and plays out a script set by its arguments: a sync
+burst of any number of users and channels, state churn and voice at set rates, ping echoes,
+and permission denials. Everything random comes from a seeded generator, so runs repeat.
+"""
+
+import collections
+import datetime
+import logging
+import os
+import random
+import shutil
+import socket
+import struct
+import tempfile
+
+import attr
+import trio
+
+from . import messages
+from . import _varint
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+except ImportError:
+    x509 = None
+
+
+logger = logging.getLogger(__name__)
+
+# 1.3.0, as Murmur packs it
+VERSION = (1 << 16) | (3 << 8)
+
+# the ChanACL permissions Murmur names when it denies a request
+WRITE, MUTE_DEAFEN, MOVE, MAKE_CHANNEL, TEXT_MESSAGE, KICK, BAN = 0x1, 0x10, 0x20, 0x40, 0x200, 0x10000, 0x20000
+
+def self_signed_certificate(directory, common_name='trumble-fake-server'):
+    """ Writes a new self-signed certificate and its key to `directory`, returning their paths """
+    if x509 is None:
+        raise RuntimeError('The fake server needs cryptography to make its certificate')
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.utcnow()
+    certificate = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+        key.public_key()
+    ).serial_number(x509.random_serial_number()).not_valid_before(
+        now - datetime.timedelta(days=1)
+    ).not_valid_after(
+        now + datetime.timedelta(days=1)
+    ).sign(key, hashes.SHA256(), default_backend())
+    certificate_path = os.path.join(directory, 'certificate.pem')
+    key_path = os.path.join(directory, 'key.pem')
+    with open(certificate_path, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+        ))
+    return certificate_path, key_path
+
+@attr.s
+class FakeClient:
+    """ A client connected to a `FakeServer` """
+
+    session = attr.ib()
+    stream = attr.ib(repr=False)
+    queue = attr.ib(repr=False, default=attr.Factory(lambda: trio.Queue(1024)))
+    name = attr.ib(default=None)
+    synced = attr.ib(default=False)
+    received = attr.ib(default=attr.Factory(collections.Counter)) # message class name -> count
+    voice_arrivals = attr.ib(repr=False, default=attr.Factory(list)) # trio times voice packets came in
+
+class FakeServer:
+    """
+    Serves bots on `host` (port 0 picks a free one, found in `port` once listening). Start it
+    in a nursery with `await server.start(nursery)` and connect with `verify=False`.
+
+    After a client authenticates it's sent `channels` channels and `users` users, then
+    `ServerSync`. From then on every synced client gets `churn_rate` `UserState` changes a second
+    (a `churn_rejoins` share of them users leaving and coming back under a new session), and
+    voice from `voice_speakers` users, a `voice_frame_bytes` Opus frame every `voice_interval`
+    seconds each, in transmissions `voice_transmission` seconds long. Pings are echoed, and
+    messages of the classes in `deny` are answered with `PermissionDenied`, naming the permission
+    Murmur would have found missing. `hang_up` closes a client's connection from the server's end.
+
+    Subclasses can change what happens with `on_*` handlers like a bot's, taking the
+    `FakeClient` and the message and returning or yielding messages to send back.
+    """
+
+    def __init__(
+        self, host='127.0.0.1', port=0, *, users=0, channels=1, churn_rate=0., churn_rejoins=.1,
+        voice_speakers=0, voice_interval=.02, voice_frame_bytes=60, voice_transmission=2.,
+        echo_pings=True, deny=(), welcome_text='', seed=0,
+    ):
+        self.host = host
+        self.port = port
+        self.churn_rate = churn_rate
+        self.churn_rejoins = churn_rejoins
+        self.voice_speakers = voice_speakers
+        self.voice_interval = voice_interval
+        self.voice_frame_bytes = voice_frame_bytes
+        self.voice_transmission = voice_transmission
+        self.echo_pings = echo_pings
+        self.deny = tuple(deny)
+        self.welcome_text = welcome_text
+        self.random = random.Random(seed)
+        self.clients = []
+        self.listening = trio.Event()
+        self.channels = collections.OrderedDict()
+        for channel_id in range(max(1, channels)):
+            self.channels[channel_id] = messages.ChannelState(
+                channel_id=channel_id, parent=0, name='Root' if channel_id == 0 else 'Channel {}'.format(channel_id),
+                position=channel_id,
+            )
+        self.channels[0].ClearField('parent')
+        self.users = collections.OrderedDict()
+        self._next_session = 1
+        for _ in range(users):
+            self._add_user()
+        self._sync_burst = None
+
+    def _add_user(self, name=None):
+        session = self._next_session
+        self._next_session += 1
+        self.users[session] = messages.UserState(
+            session=session, name=name or 'User {}'.format(session),
+            channel_id=self.random.choice(list(self.channels)),
+        )
+        return session
+
+    async def start(self, nursery):
+        """ Runs the server in `nursery`, returning the port once it's listening """
+        nursery.spawn(self.serve)
+        await self.listening.wait()
+        return self.port
+
+    async def serve(self):
+        directory = tempfile.mkdtemp(prefix='trumble-fake-server-')
+        try:
+            context = trio.ssl.create_default_context(trio.ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(*self_signed_certificate(directory))
+        finally:
+            shutil.rmtree(directory)
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(128)
+        listener.setblocking(False)
+        self.port = listener.getsockname()[1]
+        listener = trio.socket.from_stdlib_socket(listener)
+        async with trio.open_nursery() as nursery:
+            if self.churn_rate:
+                nursery.spawn(self._churn_loop)
+            if self.voice_speakers:
+                nursery.spawn(self._voice_loop)
+            self.listening.set()
+            logger.debug('Fake server listening on %s:%d', self.host, self.port)
+            while True:
+                connection, _ = await listener.accept()
+                stream = trio.ssl.SSLStream(trio.SocketStream(connection), context, server_side=True)
+                nursery.spawn(self._serve_client, FakeClient(self._next_session, stream))
+                self._next_session += 1
+
+    async def _serve_client(self, client):
+        self.clients.append(client)
+        try:
+            async with trio.open_nursery() as nursery:
+                nursery.spawn(self._send_loop, client, nursery)
+                await self.send(client, messages.Version(version=VERSION, release='trumble fake server', os='trumble'))
+                nursery.spawn(self._receive_loop, client)
+        except Exception as exc:
+            logger.debug('Fake server lost session %d: %r', client.session, exc)
+        finally:
+            self.clients.remove(client)
+            self.users.pop(client.session, None)
+            if client.synced:
+                await self.broadcast(messages.UserRemove(session=client.session))
+
+    async def _receive_exactly(self, stream, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = await stream.receive_some(length - len(data))
+            if not chunk:
+                raise EOFError('Client disconnected')
+            data += chunk
+        return bytes(data)
+
+    async def _receive_loop(self, client):
+        udp_tunnel = messages.get_id_by_class(messages.UDPTunnel)
+        while True:
+            message_id, length = struct.unpack('!HI', await self._receive_exactly(client.stream, 6))
+            data = await self._receive_exactly(client.stream, length)
+            if message_id == udp_tunnel:
+                # voice from clients has no session in it, which `UDPTunnel` can't parse
+                client.received['UDPTunnel'] += 1
+                await self._respond(client, self.on_voice(client, data))
+                continue
+            message = messages._deserialize(message_id, data)
+            client.received[type(message).__name__] += 1
+            if isinstance(message, self.deny):
+                await self.send(client, self._denial(client, message))
+                continue
+            handler = getattr(self, 'on_{}'.format(messages.get_name_by_class(type(message))), None)
+            if handler is not None:
+                await self._respond(client, handler(client, message))
+
+    def _denial(self, client, message):
+        """ The `PermissionDenied` Murmur sends when a client lacks the permission `message` needs """
+        # checked in the channel of the user it's done to, and naming the user who can't do it
+        target = client.session
+        if isinstance(message, messages.UserRemove):
+            permission, target = BAN if message.ban else KICK, message.session
+        elif isinstance(message, messages.UserState):
+            permission, target = MOVE if message.HasField('channel_id') else MUTE_DEAFEN, message.session or target
+        elif isinstance(message, messages.TextMessage):
+            permission = TEXT_MESSAGE
+        elif isinstance(message, messages.ChannelState):
+            permission = MAKE_CHANNEL
+        else:
+            permission = WRITE
+        user = self.users.get(target)
+        return messages.PermissionDenied(
+            type=messages.PermissionDenied.Permission, permission=permission, session=client.session,
+            channel_id=user.channel_id if user is not None else 0,
+        )
+
+    async def _respond(self, client, result):
+        if result is None:
+            return
+        if isinstance(result, collections.Iterable) and not isinstance(result, bytes):
+            for message in result:
+                await self.send(client, message)
+        else:
+            await self.send(client, result)
+
+    async def _send_loop(self, client, nursery):
+        while True:
+            chunks = [await client.queue.get()]
+            while len(chunks) < 64 and chunks[-1] is not None:
+                try:
+                    chunks.append(client.queue.get_nowait())
+                except trio.WouldBlock:
+                    break
+            if chunks[-1] is None:
+                # `hang_up`, once everything before it is sent
+                await client.stream.send_all(b''.join(chunks[:-1]))
+                await client.stream.aclose()
+                nursery.cancel_scope.cancel()
+                return
+            await client.stream.send_all(b''.join(chunks))
+
+    async def send(self, client, message):
+        """ Queues a message (or already framed bytes) to send to a client """
+        await client.queue.put(message if isinstance(message, bytes) else messages._serialize(message))
+
+    async def hang_up(self, client):
+        """ Closes a client's connection, after the messages already queued for it """
+        await client.queue.put(None)
+
+    async def broadcast(self, message):
+        """ Sends a message to every synced client """
+        data = message if isinstance(message, bytes) else messages._serialize(message)
+        for client in self.clients:
+            if client.synced:
+                await self.send(client, data)
+
+    def sync_burst(self):
+        """ Everything sent between authentication and `ServerSync`, besides the client's own state """
+        if self._sync_burst is None:
+            burst = [messages.CodecVersion(alpha=-2147483637, beta=0, prefer_alpha=True, opus=True)]
+            burst += self.channels.values()
+            burst += self.users.values()
+            self._sync_burst = b''.join(messages._serialize(message) for message in burst)
+        return self._sync_burst
+
+    def on_version(self, client, message):
+        pass
+
+    def on_authenticate(self, client, message):
+        client.name = message.username
+        yield self.sync_burst()
+        self.users[client.session] = state = messages.UserState(session=client.session, name=message.username, channel_id=0)
+        yield state
+        yield messages.ServerSync(session=client.session, max_bandwidth=72000, welcome_text=self.welcome_text, permissions=0xf07ff)
+        yield messages.ServerConfig(allow_html=True, message_length=5000, image_message_length=131072, max_users=100000)
+        client.synced = True
+        self._sync_burst = None
+
+    def on_ping(self, client, message):
+        if self.echo_pings:
+            return messages.Ping(timestamp=message.timestamp)
+
+    def on_voice(self, client, data):
+        """ Voice a client sent, as the raw `UDPTunnel` body """
+        client.voice_arrivals.append(trio.current_time())
+
+    async def _churn_loop(self):
+        deadline = trio.current_time()
+        while True:
+            deadline += self.random.expovariate(self.churn_rate)
+            await trio.sleep_until(deadline)
+            sessions = [session for session in self.users if session not in {client.session for client in self.clients}]
+            if not sessions:
+                continue
+            session = self.random.choice(sessions)
+            if self.random.random() < self.churn_rejoins:
+                name = self.users.pop(session).name
+                await self.broadcast(messages.UserRemove(session=session))
+                await self.broadcast(self.users[self._add_user(name)])
+            else:
+                state = self.users[session]
+                change = messages.UserState(session=session)
+                if self.random.random() < .5:
+                    state.self_mute = change.self_mute = not state.self_mute
+                else:
+                    state.channel_id = change.channel_id = self.random.choice(list(self.channels))
+                await self.broadcast(change)
+            self._sync_burst = None
+
+    def _voice_packet(self, session, sequence_number, end_transmission):
+        """ A framed `UDPTunnel` of Opus from `session`, as Murmur relays it """
+        frame = bytes([0x98]) + bytes(self.voice_frame_bytes - 1) # CELT-only, narrowband, 20 ms, mono
+        body = (
+            bytes([messages.UDPTunnel.Opus << 5]) + _varint.encode(session) + _varint.encode(sequence_number)
+            + _varint.encode(len(frame) | (0x2000 if end_transmission else 0)) + frame
+        )
+        return struct.pack('!HI', messages.get_id_by_class(messages.UDPTunnel), len(body)) + body
+
+    async def _voice_loop(self):
+        deadline = trio.current_time()
+        sequence_number = 0
+        per_transmission = max(1, int(self.voice_transmission / self.voice_interval))
+        while True:
+            deadline += self.voice_interval
+            await trio.sleep_until(deadline)
+            speakers = list(self.users)[:self.voice_speakers]
+            end_transmission = (sequence_number + 1) % per_transmission == 0
+            for session in speakers:
+                await self.broadcast(self._voice_packet(session, sequence_number * 2, end_transmission))
+            sequence_number += 1
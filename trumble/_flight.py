@@ -0,0 +1,100 @@
+import array
+import datetime
+import logging
+import os
+import tempfile
+import time
+
+from . import messages
+
+
+logger = logging.getLogger(__name__)
+
+OUTCOMES = ('received', 'sent', 'handled', 'failed', 'unhandled')
+RECEIVED, SENT, HANDLED, FAILED, UNHANDLED = range(len(OUTCOMES))
+
+NO_MESSAGE = 0xffff
+
+class FlightRecorder:
+    """
+    The last `size` things that happened on a connection (messages received and sent, and
+    each handler that ran and how it went), kept in preallocated arrays so recording one
+    costs a few stores and no formatting or allocation. It's dumped as text when the
+    connection ends, whether it crashed or the server hung up, and on SIGUSR1: to `path` if
+    it's given, and otherwise to a new file in `directory` (by default the temp directory)
+    every time.
+
+    `TrumbleCore` has one as `flight_recorder` unless created with `flight_recorder=False`.
+    """
+
+    def __init__(self, size=4096, *, path=None, directory=None):
+        self.size = size
+        self.path = path
+        self.directory = directory
+        self.last_dump = None
+        self.count = 0
+        self._times = array.array('d', bytes(8 * size))
+        self._message_ids = array.array('H', bytes(2 * size))
+        self._lengths = array.array('I', bytes(4 * size))
+        self._handlers = array.array('H', bytes(2 * size))
+        self._outcomes = array.array('B', bytes(size))
+        self._handler_names = ['-']
+        self._handler_ids = {}
+        # to turn monotonic timestamps into wall clock ones when dumping
+        self._clock_offset = time.time() - time.perf_counter()
+
+    def handler_id(self, target, handler_name):
+        """ A small number standing for a listener's handler, to record instead of its name """
+        key = (type(target), handler_name)
+        handler_id = self._handler_ids.get(key)
+        if handler_id is None:
+            handler_id = self._handler_ids[key] = len(self._handler_names)
+            self._handler_names.append('{}.{}'.format(type(target).__name__, handler_name))
+        return handler_id
+
+    def record(self, outcome, message_id=NO_MESSAGE, length=0, handler_id=0):
+        idx = self.count % self.size
+        self.count += 1
+        self._times[idx] = time.perf_counter()
+        self._message_ids[idx] = message_id
+        self._lengths[idx] = length
+        self._handlers[idx] = handler_id
+        self._outcomes[idx] = outcome
+
+    def events(self):
+        """ Yields `(timestamp, message type, length, handler, outcome)`, oldest first """
+        first = max(0, self.count - self.size)
+        for number in range(first, self.count):
+            idx = number % self.size
+            message_id = self._message_ids[idx]
+            if message_id == NO_MESSAGE:
+                message_type = '-'
+            else:
+                try:
+                    message_type = messages.get_class_by_id(message_id).__name__
+                except KeyError:
+                    message_type = str(message_id)
+            yield (
+                self._times[idx] + self._clock_offset, message_type, self._lengths[idx],
+                self._handler_names[self._handlers[idx]], OUTCOMES[self._outcomes[idx]],
+            )
+
+    def dump(self, reason='requested'):
+        """ Writes the recorded events to a file, returning its path """
+        if self.path is not None:
+            path, f = self.path, open(self.path, 'w')
+        else:
+            # a file of our own, which nobody can have put there (or linked elsewhere) first
+            fd, path = tempfile.mkstemp(prefix='trumble-{}-'.format(os.getpid()), suffix='.flight', dir=self.directory)
+            f = os.fdopen(fd, 'w')
+        with f:
+            f.write('# trumble flight recorder: last {} of {} events, dumped at {} ({})\n'.format(
+                min(self.count, self.size), self.count, datetime.datetime.now().isoformat(), reason,
+            ))
+            for timestamp, message_type, length, handler, outcome in self.events():
+                f.write('{} {:<10} {:<20} {:>8} {}\n'.format(
+                    datetime.datetime.fromtimestamp(timestamp).isoformat(), outcome, message_type, length, handler,
+                ))
+        logger.info('Flight recorder dumped to %s (%s)', path, reason)
+        self.last_dump = path
+        return path
@@ -0,0 +1,210 @@
+import logging
+import math
+
+import attr
+import trio
+
+from . import messages
+
+
+logger = logging.getLogger(__name__)
+
+@attr.s
+class JitterStats:
+    """ Per-speaker counters, accumulated across transmissions """
+
+    received = attr.ib(default=0)
+    played = attr.ib(default=0)
+    lost = attr.ib(default=0) # never arrived in time to be played
+    late = attr.ib(default=0) # arrived after its slot was already played
+    duplicates = attr.ib(default=0)
+    overflows = attr.ib(default=0) # dropped because the buffer was full
+    underruns = attr.ib(default=0)
+    transmissions = attr.ib(default=0)
+    jitter = attr.ib(default=0.) # interarrival jitter estimate in seconds, as in RFC 3550
+
+class JitterBuffer:
+    """
+    Reorders one speaker's voice packets by sequence number and plays them out one at a time.
+    Mumble sequence numbers count 10 ms audio frames, so a packet's duration (`step`) is
+    learnt from the spacing of sequence numbers. Playout starts once `target_depth` packets
+    are buffered, which grows with the measured interarrival jitter.
+    """
+
+    FRAME_UNIT = 0.01
+
+    def __init__(self, *, min_depth=1, max_depth=25, jitter_factor=2.):
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.jitter_factor = jitter_factor
+        self.stats = JitterStats()
+        self._packets = {}
+        self._reset()
+
+    def _reset(self):
+        self._packets.clear()
+        self.playing = False
+        self.step = None
+        self.next_sequence = None
+        self._highest = None
+        self._last_transit = None
+        self._ended_at = None
+
+    @property
+    def idle(self):
+        return not self._packets and not self.playing
+
+    @property
+    def depth(self):
+        return len(self._packets)
+
+    @property
+    def frame_duration(self):
+        return (self.step or 2) * self.FRAME_UNIT
+
+    @property
+    def target_depth(self):
+        depth = math.ceil(self.jitter_factor * self.stats.jitter / self.frame_duration) + 1
+        return max(self.min_depth, min(self.max_depth, depth))
+
+    def push(self, tunnel, arrival):
+        """ Adds a received `UDPTunnel` voice packet, `arrival` being a monotonic timestamp """
+        sequence = tunnel.sequence_number
+        if self.next_sequence is not None:
+            distance = abs(sequence - self.next_sequence)
+            if distance > self.max_depth * (self.step or 2) * (1 if self.idle else 4):
+                # too far off to belong to what we were playing, so either the end of the last
+                # transmission got lost or the sender started counting again
+                self._reset()
+            elif sequence < self.next_sequence:
+                self.stats.late += 1
+                return
+        if sequence in self._packets:
+            self.stats.duplicates += 1
+            return
+        self.stats.received += 1
+        if self.next_sequence is None and not self._packets:
+            self.stats.transmissions += 1
+
+        if self._highest is not None and sequence != self._highest:
+            delta = abs(sequence - self._highest)
+            if self.step is None or delta < self.step:
+                self.step = delta
+        self._highest = sequence if self._highest is None else max(sequence, self._highest)
+
+        transit = arrival - sequence * self.FRAME_UNIT
+        if self._last_transit is not None:
+            self.stats.jitter += (abs(transit - self._last_transit) - self.stats.jitter) / 16
+        self._last_transit = transit
+
+        self._packets[sequence] = tunnel
+        if tunnel.end_transmission:
+            self._ended_at = sequence
+        while len(self._packets) > self.max_depth:
+            del self._packets[min(self._packets)]
+            self.stats.overflows += 1
+            self.next_sequence = min(self._packets)
+
+    def peek(self, sequence):
+        """ Returns the buffered packet with this sequence number without removing it, if any """
+        return self._packets.get(sequence)
+
+    def pop(self):
+        """
+        Returns the next `(sequence_number, tunnel)` to play, where `tunnel` is `None` if that
+        packet was lost, or returns `None` if nothing should be played right now.
+        """
+        if not self.playing:
+            if not self._packets:
+                return None
+            if len(self._packets) < self.target_depth and self._ended_at is None:
+                return None
+            self.playing = True
+            first = min(self._packets)
+            if self.next_sequence is not None and self.next_sequence < first:
+                # whatever we were still waiting for when we ran dry never showed up
+                self.stats.lost += (first - self.next_sequence) // (self.step or 2)
+            if self.next_sequence is None or self.next_sequence < first:
+                self.next_sequence = first
+
+        if not self._packets:
+            if self._ended_at is not None and self.next_sequence > self._ended_at:
+                self._reset()
+            else:
+                # ran dry mid-transmission, wait until enough has been buffered again
+                self.stats.underruns += 1
+                self.playing = False
+            return None
+
+        sequence = self.next_sequence
+        self.next_sequence += self.step or 2
+        tunnel = self._packets.pop(sequence, None)
+        if tunnel is None:
+            self.stats.lost += 1
+        else:
+            self.stats.played += 1
+            if tunnel.end_transmission:
+                self._reset()
+        return sequence, tunnel
+
+class JitterBuffers:
+    """
+    Keeps a `JitterBuffer` per speaking session. Add an instance as a listener so it receives
+    `UDPTunnel` voice, then iterate over `playout()` to get packets back on a steady clock.
+    """
+
+    def __init__(self, *, tick=0.02, **buffer_kwargs):
+        self.tick = tick
+        self.buffers = {}
+        self._buffer_kwargs = buffer_kwargs
+        self._due = {}
+
+    @property
+    def stats(self):
+        return {session_id: buffer.stats for session_id, buffer in self.buffers.items()}
+
+    def on_udp_tunnel(self, message):
+        if message.type == messages.UDPTunnel.Ping:
+            return
+        if message.session_id not in self.buffers:
+            self.buffers[message.session_id] = JitterBuffer(**self._buffer_kwargs)
+        self.buffers[message.session_id].push(message, trio.current_time())
+
+    def on_user_remove(self, message):
+        self.buffers.pop(message.session, None)
+        self._due.pop(message.session, None)
+
+    def on_disconnect(self):
+        self.buffers.clear()
+        self._due.clear()
+
+    async def playout(self):
+        """
+        Yields `(now, [(session_id, sequence_number, tunnel), ...])` every `tick` seconds,
+        with one entry per packet that became due for playout since the last tick.
+        `tunnel` is `None` for lost packets so decoders can conceal them.
+        Deadlines are absolute, so a late wakeup doesn't push back every later tick.
+        """
+        deadline = trio.current_time()
+        while True:
+            deadline += self.tick
+            await trio.sleep_until(deadline)
+            now = trio.current_time()
+            if now - deadline > self.tick:
+                # we fell behind by more than a tick, don't try to catch up in a burst
+                deadline = now
+            due = []
+            for session_id, buffer in self.buffers.items():
+                if buffer.idle:
+                    self._due.pop(session_id, None)
+                    continue
+                session_due = self._due.setdefault(session_id, now)
+                while session_due <= now:
+                    packet = buffer.pop()
+                    if packet is None:
+                        session_due = now + self.tick
+                        break
+                    due.append((session_id,) + packet)
+                    session_due += buffer.frame_duration
+                self._due[session_id] = session_due
+            yield now, due
@@ -68,8 +68,8 @@ class UDPTunnel:
     def _serialize_opus(self):
         if len(self.voice_frames) != 1:
             raise ValueError('Opus always contains only one frame in the packet')
-        if not all(isinstance(frame, bytes) for frame in self.voice_frames):
-            raise ValueError('Voice frames must be bytes')
+        if not all(isinstance(frame, (bytes, bytearray, memoryview)) for frame in self.voice_frames):
+            raise ValueError('Voice frames must be bytes or a bytes-like buffer')
         voice_frame = self.voice_frames[0]
         if len(voice_frame) > 8191:
             raise ValueError('The maximum voice frame size is 8191')
@@ -98,6 +98,15 @@ class UDPTunnel:
                 payload += b'\x00'
         return bytes(payload)
 
+    def prepare(self):
+        """
+        Serializes everything but the header and sequence number of an Opus packet,
+        for sending the same audio many times over without serializing it again.
+        """
+        if self.type != _UDPTypes.Opus:
+            raise ValueError('Only Opus packets can be prepared')
+        return PreparedUDPTunnel(self._serialize_opus() + _struct.pack('!fff', *self.position))
+
     def SerializeToString(self):
         header = _struct.pack('!B', ((self.type & 0b111) << 5) | (self.target & 0b11111))
         if self.type == _UDPTypes.Ping:
@@ -109,7 +118,7 @@ class UDPTunnel:
         return header + payload
 
     def _deserialize_ping(self, data):
-        self.timestamp = _varint.decode(data)
+        self.timestamp, _ = _varint.decode(data)
 
     def _deserialize_audio(self, data):
         self.session_id, remainder = _varint.decode(data)
@@ -166,6 +175,23 @@ class UDPTunnel:
         else:
             raise NotImplementedError('Unimplemented type')
 
+@_attr.s(slots=True)
+class PreparedUDPTunnel:
+    """ An outgoing Opus `UDPTunnel` with its voice frame already serialized, see `UDPTunnel.prepare` """
+
+    payload = _attr.ib()
+    target = _attr.ib(default=_UDPTargets.NormalTalking)
+    sequence_number = _attr.ib(default=0)
+
+    @property
+    def end_transmission(self):
+        # the terminator bit of the voice header, as in UDPTunnel._serialize_opus
+        return bool(self.payload[0] & 0b00100000)
+
+    def SerializeToString(self):
+        header = _struct.pack('!B', (_UDPTypes.Opus << 5) | (self.target & 0b11111))
+        return header + _varint.encode(self.sequence_number) + self.payload
+
 # attach the enums to UDPTunnel, since this is similar to how protobufs work
 for constant_enum in (_UDPTypes, _UDPTargets):
     for k, v in constant_enum.__members__.items():
@@ -205,6 +231,8 @@ _MESSAGE_CLASS_FROM_ID = {
 }
 
 _MESSAGE_ID_FROM_CLASS = {v: k for k, v in _MESSAGE_CLASS_FROM_ID.items()}
+# send-only, so it only goes in this direction
+_MESSAGE_ID_FROM_CLASS[PreparedUDPTunnel] = 1
 
 _MESSAGE_NAME_FROM_CLASS = {v: _to_snake_case(v.__name__) for k, v in _MESSAGE_CLASS_FROM_ID.items()}
 
@@ -0,0 +1,177 @@
+"""
+Counters, gauges and histograms about a connection, readable from bot code and exportable
+in the Prometheus text format (e.g. for node_exporter's textfile collector).
+"""
+
+import bisect
+import collections
+import logging
+import os
+
+import trio
+
+from . import messages
+
+
+logger = logging.getLogger(__name__)
+
+# seconds, from 100 µs to 10 s
+DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+class Histogram:
+    """ Counts of observations per bucket, Prometheus-style; `counts` aren't cumulative, the export is """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.
+
+    def quantile(self, q):
+        """ Upper bound of the bucket the `q`th quantile falls in """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return 0.
+
+def _labels(**labels):
+    return ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels.items()
+    )
+
+def _message_name(message_id):
+    try:
+        return messages.get_class_by_id(message_id).__name__
+    except KeyError:
+        return str(message_id)
+
+class Metrics:
+    """
+    Everything `TrumbleCore` measures when it's created with `metrics=True` (or given an
+    instance of this). Counters are keyed by `(transport, message_id)`, `transport` being
+    'tcp' or 'udp', and handler latencies by `(listener class name, handler name)`.
+    Gauges are read when exported, from the callables passed to `gauge`.
+
+    If `path` is set, the Prometheus text format is written there every `interval` seconds
+    while connected, replacing the file atomically. With metrics off, `TrumbleCore` only
+    ever checks `metrics is not None`.
+    """
+
+    def __init__(self, *, path=None, interval=15., prefix='trumble', buckets=DEFAULT_BUCKETS):
+        self.path = path
+        self.interval = interval
+        self.prefix = prefix
+        self.buckets = buckets
+        self.received = collections.Counter()
+        self.received_bytes = collections.Counter()
+        self.sent = collections.Counter()
+        self.sent_bytes = collections.Counter()
+        self.handler_latency = collections.defaultdict(lambda: Histogram(self.buckets))
+        self.handler_errors = collections.Counter()
+        self.connects = 0
+        self.send_queue_peak = 0
+        self._gauges = collections.OrderedDict()
+
+    @property
+    def reconnects(self):
+        return max(0, self.connects - 1)
+
+    def gauge(self, name, function, help=''):
+        """ Registers a gauge, whose value is `function()` at export time """
+        self._gauges[name] = (function, help)
+
+    def message_received(self, message_id, length, transport='tcp'):
+        self.received[transport, message_id] += 1
+        self.received_bytes[transport, message_id] += length
+
+    def message_sent(self, message_id, length, transport='tcp'):
+        self.sent[transport, message_id] += 1
+        self.sent_bytes[transport, message_id] += length
+
+    def handler_finished(self, listener, handler, seconds, failed=False):
+        self.handler_latency[listener, handler].observe(seconds)
+        if failed:
+            self.handler_errors[listener, handler] += 1
+
+    def render(self):
+        """ The current values in the Prometheus text exposition format """
+        lines = []
+
+        def header(name, kind, help):
+            lines.append('# HELP {}_{} {}'.format(self.prefix, name, help))
+            lines.append('# TYPE {}_{} {}'.format(self.prefix, name, kind))
+
+        for name, counter, help in (
+            ('messages_received_total', self.received, 'Messages received, by type and transport'),
+            ('bytes_received_total', self.received_bytes, 'Bytes received, including framing, by message type and transport'),
+            ('messages_sent_total', self.sent, 'Messages sent, by type and transport'),
+            ('bytes_sent_total', self.sent_bytes, 'Bytes sent, including framing, by message type and transport'),
+        ):
+            header(name, 'counter', help)
+            for (transport, message_id), value in sorted(counter.items()):
+                lines.append('{}_{}{{{}}} {}'.format(
+                    self.prefix, name, _labels(type=_message_name(message_id), transport=transport), value,
+                ))
+
+        header('handler_seconds', 'histogram', 'Time spent in event handlers, including sending what they produce')
+        for (listener, handler), histogram in sorted(self.handler_latency.items()):
+            labels = _labels(listener=listener, handler=handler)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('{}_handler_seconds_bucket{{{},le="{}"}} {}'.format(self.prefix, labels, bound, cumulative))
+            lines.append('{}_handler_seconds_sum{{{}}} {}'.format(self.prefix, labels, histogram.sum))
+            lines.append('{}_handler_seconds_count{{{}}} {}'.format(self.prefix, labels, histogram.count))
+        header('handler_errors_total', 'counter', 'Event handlers that raised')
+        for (listener, handler), value in sorted(self.handler_errors.items()):
+            lines.append('{}_handler_errors_total{{{}}} {}'.format(self.prefix, _labels(listener=listener, handler=handler), value))
+
+        header('connects_total', 'counter', 'Connections made')
+        lines.append('{}_connects_total {}'.format(self.prefix, self.connects))
+        header('reconnects_total', 'counter', 'Connections made after the first')
+        lines.append('{}_reconnects_total {}'.format(self.prefix, self.reconnects))
+        header('send_queue_peak', 'gauge', 'Deepest the outbound queue has been')
+        lines.append('{}_send_queue_peak {}'.format(self.prefix, self.send_queue_peak))
+        for name, (function, help) in self._gauges.items():
+            try:
+                value = function()
+            except Exception:
+                logger.exception('Reading gauge %s failed', name)
+                continue
+            header(name, 'gauge', help)
+            lines.append('{}_{} {}'.format(self.prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path=None):
+        """ Writes `render()` to `path` (by default the one given at creation) atomically """
+        self._write_text(self.render(), path or self.path)
+
+    async def export(self):
+        """ Writes the file every `interval` seconds, `TrumbleCore` runs this while connected """
+        while True:
+            await trio.sleep(self.interval)
+            text = self.render()
+            try:
+                await trio.run_sync_in_worker_thread(self._write_text, text, self.path)
+            except OSError:
+                logger.exception('Writing metrics to %s failed', self.path)
+
+    @staticmethod
+    def _write_text(text, path):
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'w') as f:
+            f.write(text)
+        os.replace(temporary, path)
@@ -0,0 +1,145 @@
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ._opus import Decoder, MAX_FRAME_SAMPLES, SAMPLE_RATE
+
+
+logger = logging.getLogger(__name__)
+
+class Mixer:
+    """
+    Decodes every speaker's Opus voice and mixes the result into one mono 48 kHz PCM stream.
+
+    All buffers are allocated up front: each speaker gets a row of a float32 matrix that their
+    decoder writes into directly, and a block is mixed with a single matrix-vector product of
+    that matrix with the per-speaker gains, then clipped so loud overlaps saturate instead of
+    wrapping around. Lost packets are recovered from the next packet's FEC data when the
+    jitter buffer already has it, and concealed by the decoder otherwise.
+    """
+
+    def __init__(self, *, block=0.02, max_speakers=64, dtype='int16', idle_blocks=50):
+        if numpy is None:
+            raise ImportError('Mixing audio requires numpy')
+        self.block_samples = int(block * SAMPLE_RATE)
+        self.max_speakers = max_speakers
+        self.idle_blocks = idle_blocks
+        self.gains = {}
+        self._pcm = numpy.zeros((max_speakers, self.block_samples + 2 * MAX_FRAME_SAMPLES), numpy.float32)
+        self._fill = [0] * max_speakers
+        self._idle = [0] * max_speakers
+        self._row_gains = numpy.zeros(max_speakers, numpy.float32)
+        self._mixed = numpy.zeros(self.block_samples, numpy.float32)
+        self._out = numpy.zeros(self.block_samples, numpy.dtype(dtype))
+        self._rows = {}
+        self._free = list(range(max_speakers - 1, -1, -1))
+        self._decoders = {}
+
+    @property
+    def speakers(self):
+        """ Sessions currently holding a mixer row """
+        return list(self._rows)
+
+    def set_gain(self, session_id, gain):
+        """ Sets a linear gain for one speaker, 1.0 being unchanged """
+        self.gains[session_id] = gain
+
+    def forget(self, session_id):
+        """ Drops a speaker's row and decoder, e.g. because they disconnected """
+        row = self._rows.pop(session_id, None)
+        if row is not None:
+            self._release(row)
+        self._decoders.pop(session_id, None)
+
+    def _release(self, row):
+        self._fill[row] = 0
+        self._idle[row] = 0
+        self._row_gains[row] = 0.
+        self._free.append(row)
+
+    def _row(self, session_id):
+        if session_id not in self._rows:
+            if not self._free:
+                logger.warning('Too many simultaneous speakers, not mixing session %d', session_id)
+                return None
+            self._rows[session_id] = self._free.pop()
+        if session_id not in self._decoders:
+            self._decoders[session_id] = Decoder()
+        return self._rows[session_id]
+
+    def add(self, session_id, sequence, tunnel, jitter_buffer=None):
+        """
+        Decodes one packet from `JitterBuffers.playout` into the speaker's row.
+        `tunnel` is `None` for a lost packet, which `jitter_buffer` helps recover.
+        """
+        row = self._row(session_id)
+        if row is None:
+            return
+        space = self._pcm[row, self._fill[row]:]
+        if len(space) < MAX_FRAME_SAMPLES:
+            logger.warning('Session %d is sending faster than real time, dropping audio', session_id)
+            return
+        decoder = self._decoders[session_id]
+        if tunnel is None:
+            step = jitter_buffer.step if jitter_buffer else None
+            frame_size = int(jitter_buffer.frame_duration * SAMPLE_RATE) if jitter_buffer else self.block_samples
+            following = jitter_buffer.peek(sequence + step) if step else None
+            if following is not None and following.voice_frames and following.voice_frames[0]:
+                written = decoder.decode(following.voice_frames[0], space, frame_size, fec=True)
+            else:
+                written = decoder.decode(None, space, frame_size)
+        elif tunnel.voice_frames and tunnel.voice_frames[0]:
+            written = decoder.decode(tunnel.voice_frames[0], space, MAX_FRAME_SAMPLES)
+        else:
+            return
+        self._fill[row] += written
+        self._idle[row] = 0
+
+    def mix(self):
+        """
+        Mixes the next block from every speaker. The returned array is reused for the next
+        block, so copy it if it needs to outlive that.
+        """
+        block = self.block_samples
+        for session_id, row in list(self._rows.items()):
+            fill = self._fill[row]
+            if fill < block:
+                self._pcm[row, fill:block] = 0.
+            if not fill:
+                self._idle[row] += 1
+                if self._idle[row] >= self.idle_blocks:
+                    del self._rows[session_id]
+                    self._release(row)
+                    continue
+            self._row_gains[row] = self.gains.get(session_id, 1.)
+
+        numpy.dot(self._row_gains, self._pcm[:, :block], out=self._mixed)
+
+        for row in self._rows.values():
+            fill = self._fill[row]
+            if fill > block:
+                numpy.copyto(self._pcm[row, :fill - block], self._pcm[row, block:fill])
+                self._fill[row] = fill - block
+            else:
+                self._fill[row] = 0
+
+        numpy.clip(self._mixed, -1., 1., out=self._mixed)
+        if self._out.dtype.kind != 'f':
+            numpy.multiply(self._mixed, 32767., out=self._mixed)
+        numpy.copyto(self._out, self._mixed, casting='unsafe')
+        return self._out
+
+    async def stream(self, jitter_buffers):
+        """ Yields one mixed block per tick of `jitter_buffers.playout()` """
+        if int(jitter_buffers.tick * SAMPLE_RATE) != self.block_samples:
+            raise ValueError('The jitter buffer tick and the mixer block must be the same length')
+        async for _, due in jitter_buffers.playout():
+            for session_id, sequence, tunnel in due:
+                self.add(session_id, sequence, tunnel, jitter_buffers.buffers.get(session_id))
+            yield self.mix()
+
+    def on_user_remove(self, message):
+        self.forget(message.session)
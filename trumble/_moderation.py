@@ -0,0 +1,254 @@
+import collections
+import logging
+
+import attr
+import trio
+
+from . import messages
+from ._ratelimit import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+# the permissions (ChanACL bits) whose denial fails each kind of operation
+_PERMISSIONS = {
+    'move': (0x4, 0x20), # Enter (for the target), Move
+    'mute': (0x10,), # MuteDeafen
+    'deafen': (0x10,),
+    'kick': (0x10000, 0x20000), # Kick, Ban
+}
+
+@attr.s
+class Operation:
+    """ A single moderation request and what became of it """
+
+    action = attr.ib() # 'move', 'mute', 'deafen' or 'kick'
+    session = attr.ib()
+    message = attr.ib()
+    # the UserState field and value that confirm the change, unused for kicks
+    field = attr.ib(default=None)
+    value = attr.ib(default=None)
+
+    sent = attr.ib(default=None)
+    finished = attr.ib(default=None)
+    error = attr.ib(default=None)
+    _done = attr.ib(default=attr.Factory(trio.Event), init=False, repr=False)
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    @property
+    def succeeded(self):
+        return self.done and self.error is None
+
+    @property
+    def latency(self):
+        if self.done and self.sent is not None:
+            return self.finished - self.sent
+
+    def _confirmed_by(self, message):
+        if self.action == 'kick':
+            return isinstance(message, messages.UserRemove)
+        return (
+            isinstance(message, messages.UserState)
+            and message.HasField(self.field)
+            and getattr(message, self.field) == self.value
+        )
+
+    def _denied_by(self, message):
+        deny_type = messages.PermissionDenied
+        if message.type == deny_type.Permission:
+            return message.permission in _PERMISSIONS[self.action]
+        if message.type == deny_type.ChannelFull:
+            return self.action == 'move'
+        if message.type == deny_type.SuperUser:
+            # nobody can mute, deafen or kick SuperUser
+            return self.action in ('mute', 'deafen', 'kick')
+        # the rest (TextTooLong, ChannelName, ...) are about other requests entirely
+        return False
+
+@attr.s
+class BulkResult:
+    """ Aggregate progress and latency of a batch of operations """
+
+    operations = attr.ib()
+    started = attr.ib(default=None)
+
+    @property
+    def total(self):
+        return len(self.operations)
+
+    @property
+    def completed(self):
+        return sum(1 for op in self.operations if op.done)
+
+    @property
+    def succeeded(self):
+        return [op for op in self.operations if op.succeeded]
+
+    @property
+    def failed(self):
+        return [op for op in self.operations if op.done and op.error is not None]
+
+    @property
+    def latencies(self):
+        return sorted(op.latency for op in self.operations if op.succeeded)
+
+    def latency_percentile(self, percentile):
+        latencies = self.latencies
+        if latencies:
+            return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+class BulkModerator:
+    """
+    Moves, mutes, deafens or kicks many sessions at once. Requests are pipelined (up to
+    `window` unanswered at a time, paced by a token bucket) rather than sent one by one,
+    and each operation completes when the server echoes the change back, or fails on
+    `PermissionDenied` or after `timeout` seconds.
+
+    A `PermissionDenied` fails the oldest outstanding operation its type (and permission)
+    could have denied, preferring one on the session it names. Changes that wouldn't change
+    anything, as far as the user states seen so far go, succeed without being sent, since
+    the server wouldn't echo them. Add an instance as a listener so it sees the replies.
+    """
+
+    def __init__(self, send, *, window=32, rate=50, burst=50, timeout=10):
+        self._send = send
+        self.window = window
+        self.bucket = TokenBucket(rate, burst)
+        self.timeout = timeout
+        self.session = None
+        self._outstanding = collections.deque()
+        self._users = {}
+        self._window = trio.Semaphore(window)
+
+    async def move(self, sessions, channel_id, **kwargs):
+        """ Moves every session into `channel_id` """
+        return await self.run([
+            self._user_state('move', session, 'channel_id', channel_id) for session in sessions
+        ], **kwargs)
+
+    async def mute(self, sessions, mute=True, **kwargs):
+        """ Server-mutes (or unmutes) every session """
+        return await self.run([
+            self._user_state('mute', session, 'mute', mute) for session in sessions
+        ], **kwargs)
+
+    async def deafen(self, sessions, deaf=True, **kwargs):
+        """ Server-deafens (or undeafens) every session """
+        return await self.run([
+            self._user_state('deafen', session, 'deaf', deaf) for session in sessions
+        ], **kwargs)
+
+    async def kick(self, sessions, reason='', ban=False, **kwargs):
+        """ Kicks (or bans) every session """
+        operations = []
+        for session in sessions:
+            user_remove = messages.UserRemove()
+            user_remove.session = session
+            user_remove.reason = reason
+            user_remove.ban = ban
+            operations.append(Operation('kick', session, user_remove))
+        return await self.run(operations, **kwargs)
+
+    @staticmethod
+    def _user_state(action, session, field, value):
+        user_state = messages.UserState()
+        user_state.session = session
+        setattr(user_state, field, value)
+        return Operation(action, session, user_state, field, value)
+
+    async def run(self, operations, progress=None):
+        """
+        Sends the operations and waits until all of them have completed or failed.
+        `progress`, if given, is called with the `BulkResult` every time an operation finishes.
+        """
+        result = BulkResult(operations, trio.current_time())
+        async with trio.open_nursery() as nursery:
+            for op in operations:
+                if self._unchanged(op):
+                    op.sent = op.finished = trio.current_time()
+                    op._done.set()
+                    if progress:
+                        progress(result)
+                    continue
+                await self._window.acquire()
+                await self.bucket.acquire()
+                op.sent = trio.current_time()
+                self._outstanding.append(op)
+                nursery.spawn(self._wait, op, result, progress)
+                await self._send(op.message)
+        logger.info(
+            '%d/%d operations succeeded in %.2fs',
+            len(result.succeeded), result.total, trio.current_time() - result.started,
+        )
+        return result
+
+    async def _wait(self, op, result, progress):
+        with trio.move_on_after(self.timeout):
+            await op._done.wait()
+        if not op.done:
+            self._finish(op, 'timed out')
+        if progress:
+            progress(result)
+
+    def _unchanged(self, op):
+        state = self._users.get(op.session)
+        return op.field is not None and state is not None and getattr(state, op.field) == op.value
+
+    def _finish(self, op, error=None):
+        op.finished = trio.current_time()
+        op.error = error
+        self._outstanding.remove(op)
+        self._window.release()
+        op._done.set()
+
+    def _confirm(self, message):
+        """ Completes the oldest outstanding operation this message confirms, if any """
+        for op in self._outstanding:
+            if op.session == message.session and op._confirmed_by(message):
+                self._finish(op)
+                return
+
+    def _ours(self, message):
+        return self.session is None or not message.HasField('actor') or message.actor == self.session
+
+    def on_server_sync(self, message):
+        self.session = message.session
+
+    def on_synced(self, snapshot):
+        for session, message in snapshot.users.items():
+            # a copy, since later changes are merged into it
+            state = self._users[session] = messages.UserState()
+            state.MergeFrom(message)
+
+    def on_user_state(self, message):
+        state = self._users.get(message.session)
+        if state is None:
+            state = self._users[message.session] = messages.UserState()
+        state.MergeFrom(message)
+        if self._ours(message):
+            self._confirm(message)
+
+    def on_user_remove(self, message):
+        self._users.pop(message.session, None)
+        if self._ours(message):
+            self._confirm(message)
+        # whatever else was pending for this session isn't going to happen now, including kicks
+        # when someone else removed them first, or they left on their own
+        for op in [op for op in self._outstanding if op.session == message.session]:
+            self._finish(op, 'user left')
+
+    def on_permission_denied(self, message):
+        candidates = [op for op in self._outstanding if op._denied_by(message)]
+        if not candidates:
+            return
+        op = next((op for op in candidates if op.session == message.session), candidates[0])
+        reason = message.reason or messages.PermissionDenied.DenyType.Name(message.type)
+        self._finish(op, 'permission denied: {}'.format(reason))
+
+    def on_disconnect(self):
+        self._users.clear()
+        while self._outstanding:
+            self._finish(self._outstanding[0], 'disconnected')
@@ -0,0 +1,275 @@
+"""
+Ogg (RFC 3533) page parsing and writing for Ogg Opus (RFC 7845) files, without decoding
+or encoding any audio.
+"""
+
+import mmap
+import os
+import struct
+
+import attr
+
+from ._opus import SAMPLE_RATE, packet_samples
+
+
+_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+
+HEADER_CONTINUED = 0x01
+HEADER_BOS = 0x02
+HEADER_EOS = 0x04
+
+class OggError(Exception):
+    pass
+
+def _build_crc_table():
+    # Ogg's CRC-32: polynomial 0x04c11db7, not reflected, zero initial value and no final xor
+    table = []
+    for byte in range(256):
+        crc = byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04c11db7 if crc & 0x80000000 else crc << 1) & 0xffffffff
+        table.append(crc)
+    return tuple(table)
+
+_CRC_TABLE = _build_crc_table()
+
+def _crc(data, crc=0):
+    table = _CRC_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xffffffff) ^ table[(crc >> 24) ^ byte]
+    return crc
+
+@attr.s
+class Page:
+    """ An Ogg page's header, plus where to find its body in the file """
+
+    offset = attr.ib()
+    header_type = attr.ib()
+    granule_position = attr.ib()
+    serial = attr.ib()
+    sequence = attr.ib()
+    lacing = attr.ib()
+    body_offset = attr.ib()
+
+    @property
+    def body_length(self):
+        return sum(self.lacing)
+
+    @property
+    def end(self):
+        return self.body_offset + self.body_length
+
+@attr.s
+class OpusHead:
+    """ The identification header at the start of every Ogg Opus stream """
+
+    version = attr.ib()
+    channels = attr.ib()
+    pre_skip = attr.ib()
+    input_sample_rate = attr.ib()
+    output_gain = attr.ib()
+    mapping_family = attr.ib()
+
+    @classmethod
+    def parse(cls, data):
+        if data[:8] != b'OpusHead':
+            raise OggError('Not an Opus stream')
+        return cls(*struct.unpack_from('<BBHIhB', data, 8))
+
+@attr.s
+class Packet:
+    """ An Opus packet, and the granule position (48 kHz sample count) at which it ends """
+
+    data = attr.ib()
+    granule_position = attr.ib()
+    page_offset = attr.ib()
+
+class OggOpusReader:
+    """
+    Streams Opus packets out of an Ogg Opus file. The file is memory-mapped, so many readers
+    of the same file share the OS page cache and nothing is read that isn't used.
+    Chained streams are followed; other multiplexed logical streams are ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.head = None
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._map)
+
+    def page_at(self, offset):
+        """ Parses the page header at `offset`, or returns None if there isn't one """
+        if offset + _PAGE_HEADER.size > len(self._map):
+            return None
+        capture, version, header_type, granule, serial, sequence, _, segments = _PAGE_HEADER.unpack_from(self._map, offset)
+        if capture != b'OggS' or version != 0:
+            return None
+        lacing_offset = offset + _PAGE_HEADER.size
+        lacing = self._map[lacing_offset:lacing_offset + segments]
+        return Page(offset, header_type, granule, serial, sequence, lacing, lacing_offset + segments)
+
+    def pages(self, offset=0):
+        """ Yields every page from `offset` onwards, resynchronising after garbage """
+        while True:
+            page = self.page_at(offset)
+            if page is None:
+                offset = self._map.find(b'OggS', offset + 1)
+                if offset < 0:
+                    return
+                continue
+            if page.end > len(self._map):
+                # truncated file
+                return
+            yield page
+            offset = page.end
+
+    def _raw_packets(self, offset):
+        """ Yields `(data, page)` for every packet of the first logical stream, `page` being where it ends """
+        serial = None
+        # None while we don't know the start of the packet in progress, e.g. right after a seek
+        partial = None
+        for page in self.pages(offset):
+            if page.header_type & HEADER_BOS:
+                serial, partial = page.serial, b''
+            elif serial is None:
+                serial = page.serial
+            if page.serial != serial:
+                continue
+            if not page.header_type & HEADER_CONTINUED:
+                partial = b''
+            position = page.body_offset
+            segment_start = position
+            for lacing_value in page.lacing:
+                position += lacing_value
+                if lacing_value < 255:
+                    if partial is not None:
+                        yield partial + self._map[segment_start:position], page
+                    partial = b''
+                    segment_start = position
+            if segment_start != position and partial is not None:
+                # packet continues on the next page
+                partial += self._map[segment_start:position]
+
+    def packets(self, offset=0):
+        """
+        Yields the audio `Packet`s of the stream, parsing the Opus headers on the way.
+        Ogg only records the granule position at the end of each page, so the position
+        of the packets before it is worked out backwards from their durations.
+        """
+        page, page_packets = None, []
+        for data, packet_page in self._raw_packets(offset):
+            if data[:8] == b'OpusHead':
+                self.head = OpusHead.parse(data)
+                continue
+            elif data[:8] == b'OpusTags' or not data:
+                continue
+            if packet_page is not page:
+                yield from self._place(page, page_packets)
+                page, page_packets = packet_page, []
+            page_packets.append(data)
+        yield from self._place(page, page_packets)
+
+    @staticmethod
+    def _place(page, page_packets):
+        if not page_packets:
+            return
+        granule = page.granule_position - sum(packet_samples(data) for data in page_packets)
+        for data in page_packets:
+            granule += packet_samples(data)
+            yield Packet(data, granule, page.offset)
+
+class OggOpusWriter:
+    """
+    Writes Opus packets into a new Ogg Opus file as they are, with no re-encoding.
+    Granule positions are the running sum of the packets' durations, so gaps have to be
+    written as packets too (a TOC byte on its own is a valid packet with no audio in it,
+    which decoders conceal like a lost one). Packets are gathered into pages of up to
+    `packets_per_page`, and `flush` writes out a partial page early.
+    """
+
+    def __init__(self, path, *, channels=1, pre_skip=0, tags=None, serial=None, packets_per_page=50, buffering=65536):
+        self.path = path
+        self.packets_per_page = packets_per_page
+        self.serial = serial if serial is not None else struct.unpack('<I', os.urandom(4))[0]
+        self.granule_position = 0
+        self._file = open(path, 'wb', buffering=buffering)
+        self._sequence = 0
+        self._packets = []
+        head = b'OpusHead' + struct.pack('<BBHIhB', 1, channels, pre_skip, SAMPLE_RATE, 0, 0)
+        vendor = b'trumble'
+        comments = [
+            '{}={}'.format(key.upper(), value).encode('utf-8')
+            for key, value in (tags or {}).items()
+        ]
+        opus_tags = b''.join(
+            [b'OpusTags', struct.pack('<I', len(vendor)), vendor, struct.pack('<I', len(comments))]
+            + [struct.pack('<I', len(comment)) + comment for comment in comments]
+        )
+        # the headers each get a page of their own, and audio starts on a fresh page
+        self._write_page([head], 0, HEADER_BOS)
+        self._write_page([opus_tags], 0, 0)
+
+    def _write_page(self, packets, granule_position, header_type):
+        lacing = bytearray()
+        for packet in packets:
+            lacing += b'\xff' * (len(packet) // 255) + bytes([len(packet) % 255])
+        if len(lacing) > 255:
+            raise OggError('Too many packets for one page')
+        header = bytearray(_PAGE_HEADER.pack(
+            b'OggS', 0, header_type, granule_position, self.serial, self._sequence, 0, len(lacing)
+        ))
+        header += lacing
+        crc = _crc(header)
+        for packet in packets:
+            crc = _crc(packet, crc)
+        struct.pack_into('<I', header, 22, crc)
+        self._file.write(header)
+        for packet in packets:
+            self._file.write(packet)
+        self._sequence += 1
+
+    def _flush_page(self, header_type=0):
+        self._write_page(self._packets, self.granule_position, header_type)
+        self._packets = []
+
+    def write(self, packet):
+        """ Adds an Opus packet (anything bytes-like) to the stream """
+        if len(packet) >= 255 * 255:
+            raise OggError('Packet too large to fit on one page')
+        if sum(len(p) // 255 + 1 for p in self._packets) + len(packet) // 255 + 1 > 255:
+            self._flush_page()
+        self._packets.append(packet)
+        self.granule_position += packet_samples(packet)
+        if len(self._packets) >= self.packets_per_page:
+            self._flush_page()
+
+    def flush(self):
+        """ Writes out the packets gathered so far and flushes the file """
+        if self._packets:
+            self._flush_page()
+        self._file.flush()
+
+    def close(self):
+        """ Ends the stream, marking its last page, and closes the file """
+        if self._file.closed:
+            return
+        self._flush_page(HEADER_EOS)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,200 @@
+"""
+Minimal ctypes binding to the system libopus, plus TOC parsing that needs no library at all.
+Only what trumble uses is bound. libopus calls release the GIL, like any ctypes call.
+"""
+
+import ctypes
+import ctypes.util
+
+import attr
+
+
+SAMPLE_RATE = 48000
+MAX_FRAME_SAMPLES = 5760 # 120 ms at 48 kHz, the longest an Opus packet can be
+MAX_PACKET_SIZE = 4000 # recommended by the libopus docs
+
+APPLICATION_VOIP = 2048
+APPLICATION_AUDIO = 2049
+APPLICATION_RESTRICTED_LOWDELAY = 2051
+
+_SET_BITRATE_REQUEST = 4002
+_SET_INBAND_FEC_REQUEST = 4012
+_SET_PACKET_LOSS_PERC_REQUEST = 4014
+_RESET_STATE = 4028
+
+class OpusError(Exception):
+    pass
+
+class MalformedPacket(ValueError):
+    """ A packet whose framing breaks the rules of RFC 6716 section 3 """
+
+_libopus = None
+
+def _lib():
+    """ Loads libopus on first use, so that importing trumble doesn't require it """
+    global _libopus
+    if _libopus is None:
+        path = ctypes.util.find_library('opus')
+        if path is None:
+            raise OpusError('libopus was not found, install it to encode or decode audio')
+        lib = ctypes.CDLL(path)
+        lib.opus_strerror.restype = ctypes.c_char_p
+        lib.opus_strerror.argtypes = [ctypes.c_int]
+        lib.opus_decoder_create.restype = ctypes.c_void_p
+        lib.opus_decoder_create.argtypes = [ctypes.c_int32, ctypes.c_int, ctypes.POINTER(ctypes.c_int)]
+        lib.opus_decoder_destroy.argtypes = [ctypes.c_void_p]
+        lib.opus_decode.argtypes = [
+            ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int32, ctypes.c_void_p, ctypes.c_int, ctypes.c_int,
+        ]
+        lib.opus_decode_float.argtypes = lib.opus_decode.argtypes
+        lib.opus_encoder_create.restype = ctypes.c_void_p
+        lib.opus_encoder_create.argtypes = [ctypes.c_int32, ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int)]
+        lib.opus_encoder_destroy.argtypes = [ctypes.c_void_p]
+        lib.opus_encode.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_int32]
+        lib.opus_encode_float.argtypes = lib.opus_encode.argtypes
+        _libopus = lib
+    return _libopus
+
+def _check(result):
+    if result < 0:
+        raise OpusError(_lib().opus_strerror(result).decode())
+    return result
+
+def _pointer(array):
+    """ Address of a writable buffer: a NumPy array or anything ctypes can wrap """
+    if hasattr(array, 'ctypes'):
+        return array.ctypes.data
+    return ctypes.addressof(ctypes.c_char.from_buffer(array))
+
+class Decoder:
+    """ One stream's decoder state. Decodes into caller-provided int16 or float32 buffers. """
+
+    def __init__(self, rate=SAMPLE_RATE, channels=1):
+        self.rate = rate
+        self.channels = channels
+        error = ctypes.c_int()
+        self._state = _lib().opus_decoder_create(rate, channels, ctypes.byref(error))
+        _check(error.value)
+
+    def __del__(self):
+        if getattr(self, '_state', None):
+            _lib().opus_decoder_destroy(self._state)
+            self._state = None
+
+    def decode(self, packet, out, frame_size=None, fec=False):
+        """
+        Decodes `packet` into the NumPy array `out` (int16 or float32, C-contiguous), returning
+        the number of samples per channel written. With `packet=None`, conceals a lost packet
+        of `frame_size` samples instead; with `fec=True`, `packet` must be the one after the
+        lost one and its forward error correction data is decoded.
+        """
+        if frame_size is None:
+            frame_size = len(out) // self.channels
+        if out.dtype.kind == 'f':
+            decode = _lib().opus_decode_float
+        else:
+            decode = _lib().opus_decode
+        if packet is None:
+            return _check(decode(self._state, None, 0, _pointer(out), frame_size, 0))
+        packet = bytes(packet)
+        return _check(decode(self._state, packet, len(packet), _pointer(out), frame_size, int(fec)))
+
+class Encoder:
+    """ One stream's encoder state. Encodes fixed-size int16 or float32 PCM frames. """
+
+    def __init__(self, rate=SAMPLE_RATE, channels=1, application=APPLICATION_AUDIO, bitrate=None, fec=False):
+        self.rate = rate
+        self.channels = channels
+        error = ctypes.c_int()
+        self._state = _lib().opus_encoder_create(rate, channels, application, ctypes.byref(error))
+        _check(error.value)
+        self._packet = ctypes.create_string_buffer(MAX_PACKET_SIZE)
+        if bitrate is not None:
+            self._ctl(_SET_BITRATE_REQUEST, bitrate)
+        if fec:
+            self._ctl(_SET_INBAND_FEC_REQUEST, 1)
+            self._ctl(_SET_PACKET_LOSS_PERC_REQUEST, 10)
+
+    def __del__(self):
+        if getattr(self, '_state', None):
+            _lib().opus_encoder_destroy(self._state)
+            self._state = None
+
+    def _ctl(self, request, *args):
+        _check(_lib().opus_encoder_ctl(ctypes.c_void_p(self._state), ctypes.c_int(request), *map(ctypes.c_int32, args)))
+
+    def reset(self):
+        """ Forget all history, e.g. at the start of a new transmission """
+        _check(_lib().opus_encoder_ctl(ctypes.c_void_p(self._state), ctypes.c_int(_RESET_STATE)))
+
+    def encode(self, pcm):
+        """ Encodes one frame of PCM (a NumPy array, or int16 bytes) into an Opus packet """
+        if isinstance(pcm, (bytes, bytearray, memoryview)):
+            frame_size = len(pcm) // (2 * self.channels)
+            encode, pcm = _lib().opus_encode, bytes(pcm)
+        else:
+            frame_size = len(pcm) // self.channels
+            encode = _lib().opus_encode_float if pcm.dtype.kind == 'f' else _lib().opus_encode
+            pcm = _pointer(pcm)
+        length = _check(encode(self._state, pcm, frame_size, self._packet, MAX_PACKET_SIZE))
+        return self._packet.raw[:length]
+
+@attr.s(frozen=True)
+class TOC:
+    """ What the first byte of an Opus packet says about it (RFC 6716 section 3.1) """
+
+    mode = attr.ib() # 'silk', 'hybrid' or 'celt'
+    bandwidth = attr.ib() # 'nb', 'mb', 'wb', 'swb' or 'fb'
+    frame_samples = attr.ib() # at 48 kHz
+    channels = attr.ib()
+    code = attr.ib() # how frames are packed: 0 one, 1 two equal, 2 two unequal, 3 arbitrary
+
+def _build_toc_table():
+    table = []
+    for toc in range(256):
+        config, stereo, code = toc >> 3, (toc >> 2) & 1, toc & 0b11
+        if config < 12:
+            mode, bandwidth = 'silk', ('nb', 'mb', 'wb')[config // 4]
+            frame_samples = (480, 960, 1920, 2880)[config % 4]
+        elif config < 16:
+            mode, bandwidth = 'hybrid', ('swb', 'fb')[(config - 12) // 2]
+            frame_samples = (480, 960)[config % 2]
+        else:
+            mode, bandwidth = 'celt', ('nb', 'wb', 'swb', 'fb')[(config - 16) // 4]
+            frame_samples = (120, 240, 480, 960)[config % 4]
+        table.append(TOC(mode, bandwidth, frame_samples, stereo + 1, code))
+    return tuple(table)
+
+_TOC_TABLE = _build_toc_table()
+
+def parse_toc(packet):
+    """ Returns the `TOC` of an Opus packet without decoding anything """
+    return _TOC_TABLE[packet[0]]
+
+def packet_frames(packet):
+    """ Number of Opus frames in a packet, raising `MalformedPacket` if it can't have that many """
+    if not packet:
+        raise MalformedPacket('Opus packet is empty')
+    code = packet[0] & 0b11
+    if code == 0:
+        return 1
+    elif code in (1, 2):
+        return 2
+    if len(packet) < 2:
+        raise MalformedPacket('Code 3 Opus packet has no frame count')
+    # "the second byte signals the number of frames in the packet"
+    frames = packet[1] & 0b00111111
+    # "the total duration contained within a packet MUST NOT exceed 120 ms"
+    if not frames or frames * _TOC_TABLE[packet[0]].frame_samples > MAX_FRAME_SAMPLES:
+        raise MalformedPacket('Code 3 Opus packet has {} frames'.format(frames))
+    return frames
+
+def packet_samples(packet):
+    """ Number of samples (per channel, at 48 kHz) a packet decodes to """
+    if not packet:
+        return 0
+    return _TOC_TABLE[packet[0]].frame_samples * packet_frames(packet)
+
+def packet_duration(packet):
+    """ Duration of a packet in seconds """
+    return packet_samples(packet) / SAMPLE_RATE
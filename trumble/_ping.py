@@ -0,0 +1,88 @@
+import trio
+
+from . import messages
+
+
+class RunningStats:
+    """ Streaming mean and variance (Welford's algorithm) of round trip times, in milliseconds """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.last = None
+        self._m2 = 0.
+
+    def __repr__(self):
+        return '<RunningStats count={} mean={:.1f}ms stddev={:.1f}ms>'.format(self.count, self.mean, self.variance ** .5)
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.last = value
+
+    @property
+    def variance(self):
+        return self._m2 / self.count if self.count else 0.
+
+class PingStats:
+    """
+    Round trip times of the control channel (and of UDP, if it's in use), measured by the
+    pings `TrumbleCore` sends. They go back to the server in every ping, the way the
+    official client reports them, and the server's echo tells us how our UDP packets fared
+    on its end (`remote_*`). `TrumbleCore` keeps one as `ping_stats`.
+    """
+
+    # echoes of pings older than this many are ignored
+    MAX_OUTSTANDING = 16
+
+    def __init__(self, udp=None):
+        self.udp = udp
+        self._reset()
+
+    def _reset(self):
+        self.tcp = RunningStats()
+        self.last_reply = None
+        self.remote_good = self.remote_late = self.remote_lost = self.remote_resync = 0
+        self._outstanding = []
+
+    @property
+    def udp_rtt(self):
+        return self.udp.rtt if self.udp is not None else None
+
+    @property
+    def outstanding(self):
+        """ Pings sent that haven't been answered yet """
+        return len(self._outstanding)
+
+    def ping(self):
+        """ Builds the next ping, timestamped and carrying our stats so far """
+        ping = messages.Ping()
+        ping.timestamp = int(trio.current_time() * 1000000)
+        ping.tcp_packets = self.tcp.count
+        ping.tcp_ping_avg = self.tcp.mean
+        ping.tcp_ping_var = self.tcp.variance
+        if self.udp is not None and self.udp.crypt is not None:
+            crypt = self.udp.crypt
+            ping.good, ping.late, ping.lost, ping.resync = crypt.good, crypt.late, max(0, crypt.lost), crypt.resync
+            ping.udp_packets = self.udp.rtt.count
+            ping.udp_ping_avg = self.udp.rtt.mean
+            ping.udp_ping_var = self.udp.rtt.variance
+        self._outstanding.append(ping.timestamp)
+        del self._outstanding[:-self.MAX_OUTSTANDING]
+        return ping
+
+    def on_connect(self):
+        self._reset()
+
+    def on_ping(self, message):
+        if message.timestamp not in self._outstanding:
+            return
+        now = trio.current_time()
+        # anything sent before this one isn't coming back any more
+        del self._outstanding[:self._outstanding.index(message.timestamp) + 1]
+        self.tcp.add((now - message.timestamp / 1000000) * 1000)
+        self.last_reply = now
+        self.remote_good, self.remote_late = message.good, message.late
+        self.remote_lost, self.remote_resync = message.lost, message.resync
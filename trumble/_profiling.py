@@ -0,0 +1,243 @@
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+import attr
+import trio
+
+
+logger = logging.getLogger(__name__)
+
+try:
+    _cpu_time = time.thread_time
+except AttributeError:
+    # Python 3.6 only has this spelling of it, and only on some platforms
+    def _cpu_time():
+        return time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+
+@attr.s
+class HandlerStats:
+    """
+    Timings of one `on_*` handler, in seconds. `wall` is from dispatch until everything the
+    handler produced was sent; `held` is the part of that the handler spent running, during
+    which nothing else on the event loop could. CPU time is only measured on a sample of
+    calls, as `sampled_cpu` out of `sampled_held`.
+    """
+
+    calls = attr.ib(default=0)
+    slow = attr.ib(default=0)
+    wall = attr.ib(default=0.)
+    held = attr.ib(default=0.)
+    max_wall = attr.ib(default=0.)
+    sampled_held = attr.ib(default=0.)
+    sampled_cpu = attr.ib(default=0.)
+
+    @property
+    def mean_wall(self):
+        return self.wall / self.calls if self.calls else 0.
+
+    @property
+    def awaiting_fraction(self):
+        """ How much of the wall time was spent awaiting, rather than running """
+        return 1 - self.held / self.wall if self.wall else 0.
+
+    @property
+    def cpu_fraction(self):
+        """ Of the time spent running, how much was on the CPU rather than blocked in a system call """
+        return self.sampled_cpu / self.sampled_held if self.sampled_held else 0.
+
+class _Invocation:
+    """ One handler call in progress """
+
+    def __init__(self, key, message_type, sample):
+        self.key = key
+        self.message_type = message_type
+        self.sample = sample
+        self.start = time.perf_counter()
+        self.held = 0.
+        self.cpu = 0.
+        self.awaitable = None # what the handler is running, for stacks of where it's waiting
+        self.reported = False
+
+class _Step:
+    """ A handler running on the event loop right now, as the watchdog thread sees it """
+
+    def __init__(self, invocation, thread_id):
+        self.invocation = invocation
+        self.thread_id = thread_id
+        self.start = time.perf_counter()
+        self.reported = False
+
+def _await_stack(awaitable):
+    """ The frames of a suspended coroutine and everything it's awaiting, outermost first """
+    frames = []
+    while awaitable is not None:
+        frame = next((
+            getattr(awaitable, name) for name in ('cr_frame', 'ag_frame', 'gi_frame')
+            if getattr(awaitable, name, None) is not None
+        ), None)
+        if frame is not None:
+            frames.append((frame, frame.f_lineno))
+        awaitable = next((
+            getattr(awaitable, name) for name in ('cr_await', 'ag_await', 'gi_yieldfrom')
+            if getattr(awaitable, name, None) is not None
+        ), None)
+    return ''.join(traceback.StackSummary.extract(frames).format())
+
+class SlowHandlerDetector:
+    """
+    Times every handler `TrumbleCore` dispatches to, per `(listener class name, handler name)`
+    in `stats`, and logs a warning with a stack for each call that takes longer than `budget`
+    seconds. A handler that holds up the event loop (blocking sync code) is caught in the act
+    by a watchdog thread, with the stack of what it's doing; one that's slow because it's
+    awaiting is caught by a task on the event loop, with the chain of awaits it's stuck in.
+
+    Every `cpu_sample`th call of each handler also has its CPU time measured, to tell
+    handlers busy computing from those stuck in blocking system calls.
+    `watching` is set while `monitor` has the watchdog thread running.
+    `TrumbleCore` creates one when passed `slow_handlers=True`.
+    """
+
+    def __init__(self, *, budget=0.1, cpu_sample=10, check_interval=None):
+        self.budget = budget
+        self.cpu_sample = cpu_sample
+        self.check_interval = check_interval or max(0.01, budget / 4)
+        self.stats = collections.defaultdict(HandlerStats)
+        self._running = set()
+        self._step = None
+        self.watching = trio.Event()
+
+    def start(self, listener, handler, message_type):
+        key = (listener, handler)
+        stats = self.stats[key]
+        stats.calls += 1
+        invocation = _Invocation(key, message_type, self.cpu_sample and stats.calls % self.cpu_sample == 0)
+        self._running.add(invocation)
+        return invocation
+
+    def _run_step(self, invocation, function, *args):
+        step = self._step = _Step(invocation, threading.get_ident())
+        cpu = _cpu_time() if invocation.sample else None
+        try:
+            return function(*args)
+        finally:
+            invocation.held += time.perf_counter() - step.start
+            if cpu is not None:
+                invocation.cpu += _cpu_time() - cpu
+            self._step = None
+
+    def call(self, invocation, handler, args, kwargs):
+        """ Calls the handler, returning its result wrapped so that running it is timed too """
+        result = self._run_step(invocation, lambda: handler(*args, **kwargs))
+        if hasattr(result, '__anext__'):
+            invocation.awaitable = result
+            return self._async_generator(invocation, result)
+        elif hasattr(result, '__await__'):
+            invocation.awaitable = result
+            return _Timed(self, invocation, result)
+        elif hasattr(result, '__next__'):
+            return self._generator(invocation, result)
+        return result
+
+    async def _async_generator(self, invocation, generator):
+        while True:
+            try:
+                item = await _Timed(self, invocation, generator.__anext__())
+            except StopAsyncIteration:
+                return
+            yield item
+
+    def _generator(self, invocation, generator):
+        while True:
+            try:
+                item = self._run_step(invocation, next, generator)
+            except StopIteration:
+                return
+            yield item
+
+    def finish(self, invocation):
+        self._running.discard(invocation)
+        wall = time.perf_counter() - invocation.start
+        stats = self.stats[invocation.key]
+        stats.wall += wall
+        stats.held += invocation.held
+        stats.max_wall = max(stats.max_wall, wall)
+        if invocation.sample:
+            stats.sampled_held += invocation.held
+            stats.sampled_cpu += invocation.cpu
+        if wall > self.budget:
+            stats.slow += 1
+            if not invocation.reported:
+                logger.warning(
+                    '%s.%s handling %s took %.3fs (%.3fs of it blocking the event loop)',
+                    *invocation.key, invocation.message_type, wall, invocation.held,
+                )
+
+    def _report_awaiting(self, invocation, now):
+        invocation.reported = True
+        logger.warning(
+            '%s.%s handling %s has been running for %.3fs, waiting in:\n%s',
+            *invocation.key, invocation.message_type, now - invocation.start,
+            _await_stack(invocation.awaitable) if invocation.awaitable is not None else '(unknown)',
+        )
+
+    def _report_blocking(self, step, now):
+        step.reported = step.invocation.reported = True
+        frame = sys._current_frames().get(step.thread_id)
+        logger.warning(
+            '%s.%s handling %s has been blocking the event loop for %.3fs, in:\n%s',
+            *step.invocation.key, step.invocation.message_type, now - step.start,
+            ''.join(traceback.format_stack(frame)) if frame is not None else '(unknown)',
+        )
+
+    def _watchdog(self, stopped):
+        while not stopped.wait(self.check_interval):
+            step = self._step
+            now = time.perf_counter()
+            if step is not None and not step.reported and now - step.start > self.budget:
+                self._report_blocking(step, now)
+
+    async def monitor(self):
+        """ Runs the watchdog thread and looks for slow awaiting handlers, `TrumbleCore` runs this while connected """
+        stopped = threading.Event()
+        watchdog = threading.Thread(target=self._watchdog, args=(stopped,), name='trumble-watchdog', daemon=True)
+        watchdog.start()
+        self.watching.set()
+        try:
+            while True:
+                await trio.sleep(self.check_interval)
+                now = time.perf_counter()
+                for invocation in list(self._running):
+                    if not invocation.reported and now - invocation.start > self.budget:
+                        self._report_awaiting(invocation, now)
+        finally:
+            stopped.set()
+            self.watching.clear()
+
+class _Timed:
+    """ Awaits a coroutine (or other awaitable), timing each step it runs on the event loop """
+
+    def __init__(self, detector, invocation, awaitable):
+        self._detector = detector
+        self._invocation = invocation
+        self._awaitable = awaitable
+
+    def __await__(self):
+        iterator = self._awaitable.__await__() if not hasattr(self._awaitable, 'send') else self._awaitable
+        send, throw = iterator.send, iterator.throw
+        value, error = None, None
+        while True:
+            try:
+                if error is None:
+                    yielded = self._detector._run_step(self._invocation, send, value)
+                else:
+                    yielded = self._detector._run_step(self._invocation, throw, error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value, error = (yield yielded), None
+            except BaseException as exc:
+                value, error = None, exc
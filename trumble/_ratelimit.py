@@ -0,0 +1,33 @@
+import trio
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter, the same shape as Murmur's own message limiter:
+    `rate` tokens are added per second, up to a maximum of `burst` saved tokens.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = None
+
+    def _refill(self):
+        now = trio.current_time()
+        if self._updated is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """ Takes tokens if they're available right now, returning whether it did """
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens=1):
+        """ Waits until enough tokens are available, then takes them """
+        while not self.try_acquire(tokens):
+            await trio.sleep((tokens - self._tokens) / self.rate)
@@ -0,0 +1,264 @@
+import datetime
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+import attr
+import trio
+
+from . import messages
+from ._ogg import OggOpusWriter
+from ._opus import SAMPLE_RATE, MalformedPacket, packet_samples, parse_toc
+
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+@attr.s
+class RecorderStats:
+    """ Counters for everything the recorder has seen, across all speakers """
+
+    files = attr.ib(default=0)
+    packets = attr.ib(default=0)
+    filled = attr.ib(default=0) # TOC-only packets written in place of lost (or silent) audio
+    late = attr.ib(default=0) # arrived after later audio was already written, so dropped
+    errors = attr.ib(default=0)
+    malformed = attr.ib(default=0) # packets whose TOC didn't add up, so dropped
+
+class _Recording:
+    """ The receive side's view of one open file """
+
+    def __init__(self, key, session_id, toc_byte):
+        self.key = key
+        self.session_id = session_id
+        self.toc_byte = toc_byte
+        self.next_sequence = None
+        self.ended = False
+        self.arrival = None
+        self.samples = 0 # of the last packet
+
+class Recorder:
+    """
+    Records received Opus voice into one Ogg Opus file per speaker, either per session
+    (`per_transmission=False`, silence between transmissions included) or per transmission.
+    Packets are written as they were received, and lost ones are filled with TOC-only
+    packets so players conceal them and the file keeps time.
+
+    Add it as a listener. All the file work happens in a background thread that takes
+    batches off an unbounded queue, so a busy channel or a slow disk never holds up the
+    receive loop; files are flushed every `flush_interval` seconds. Only users in
+    `channels` are recorded, if it's given. A speaker silent for more than `max_gap` seconds
+    gets a new file when they're next heard, rather than minutes of filler. Call `close` to
+    finish every file and stop the thread; events after that are ignored.
+    """
+
+    # sequence number jumps bigger than this (in 10 ms frames) mean the sender started counting again
+    MAX_SEQUENCE_GAP = 500
+    # the encoder lookahead of libopus at 48 kHz, which players skip at the start of each file
+    PRE_SKIP = 312
+
+    def __init__(self, directory, *, per_transmission=False, channels=None, flush_interval=1., max_gap=300.,
+                 filename='{start:%Y%m%d-%H%M%S}-{session}-{user}-{index}.opus'):
+        self.directory = directory
+        self.per_transmission = per_transmission
+        self.channels = set(channels) if channels is not None else None
+        self.flush_interval = flush_interval
+        self.max_gap = max_gap
+        self.filename = filename
+        self.stats = RecorderStats()
+        self.closed = False
+        self._users = {}
+        self._recordings = {}
+        self._index = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, name='trumble-recorder', daemon=True)
+        self._thread.start()
+
+    @property
+    def pending(self):
+        """ Operations queued for the writer thread """
+        return self._queue.qsize()
+
+    @property
+    def recording(self):
+        """ Sessions with a file open """
+        return set(self._recordings)
+
+    def close(self):
+        """ Finishes every open file and waits for the writer thread to be done """
+        if self.closed:
+            return
+        self.closed = True
+        for session_id in list(self._recordings):
+            self._finish(session_id)
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _wanted(self, session_id):
+        if self.channels is None:
+            return True
+        return self._users.get(session_id, {}).get('channel_id') in self.channels
+
+    def _start(self, session_id, toc_byte):
+        user = self._users.get(session_id, {})
+        name = re.sub(r'[^\w.-]+', '_', user.get('name') or 'unknown')
+        start = datetime.datetime.now()
+        self._index += 1
+        path = os.path.join(self.directory, self.filename.format(
+            start=start, session=session_id, user=name, index=self._index,
+        ))
+        tags = {
+            'title': user.get('name') or 'session {}'.format(session_id),
+            'date': start.isoformat(),
+            'mumble_session': session_id,
+        }
+        if user.get('channel_id') is not None:
+            tags['mumble_channel'] = user['channel_id']
+        recording = self._recordings[session_id] = _Recording(self._index, session_id, toc_byte)
+        self._queue.put(('open', recording.key, path, parse_toc(bytes([toc_byte])).channels, tags))
+        self.stats.files += 1
+        logger.debug('Recording session %d to %s', session_id, path)
+        return recording
+
+    def _finish(self, session_id):
+        recording = self._recordings.pop(session_id, None)
+        if recording is not None:
+            self._queue.put(('close', recording.key))
+
+    def _gap(self, recording, tunnel, now):
+        """ How many samples went missing between the last packet written and this one """
+        if not recording.ended and recording.next_sequence is not None:
+            frames = tunnel.sequence_number - recording.next_sequence
+            if abs(frames) < self.MAX_SEQUENCE_GAP:
+                return frames * SAMPLE_RATE // 100
+        # between transmissions (or after the sender started counting again), go by the clock
+        return max(0, round((now - recording.arrival) * SAMPLE_RATE) - recording.samples)
+
+    def on_udp_tunnel(self, message):
+        if self.closed or message.type != messages.UDPTunnel.Opus or not self._wanted(message.session_id):
+            return
+        frame = bytes(message.voice_frames[0]) if message.voice_frames else b''
+        if frame:
+            try:
+                samples = packet_samples(frame)
+            except MalformedPacket:
+                self.stats.malformed += 1
+                frame = b''
+        recording = self._recordings.get(message.session_id)
+        if recording is None:
+            if not frame:
+                return
+            recording = self._start(message.session_id, frame[0])
+        now = trio.current_time()
+
+        if frame:
+            gap = self._gap(recording, message, now) if recording.arrival is not None else 0
+            if gap < 0:
+                self.stats.late += 1
+                return
+            if gap > self.max_gap * SAMPLE_RATE:
+                self._finish(message.session_id)
+                recording = self._start(message.session_id, frame[0])
+                gap = 0
+            # a TOC byte alone (code 0, no frame data) is how Opus says "nothing here";
+            # the writer thread writes as many as it takes, so the filler never piles up here
+            filler = bytes([recording.toc_byte & 0b11111100])
+            fill = gap // packet_samples(filler)
+            if fill:
+                self._queue.put(('fill', recording.key, filler, fill))
+                self.stats.filled += fill
+            self._queue.put(('write', recording.key, frame))
+            self.stats.packets += 1
+            recording.toc_byte = frame[0]
+            recording.samples = samples
+            recording.next_sequence = message.sequence_number + max(1, recording.samples * 100 // SAMPLE_RATE)
+            recording.arrival = now
+            recording.ended = False
+
+        if message.end_transmission:
+            recording.ended = True
+            if self.per_transmission:
+                self._finish(message.session_id)
+
+    def on_user_state(self, message):
+        if self.closed:
+            return
+        user = self._users.setdefault(message.session, {})
+        if message.HasField('name'):
+            user['name'] = message.name
+        if message.HasField('channel_id'):
+            user['channel_id'] = message.channel_id
+            if not self._wanted(message.session):
+                self._finish(message.session)
+
+    def on_synced(self, snapshot):
+        for message in snapshot.users.values():
+            self.on_user_state(message)
+
+    def on_user_remove(self, message):
+        self._users.pop(message.session, None)
+        self._finish(message.session)
+
+    def on_disconnect(self):
+        self._users.clear()
+        for session_id in list(self._recordings):
+            self._finish(session_id)
+
+    def _write_loop(self):
+        writers = {}
+        last_flush = time.monotonic()
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            # take everything that piled up while we were busy, and write it in one go
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            for item in batch:
+                if item is _STOP:
+                    stop = True
+                    continue
+                operation, key, *args = item
+                try:
+                    if operation == 'open':
+                        path, channels, tags = args
+                        writers[key] = OggOpusWriter(path, channels=channels, pre_skip=self.PRE_SKIP, tags=tags)
+                    elif operation == 'write' and key in writers:
+                        writers[key].write(args[0])
+                    elif operation == 'fill' and key in writers:
+                        filler, count = args
+                        for _ in range(count):
+                            writers[key].write(filler)
+                    elif operation == 'close' and key in writers:
+                        writers.pop(key).close()
+                except Exception:
+                    logger.exception('Recording %d failed', key)
+                    self.stats.errors += 1
+                    writer = writers.pop(key, None)
+                    if writer is not None:
+                        try:
+                            writer.close()
+                        except Exception:
+                            pass
+            if not stop and time.monotonic() - last_flush < self.flush_interval:
+                continue
+            last_flush = time.monotonic()
+            for key, writer in list(writers.items()):
+                try:
+                    writer.flush()
+                except OSError:
+                    logger.exception('Flushing recording %d failed', key)
+                    self.stats.errors += 1
+            if stop:
+                for writer in writers.values():
+                    writer.close()
+                return
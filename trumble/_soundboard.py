@@ -0,0 +1,138 @@
+"""
+Clip libraries: many short Opus clips packed into one file for soundboard bots.
+
+The file starts with a header, followed by every clip's Opus packets back to back, and ends
+with an index of clip names and the offset and length of each of their packets:
+
+    header:  magic (8s) | version (H) | clip count (I) | index offset (Q)
+    index:   per clip: name length (H) | name (UTF-8) | packet count (I)
+             | packet offsets (I * count) | packet lengths (H * count)
+
+All integers are little-endian.
+"""
+
+import collections
+import mmap
+import struct
+
+from . import messages
+from ._ogg import OggOpusReader
+from ._opus import SAMPLE_RATE, packet_samples
+
+
+MAGIC = b'TRMBCLIP'
+VERSION = 1
+
+_HEADER = struct.Struct('<8sHIQ')
+
+class ClipLibraryError(Exception):
+    pass
+
+def build_library(output_path, clips):
+    """ Writes a clip library from `(name, ogg_opus_path)` pairs """
+    index = []
+    with open(output_path, 'wb') as output:
+        output.write(b'\0' * _HEADER.size)
+        for name, path in clips:
+            offsets, lengths = [], []
+            with OggOpusReader(path) as reader:
+                for packet in reader.packets():
+                    if len(packet.data) > 8191:
+                        raise ClipLibraryError('{}: packet too large for a voice frame'.format(path))
+                    offsets.append(output.tell())
+                    lengths.append(len(packet.data))
+                    output.write(packet.data)
+            index.append((name, offsets, lengths))
+        index_offset = output.tell()
+        if index_offset > 0xffffffff:
+            raise ClipLibraryError('Clip libraries are limited to 4 GiB of audio')
+        for name, offsets, lengths in index:
+            encoded_name = name.encode('utf-8')
+            output.write(struct.pack('<H', len(encoded_name)) + encoded_name)
+            output.write(struct.pack('<I{0}I{0}H'.format(len(offsets)), len(offsets), *(offsets + lengths)))
+        output.seek(0)
+        output.write(_HEADER.pack(MAGIC, VERSION, len(index), index_offset))
+
+class ClipLibrary:
+    """
+    A memory-mapped clip library. Playing a clip yields zero-copy memoryviews of its packets
+    straight out of the mapping. Clips played at least `hot_after` times are kept (up to
+    `hot_clips` of them, least recently played evicted first) as `PreparedUDPTunnel`s,
+    whose voice frames are already serialized.
+    """
+
+    def __init__(self, path, *, hot_clips=32, hot_after=2):
+        self.path = path
+        self.hot_clips = hot_clips
+        self.hot_after = hot_after
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        magic, version, count, index_offset = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ClipLibraryError('{} is not a version {} clip library'.format(path, VERSION))
+        self._clips = {}
+        position = index_offset
+        for _ in range(count):
+            name_length, = struct.unpack_from('<H', self._map, position)
+            position += 2
+            name = bytes(self._view[position:position + name_length]).decode('utf-8')
+            position += name_length
+            packet_count, = struct.unpack_from('<I', self._map, position)
+            position += 4
+            offsets = struct.unpack_from('<{}I'.format(packet_count), self._map, position)
+            position += 4 * packet_count
+            lengths = struct.unpack_from('<{}H'.format(packet_count), self._map, position)
+            position += 2 * packet_count
+            self._clips[name] = (offsets, lengths)
+        self._plays = collections.Counter()
+        self._hot = collections.OrderedDict()
+
+    def close(self):
+        """ Unmaps the file; no memoryviews from `packets` may still be in use """
+        self._hot.clear()
+        self._view.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self._clips
+
+    def __len__(self):
+        return len(self._clips)
+
+    @property
+    def names(self):
+        return sorted(self._clips)
+
+    def _views(self, name):
+        offsets, lengths = self._clips[name]
+        view = self._view
+        return [view[offset:offset + length] for offset, length in zip(offsets, lengths)]
+
+    def duration(self, name):
+        """ Length of a clip in seconds """
+        return sum(packet_samples(packet) for packet in self._views(name)) / SAMPLE_RATE
+
+    def packets(self, name):
+        """ Returns the packets of a clip, ready to be passed to `AudioStream` """
+        if name in self._hot:
+            self._hot.move_to_end(name)
+            return self._hot[name]
+        views = self._views(name)
+        self._plays[name] += 1
+        if self._plays[name] < self.hot_after:
+            return views
+        prepared = [
+            messages.UDPTunnel(voice_frames=[view], end_transmission=(idx == len(views) - 1)).prepare()
+            for idx, view in enumerate(views)
+        ]
+        self._hot[name] = prepared
+        if len(self._hot) > self.hot_clips:
+            self._hot.popitem(last=False)
+        return prepared
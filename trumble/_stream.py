@@ -0,0 +1,156 @@
+import inspect
+import logging
+
+import trio
+
+from . import messages
+from ._opus import SAMPLE_RATE, packet_samples
+
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+class _Gap:
+    """ Time that passes without sending anything, e.g. silence cut out by a `SilenceGate` """
+
+    def __init__(self, samples):
+        self.samples = samples
+
+async def iterate(iterable):
+    """ Turns a plain iterable of packets into an async iterator for `AudioStream` """
+    for item in iterable:
+        yield item
+
+class AudioStream:
+    """
+    Sends one voice transmission from an async iterator of Opus packets (bytes-like, or
+    `PreparedUDPTunnel`s), or of PCM frames if an `encoder` is given: a `trumble.opus.Encoder`,
+    or an `EncoderPool` encoder to keep the encoding off the trio thread. With a `gate`
+    (a `SilenceGate`), silent PCM is neither encoded nor sent, and each stretch of speech
+    becomes a transmission of its own.
+
+    Packets are sent on an absolute-deadline clock: packet N goes out when the audio before
+    it has finished playing, measured from when the stream started, so scheduling delays
+    don't add up over time. A reader task keeps up to `read_ahead` packets ready, so a
+    slow source or a GC pause doesn't immediately turn into a gap in the audio.
+    """
+
+    MAX_LAG = 0.2 # if we get further behind than this, restart the clock instead of bursting
+
+    def __init__(self, send, source, *, target=messages.UDPTunnel.NormalTalking, encoder=None, gate=None, read_ahead=5, sequence_number=0):
+        self._send = send
+        self.source = source
+        self.target = target
+        self.encoder = encoder
+        self.gate = gate
+        self.sequence_number = sequence_number
+        self._queue = trio.Queue(read_ahead)
+        self._stopped = False
+        self.packets = 0
+        self.underruns = 0 # times the next packet wasn't ready in time
+        self.resyncs = 0
+        self.max_lag = 0.
+
+    def stop(self):
+        """ Ends the transmission after the packet currently being sent """
+        self._stopped = True
+
+    async def _encode(self, frame):
+        if self.encoder is None:
+            return frame
+        packet = self.encoder.encode(frame)
+        if inspect.isawaitable(packet):
+            # e.g. a PooledEncoder, which encodes in a worker thread
+            packet = await packet
+        return packet
+
+    async def _read(self):
+        try:
+            async for frame in self.source:
+                if self._stopped:
+                    break
+                if self.gate is None:
+                    await self._queue.put(await self._encode(frame))
+                    continue
+                for frame, voiced in self.gate.process(frame):
+                    if voiced:
+                        await self._queue.put(await self._encode(frame))
+                    else:
+                        await self._queue.put(_Gap(0 if frame is None else self.gate.samples(frame)))
+        finally:
+            await self._queue.put(_END)
+
+    def _next(self):
+        """ Gets the next packet if it's already been read, otherwise returns None """
+        try:
+            return self._queue.get_nowait()
+        except trio.WouldBlock:
+            return None
+
+    @staticmethod
+    def _samples(packet):
+        if isinstance(packet, messages.PreparedUDPTunnel):
+            # skip the two byte voice header to get to the Opus TOC
+            packet = memoryview(packet.payload)[2:]
+        return packet_samples(packet)
+
+    async def _send_packet(self, packet, end_transmission):
+        if isinstance(packet, messages.PreparedUDPTunnel):
+            tunnel = messages.PreparedUDPTunnel(packet.payload, self.target, self.sequence_number)
+        else:
+            tunnel = messages.UDPTunnel(
+                target=self.target,
+                sequence_number=self.sequence_number,
+                voice_frames=[packet],
+                end_transmission=end_transmission,
+            )
+        await self._send(tunnel)
+        self.packets += 1
+        # sequence numbers count 10 ms frames
+        self.sequence_number += max(1, self._samples(packet) * 100 // SAMPLE_RATE)
+        if end_transmission and not tunnel.end_transmission:
+            # a prepared packet can't be changed, so the terminator needs a packet of its own
+            await self._send_packet(b'', True)
+
+    async def run(self):
+        """ Streams the whole source, returning once the end of the transmission has been sent """
+        async with trio.open_nursery() as nursery:
+            nursery.spawn(self._read)
+            packet = await self._queue.get()
+            start = trio.current_time()
+            elapsed = 0.
+            while packet is not _END:
+                if isinstance(packet, _Gap):
+                    # silence: let the time pass (and the sequence numbers with it), but send nothing
+                    elapsed += packet.samples / SAMPLE_RATE
+                    self.sequence_number += packet.samples * 100 // SAMPLE_RATE
+                    packet = await self._queue.get()
+                    continue
+                deadline = start + elapsed
+                await trio.sleep_until(deadline)
+                lag = trio.current_time() - deadline
+                self.max_lag = max(self.max_lag, lag)
+                if lag > self.MAX_LAG:
+                    logger.debug('Audio stream fell %.3fs behind, restarting its clock', lag)
+                    self.resyncs += 1
+                    start += lag
+                elapsed += self._samples(packet) / SAMPLE_RATE
+
+                # look ahead one packet so the last one can carry the terminator bit
+                following = self._next()
+                if self._stopped:
+                    following = _END
+                await self._send_packet(packet, following is _END or isinstance(following, _Gap))
+                if following is None:
+                    with trio.move_on_at(start + elapsed):
+                        following = await self._queue.get()
+                    if following is None:
+                        # the source didn't keep up; wait for it, the clock catches up after
+                        self.underruns += 1
+                        following = await self._queue.get()
+                    if following is _END or isinstance(following, _Gap):
+                        await self._send_packet(b'', True)
+                packet = following
+            nursery.cancel_scope.cancel()
+        return self
@@ -0,0 +1,40 @@
+import attr
+
+from . import messages
+
+
+@attr.s
+class SyncSnapshot:
+    """
+    The server's state as of `ServerSync`, for the `synced` event of a `TrumbleCore` created
+    with `fast_sync=True`: every channel and user, with all the updates received for each
+    before `ServerSync` merged into one message, and the `ServerSync` itself.
+    """
+
+    channels = attr.ib(default=attr.Factory(dict)) # channel_id -> ChannelState
+    users = attr.ib(default=attr.Factory(dict)) # session -> UserState
+    server_sync = attr.ib(default=None)
+
+    def apply(self, message):
+        """ Folds a state message into the snapshot, returning whether it was one """
+        kind = type(message)
+        if kind is messages.UserState:
+            user = self.users.get(message.session)
+            if user is None:
+                self.users[message.session] = message
+            else:
+                user.MergeFrom(message)
+        elif kind is messages.ChannelState:
+            channel = self.channels.get(message.channel_id)
+            if channel is None:
+                self.channels[message.channel_id] = message
+            else:
+                # Murmur sends channel links in a second pass, which this appends
+                channel.MergeFrom(message)
+        elif kind is messages.UserRemove:
+            self.users.pop(message.session, None)
+        elif kind is messages.ChannelRemove:
+            self.channels.pop(message.channel_id, None)
+        else:
+            return False
+        return True
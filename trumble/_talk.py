@@ -0,0 +1,111 @@
+import collections
+
+import attr
+import trio
+
+from . import messages
+from ._opus import SAMPLE_RATE, _TOC_TABLE, MalformedPacket, packet_frames
+
+
+@attr.s
+class SpeakerStats:
+    """ Talk time and bitrate of one session, from the TOC bytes of the voice it sent """
+
+    packets = attr.ib(default=0)
+    bytes = attr.ib(default=0) # Opus payload only, no Mumble or transport headers
+    samples = attr.ib(default=0) # at 48 kHz
+    transmissions = attr.ib(default=0)
+    modes = attr.ib(default=attr.Factory(collections.Counter)) # samples per 'silk', 'hybrid' or 'celt'
+    bandwidth = attr.ib(default=None) # of the last packet
+    channels = attr.ib(default=None) # of the last packet
+    talking = attr.ib(default=False)
+    last_packet = attr.ib(default=None) # trio clock
+    transmission_bytes = attr.ib(default=0)
+    transmission_samples = attr.ib(default=0)
+    malformed = attr.ib(default=0) # packets whose TOC didn't add up, which aren't counted otherwise
+
+    @property
+    def seconds(self):
+        """ Time spent talking """
+        return self.samples / SAMPLE_RATE
+
+    @property
+    def bitrate(self):
+        """ Average bits per second of talking """
+        return self.bytes * 8 / self.seconds if self.samples else 0.
+
+    @property
+    def transmission_bitrate(self):
+        """ Average bits per second of the current (or last) transmission """
+        if not self.transmission_samples:
+            return 0.
+        return self.transmission_bytes * 8 * SAMPLE_RATE / self.transmission_samples
+
+class TalkStats:
+    """
+    Counts talk time, bitrate and transmissions per session for all the Opus voice the server
+    sends us, from every channel we can hear. Nothing is decoded: a packet's duration, mode,
+    bandwidth and channel count all come from its first (TOC) byte, so this costs a few
+    additions per packet. Add an instance as a listener; `totals` keeps the counts of
+    sessions that have left. A transmission whose terminator got lost is taken to be over
+    after `transmission_timeout` seconds of nothing.
+    """
+
+    def __init__(self, *, transmission_timeout=1.):
+        self.transmission_timeout = transmission_timeout
+        self.sessions = {}
+        self.totals = SpeakerStats()
+
+    def __getitem__(self, session_id):
+        return self.sessions[session_id]
+
+    @property
+    def talking(self):
+        """ Sessions in the middle of a transmission """
+        return {session_id for session_id, stats in self.sessions.items() if stats.talking}
+
+    def on_udp_tunnel(self, message):
+        if message.type != messages.UDPTunnel.Opus:
+            return
+        stats = self.sessions.get(message.session_id)
+        if stats is None:
+            stats = self.sessions[message.session_id] = SpeakerStats()
+        now = trio.current_time()
+        frame = message.voice_frames[0] if message.voice_frames else b''
+        if frame:
+            toc = _TOC_TABLE[frame[0]]
+            try:
+                samples = toc.frame_samples * (1 if toc.code == 0 else packet_frames(frame))
+            except MalformedPacket:
+                stats.malformed += 1
+                frame = b''
+        if frame:
+            if not stats.talking or now - stats.last_packet > self.transmission_timeout:
+                stats.transmissions += 1
+                stats.transmission_bytes = stats.transmission_samples = 0
+                stats.talking = True
+            stats.packets += 1
+            stats.bytes += len(frame)
+            stats.samples += samples
+            stats.transmission_bytes += len(frame)
+            stats.transmission_samples += samples
+            stats.modes[toc.mode] += samples
+            stats.bandwidth = toc.bandwidth
+            stats.channels = toc.channels
+            stats.last_packet = now
+        if message.end_transmission:
+            stats.talking = False
+
+    def on_user_remove(self, message):
+        stats = self.sessions.pop(message.session, None)
+        if stats is None:
+            return
+        self.totals.packets += stats.packets
+        self.totals.bytes += stats.bytes
+        self.totals.samples += stats.samples
+        self.totals.transmissions += stats.transmissions
+        self.totals.malformed += stats.malformed
+        self.totals.modes.update(stats.modes)
+
+    def on_disconnect(self):
+        self.sessions.clear()
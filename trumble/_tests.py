@@ -1,7 +1,43 @@
 """
-Unit tests are not implemented yet, so we're just saving this for later.
+Unit tests. Run them with `python -m pytest trumble/_tests.py`.
 """
 
+import os
+import socket
+import time
+
+import pytest
+import trio
+import trio.testing
+
+from . import messages
+from ._broadcast import TextBroadcaster
+from ._capture import INDEX_BLOCK, CaptureReader, CaptureWriter, Replay, _NullStream
+from ._core import TrumbleCore
+from ._encoder import EncoderPool
+from ._fake_server import FakeServer
+from ._flight import RECEIVED, FlightRecorder
+from ._jitter import JitterBuffer
+from ._mixer import Mixer
+from ._moderation import BulkModerator
+from ._bots._music import MusicTrumble, Track
+from ._bots._simple import SimpleTrumble
+from ._ogg import OggOpusReader, OggOpusWriter
+from ._opus import Encoder, MalformedPacket, OpusError, _lib as _libopus, packet_frames, packet_samples
+from ._ping import PingStats
+from ._profiling import SlowHandlerDetector
+from ._recorder import Recorder
+from ._soundboard import ClipLibrary, build_library
+from ._stream import AudioStream, iterate
+from ._sync import SyncSnapshot
+from ._trace import SENT, Tracer, Trace, read_trace
+from ._udp import CryptState
+from ._vad import SilenceGate
+from ._talk import TalkStats
+from . import _varint as varint
+from ._voice_target import VoiceTargets, VoiceTargetsFull
+
+
 def test_varint():
     test_cases = [
         ([0b01000000], 2 ** 6),
@@ -25,3 +61,766 @@ def test_varint():
             result, garbage = varint.decode(encoded_bytes)
             assert result == expected_value
             assert not garbage
+
+def test_voice_targets_share_and_evict_least_recently_used():
+    targets = VoiceTargets(1, 2)
+    slot_a, message = targets.register(sessions=[1])
+    assert message.id == slot_a
+    assert targets.register(sessions=[1]) == (slot_a, None)
+    slot_b, _ = targets.register(sessions=[2])
+    targets.register(sessions=[1])
+    slot_c, message = targets.register(sessions=[3])
+    assert slot_c == slot_b and message.targets[0].session == [3]
+    assert targets.slot_for(sessions=[2]) is None
+
+def test_voice_targets_never_evict_slots_in_use():
+    targets = VoiceTargets(1, 2)
+    with targets.pinned(sessions=[1]) as (slot_a, prepare):
+        assert [m.id for m in prepare] == [slot_a]
+        list(targets.whisper(messages.UDPTunnel(), sessions=[2]))
+        with pytest.raises(VoiceTargetsFull):
+            targets.register(sessions=[3])
+        # the end of the whisper's transmission frees its slot up again
+        list(targets.whisper(messages.UDPTunnel(end_transmission=True), sessions=[2]))
+        slot_c, _ = targets.register(sessions=[3])
+        assert slot_c != slot_a
+    assert targets.register(sessions=[4])[0] == slot_a
+
+def test_broadcast_merges_identical_messages():
+    async def main():
+        sent = []
+        async def send(message):
+            sent.append(message)
+        broadcaster = TextBroadcaster(send)
+        broadcaster.broadcast('hi', sessions=[1])
+        broadcaster.broadcast('hi', sessions=[2], channels=[3])
+        async with trio.open_nursery() as nursery:
+            nursery.spawn(broadcaster.run)
+            await trio.sleep(1)
+            nursery.cancel_scope.cancel()
+        return sent
+    (message,) = trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0))
+    assert message.message == 'hi' and list(message.session) == [1, 2] and list(message.channel_id) == [3]
+
+def test_broadcast_splits_between_tags_and_entities():
+    chunks = TextBroadcaster._split('a <b>bold</b> &amp; ' + '\U0001F600' * 3, 6)
+    assert chunks == ['a', '<b>bol', 'd</b>', '&amp;', '\U0001F600' * 3]
+    # Murmur counts UTF-16 code units, two for each of these
+    assert TextBroadcaster._split('\U0001F600' * 4, 6) == ['\U0001F600' * 3, '\U0001F600']
+
+def _moderate(replies, operation):
+    """ Runs `operation(moderator)`, answering each message sent with `replies(message)` """
+    async def main():
+        sent = []
+        async def send(message):
+            sent.append(message)
+            for reply in replies(message):
+                handler = getattr(moderator, 'on_' + messages.get_name_by_class(type(reply)))
+                handler(reply)
+        moderator = BulkModerator(send, timeout=.5)
+        moderator.on_server_sync(messages.ServerSync(session=100))
+        for session in (1, 2, 3):
+            moderator.on_user_state(messages.UserState(session=session, channel_id=0))
+        return sent, await operation(moderator)
+    return trio.run(main)
+
+def test_moderation_correlates_denials_by_session_and_permission():
+    def replies(message):
+        if message.session == 2:
+            # Murmur names the user who can't enter the channel, and says nothing for the others yet
+            yield messages.PermissionDenied(type=messages.PermissionDenied.Permission, permission=0x4, session=2)
+        if message.session == 3:
+            yield messages.UserState(session=3, actor=100, channel_id=5)
+    sent, result = _moderate(replies, lambda moderator: moderator.move([1, 2, 3], 5))
+    by_session = {op.session: op for op in result.operations}
+    assert by_session[2].error.startswith('permission denied')
+    assert by_session[3].succeeded
+    # confirming a later move doesn't count an earlier unconfirmed one as done
+    assert by_session[1].error == 'timed out'
+
+def test_moderation_ignores_denials_for_other_operations():
+    def replies(message):
+        yield messages.PermissionDenied(type=messages.PermissionDenied.Permission, permission=0x10000, session=100)
+        yield messages.UserState(session=message.session, actor=100, mute=True)
+    sent, result = _moderate(replies, lambda moderator: moderator.mute([1]))
+    assert result.operations[0].succeeded
+
+def test_moderation_ignores_denials_of_other_requests():
+    def replies(message):
+        # e.g. a TextBroadcaster's message that was too long, which names no permission
+        yield messages.PermissionDenied(type=messages.PermissionDenied.TextTooLong)
+        yield messages.UserState(session=message.session, actor=100, channel_id=5)
+    sent, result = _moderate(replies, lambda moderator: moderator.move([1], 5))
+    assert result.operations[0].succeeded
+
+def test_moderation_fails_moves_into_full_channels():
+    def replies(message):
+        yield messages.PermissionDenied(type=messages.PermissionDenied.ChannelFull)
+    sent, result = _moderate(replies, lambda moderator: moderator.move([1], 5))
+    assert result.operations[0].error == 'permission denied: ChannelFull'
+
+def test_moderation_only_counts_our_own_kicks():
+    def replies(message):
+        # someone else got to them first
+        yield messages.UserRemove(session=message.session, actor=200 if message.session == 1 else 100)
+    sent, result = _moderate(replies, lambda moderator: moderator.kick([1, 2]))
+    by_session = {op.session: op for op in result.operations}
+    assert by_session[1].error == 'user left'
+    assert by_session[2].succeeded
+
+def test_moderation_skips_changes_that_change_nothing():
+    sent, result = _moderate(lambda message: (), lambda moderator: moderator.move([1, 2], 0))
+    assert not sent
+    assert len(result.succeeded) == 2
+
+def test_jitter_buffer_reorders_and_conceals_losses():
+    buffer = JitterBuffer()
+    for arrival, sequence in enumerate((2, 0, 6)):
+        tunnel = _voice(1, b'\x78')
+        tunnel.sequence_number = sequence
+        tunnel.end_transmission = sequence == 6
+        buffer.push(tunnel, arrival * .02)
+    played = []
+    while True:
+        packet = buffer.pop()
+        if packet is None:
+            break
+        played.append((packet[0], packet[1] is not None))
+    assert played == [(0, True), (2, True), (4, False), (6, True)]
+    assert buffer.stats.played == 3 and buffer.stats.lost == 1 and buffer.idle
+
+def _speak(mixer, session_id, samples):
+    # what `Mixer.add` leaves behind after decoding, minus the decoder
+    if session_id not in mixer._rows:
+        mixer._rows[session_id] = mixer._free.pop()
+    row = mixer._rows[session_id]
+    mixer._pcm[row, mixer._fill[row]:mixer._fill[row] + len(samples)] = samples
+    mixer._fill[row] += len(samples)
+    mixer._idle[row] = 0
+
+def test_mixer_sums_gains_and_saturates():
+    pytest.importorskip('numpy')
+    mixer = Mixer(block=.001, idle_blocks=2) # 48 samples
+    mixer.set_gain(2, .5)
+    _speak(mixer, 1, [.5] * 48)
+    _speak(mixer, 2, [.5] * 48)
+    _speak(mixer, 3, [-1.] * 24) # runs out halfway, the rest is silence
+    assert mixer.mix().tolist() == [-8191] * 24 + [24575] * 24
+    _speak(mixer, 1, [1.] * 24 + [-1.] * 24)
+    _speak(mixer, 2, [1.] * 24 + [-1.] * 24)
+    assert mixer.mix().tolist() == [32767] * 24 + [-32767] * 24
+
+def test_mixer_releases_idle_speakers():
+    pytest.importorskip('numpy')
+    mixer = Mixer(block=.001, max_speakers=1, idle_blocks=2)
+    _speak(mixer, 1, [.5] * 72) # a block and a half
+    assert mixer.mix().tolist() == [16383] * 48
+    assert mixer.mix().tolist() == [16383] * 24 + [0] * 24
+    assert mixer.mix().tolist() == [0] * 48
+    assert mixer.speakers == [1]
+    mixer.mix()
+    assert mixer.speakers == []
+    _speak(mixer, 2, [.25] * 48) # the only row is free again
+    assert mixer.mix().tolist() == [8191] * 48
+
+def test_mixer_recovers_and_conceals_lost_packets():
+    numpy = pytest.importorskip('numpy')
+    _require_libopus()
+    encoder = Encoder()
+    buffer = JitterBuffer()
+    for arrival, sequence in enumerate((0, 4, 6)):
+        tunnel = _voice(1, encoder.encode(numpy.full(960, 8000, numpy.int16)))
+        tunnel.sequence_number = sequence
+        buffer.push(tunnel, arrival * .02)
+    mixer = Mixer()
+    mixer.add(1, 0, buffer.peek(0), buffer)
+    mixer.add(1, 2, None, buffer) # recovered from the FEC data in packet 4
+    mixer.add(1, 8, None, None) # nothing to recover from, so concealed
+    row = mixer._rows[1]
+    assert mixer._fill[row] == 3 * 960
+    mixer.mix()
+    assert mixer._fill[row] == 2 * 960
+
+def test_moderation_knows_the_state_from_a_fast_sync():
+    snapshot = SyncSnapshot(users={1: messages.UserState(session=1, channel_id=5, mute=True)})
+    async def main():
+        sent = []
+        async def send(message):
+            sent.append(message)
+        moderator = BulkModerator(send, timeout=.5)
+        moderator.on_synced(snapshot)
+        return sent, await moderator.mute([1])
+    # no UserState is coming back for a mute that's already in effect, so it isn't sent at all
+    sent, result = trio.run(main)
+    assert not sent and result.operations[0].succeeded
+
+def test_packet_frames():
+    assert packet_frames(b'\x78' + bytes(10)) == 1 # code 0
+    assert packet_frames(b'\x79' + bytes(10)) == 2 # code 1
+    assert packet_frames(b'\x7b\x03' + bytes(10)) == 3 # code 3, 3 frames of 20 ms
+    assert packet_samples(b'\x7b\x83' + bytes(10)) == 3 * 960 # VBR and padding bits don't count
+    assert packet_samples(b'') == 0
+
+@pytest.mark.parametrize('packet', [
+    b'',
+    b'\x03', # code 3 with no frame count
+    b'\x03\x00', # zero frames
+    b'\x7b\x07', # 7 frames of 20 ms is more than 120 ms
+    b'\xfb\x3f', # 63 frames of 20 ms
+])
+def test_packet_frames_rejects_malformed_packets(packet):
+    with pytest.raises(MalformedPacket):
+        packet_frames(packet)
+
+def _require_libopus():
+    try:
+        _libopus()
+    except OpusError:
+        pytest.skip('libopus is not installed')
+
+def test_encoder_pool_never_reuses_names():
+    _require_libopus()
+    pool = EncoderPool(1)
+    first, second = pool.encoder(), pool.encoder()
+    pool.release(first)
+    third = pool.encoder()
+    assert third.name not in (first.name, second.name)
+    pool.release(third)
+    assert list(pool.stats) == [second.name]
+
+def test_silence_gate_preroll_keeps_bytes_like_frames_whole():
+    pytest.importorskip('numpy')
+    gate = SilenceGate(preroll=2)
+    frame = bytearray(1920) # 20 ms of int16 silence, in a buffer the source reuses
+    assert gate.process(frame) == []
+    frame[:] = b'\x00\x40' * 960 # -6 dBFS
+    released = gate.process(frame)
+    assert [(bytes(held), voiced) for held, voiced in released] == [(bytes(1920), True), (b'\x00\x40' * 960, True)]
+    assert [gate.samples(held) for held, _ in released] == [960, 960]
+    _require_libopus()
+    encoder = Encoder()
+    for held, _ in released:
+        assert packet_samples(encoder.encode(held)) == 960
+
+def _voice(session_id, *frames, end_transmission=False):
+    message = messages.UDPTunnel(session_id=session_id, voice_frames=list(frames))
+    message.type = messages.UDPTunnel.Opus
+    message.end_transmission = end_transmission
+    return message
+
+def test_talk_stats_counts_malformed_packets():
+    async def main():
+        stats = TalkStats()
+        stats.on_udp_tunnel(_voice(1, b'\x03'))
+        stats.on_udp_tunnel(_voice(1, b'\x78' + bytes(59)))
+        stats.on_udp_tunnel(_voice(1, b'\x7b\x00', end_transmission=True))
+        return stats[1]
+    speaker = trio.run(main)
+    assert speaker.malformed == 2
+    assert speaker.packets == 1 and speaker.samples == 960 and speaker.transmissions == 1
+    assert not speaker.talking
+
+def _record(tmpdir, script, **kwargs):
+    """ Feeds `(seconds to wait, UDPTunnel)` pairs to a `Recorder`, returning it and the packets of each file """
+    recorder = Recorder(str(tmpdir), **kwargs)
+    async def main():
+        for delay, message in script:
+            await trio.sleep(delay)
+            recorder.on_udp_tunnel(message)
+    trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0))
+    recorder.close()
+    files = []
+    for name in sorted(os.listdir(str(tmpdir))):
+        with OggOpusReader(os.path.join(str(tmpdir), name)) as reader:
+            files.append([bytes(packet.data) for packet in reader.packets()])
+    return recorder, files
+
+def test_recorder_skips_malformed_packets(tmpdir):
+    frame = b'\x78' + bytes(59)
+    recorder, files = _record(tmpdir, [(0, _voice(1, b'\x03')), (0, _voice(1, frame)), (.02, _voice(1, b'\x03\x00'))])
+    assert recorder.stats.malformed == 2
+    assert files == [[frame]]
+
+def test_recorder_fills_gaps(tmpdir):
+    frame = b'\x78' + bytes(59)
+    first, second = _voice(1, frame), _voice(1, frame)
+    second.sequence_number = 10 # 100 ms later, so 80 ms (4 frames) went missing
+    recorder, files = _record(tmpdir, [(0, first), (.1, second)])
+    assert recorder.stats.filled == 4
+    assert files == [[frame, b'\x78', b'\x78', b'\x78', b'\x78', frame]]
+
+def test_recorder_starts_a_new_file_after_a_long_gap(tmpdir):
+    frame = b'\x78' + bytes(59)
+    last = _voice(1, frame)
+    last.sequence_number = 2
+    recorder, files = _record(tmpdir, [
+        (0, _voice(1, frame, end_transmission=True)), (2, _voice(1, frame)), (.02, last),
+    ], max_gap=1.)
+    assert recorder.stats.files == 2 and recorder.stats.filled == 0
+    assert files == [[frame], [frame, frame]]
+
+def test_recorder_skips_encoder_lookahead_and_stays_closed(tmpdir):
+    frame = b'\x78' + bytes(59)
+    recorder, files = _record(tmpdir, [(0, _voice(1, frame))])
+    with OggOpusReader(os.path.join(str(tmpdir), os.listdir(str(tmpdir))[0])) as reader:
+        list(reader.packets())
+        assert reader.head.pre_skip == Recorder.PRE_SKIP
+    recorder.on_user_state(messages.UserState(session=2, channel_id=1))
+    recorder.on_udp_tunnel(_voice(2, frame))
+    assert not recorder.pending and not recorder.recording and recorder.stats.files == 1
+
+def test_recorder_knows_the_channels_from_a_fast_sync(tmpdir):
+    frame = b'\x78' + bytes(59)
+    snapshot = SyncSnapshot(users={
+        session: messages.UserState(session=session, name='User {}'.format(session), channel_id=session)
+        for session in (1, 2)
+    })
+    recorder = Recorder(str(tmpdir), channels=[2])
+    recorder.on_synced(snapshot)
+    async def main():
+        recorder.on_udp_tunnel(_voice(1, frame))
+        recorder.on_udp_tunnel(_voice(2, frame))
+    trio.run(main)
+    assert recorder.recording == {2}
+    recorder.close()
+
+def test_audio_stream_sends_on_a_steady_clock():
+    async def main():
+        sent = []
+        async def send(message):
+            sent.append((trio.current_time(), message))
+        packets = [b'\x78' + bytes(10)] * 5 # 20 ms each
+        await AudioStream(send, iterate(packets)).run()
+        return sent
+    sent = trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0))
+    voice = [(time, message) for time, message in sent if message.voice_frames[0]]
+    assert [round(time - sent[0][0], 3) for time, _ in voice] == [0., .02, .04, .06, .08]
+    assert [message.sequence_number for _, message in voice] == [0, 2, 4, 6, 8]
+    assert sent[-1][1].end_transmission
+
+def test_voice_waits_for_its_voice_target_over_tcp():
+    async def main():
+        core = TrumbleCore('127.0.0.1', 0, udp=True, flight_recorder=False)
+        core.udp.active = True
+        targets = VoiceTargets()
+        for message in targets.whisper(messages.UDPTunnel(voice_frames=[b'\x78']), sessions=[1]):
+            await core.send(message)
+        # the registration and the audio after it are both still waiting for TCP
+        assert core._send_queue.qsize() == 2 and core.udp._queue.qsize() == 0
+        async with trio.open_nursery() as nursery:
+            nursery.spawn(core._send_loop, nursery, _NullStream())
+            while core._send_queue.qsize():
+                await trio.sleep(0)
+            await trio.sleep(0)
+            nursery.cancel_scope.cancel()
+        for message in targets.whisper(messages.UDPTunnel(voice_frames=[b'\x78']), sessions=[1]):
+            await core.send(message)
+        assert core.udp._queue.qsize() == 1
+    trio.run(main)
+
+def _ogg_file(tmpdir, packets, pre_skip=0):
+    path = str(tmpdir.join('track.opus'))
+    with OggOpusWriter(path, pre_skip=pre_skip) as writer:
+        for packet in packets:
+            writer.write(packet)
+    return path
+
+def test_ogg_round_trip(tmpdir):
+    # 10 ms packets, some of them longer than a lacing value, spread over several pages
+    packets = [bytes([0, number]) * (number * 100 + 1) for number in range(5)]
+    path = str(tmpdir.join('track.opus'))
+    with OggOpusWriter(path, pre_skip=312, packets_per_page=2) as writer:
+        for packet in packets:
+            writer.write(packet)
+    with OggOpusReader(path) as reader:
+        read = list(reader.packets())
+        assert reader.head.pre_skip == 312
+        assert [bytes(packet.data) for packet in read] == packets
+        assert [packet.granule_position for packet in read] == [480 * n for n in range(1, 6)]
+        assert len({packet.page_offset for packet in read}) == 3
+
+def test_track_drops_pre_skip(tmpdir):
+    # 10 ms packets, with 600 samples of pre-roll: the first packet is mostly pre-roll, the second mostly not
+    packets = [bytes([0, number]) for number in range(5)]
+    track = Track(_ogg_file(tmpdir, packets, pre_skip=600))
+    track.fill()
+    assert [bytes(packet.data) for packet in track.buffer] == packets[1:]
+    track.close()
+
+def test_track_indexes_pages_ahead_of_seeking(tmpdir):
+    track = Track(_ogg_file(tmpdir, [bytes([0, number % 256]) for number in range(500)]), buffer_packets=10)
+    track.fill()
+    # the prefetch has already done the scan, so the seek is a lookup
+    assert track._page_index is not None
+    track.seek(3.)
+    assert track.buffer[0].granule_position == 301 * 480
+    track.close()
+
+def test_track_stays_closed(tmpdir):
+    track = Track(_ogg_file(tmpdir, [bytes([0, number]) for number in range(5)]), buffer_packets=2)
+    track.fill()
+    track.close()
+    # a prefetch that was already on its way doesn't reopen the file
+    track.fill()
+    track.seek(0)
+    assert track._reader is None and len(track.buffer) == 2
+
+def test_music_stop_closes_the_playing_track_too(tmpdir):
+    bot = MusicTrumble('127.0.0.1', 64738, verify=False)
+    bot.current, queued = (Track(_ogg_file(tmpdir.mkdir(name), [bytes([0, 1])])) for name in 'ab')
+    bot.queue.append(queued)
+    for track in (bot.current, queued):
+        track.fill()
+    bot.stop()
+    assert bot.current.closed and queued.closed and not bot.queue
+
+def test_clip_library(tmpdir):
+    clips = {
+        'rimshot': [bytes([0, number]) for number in range(3)],
+        'airhorn': [bytes([0x78]) + bytes(number) for number in range(1, 51)],
+    }
+    path = str(tmpdir.join('clips'))
+    build_library(path, [(name, _ogg_file(tmpdir.mkdir(name), packets)) for name, packets in clips.items()])
+    with ClipLibrary(path, hot_after=2) as library:
+        assert library.names == ['airhorn', 'rimshot']
+        assert library.duration('airhorn') == 1.
+        assert [bytes(view) for view in library.packets('rimshot')] == clips['rimshot']
+        # played again, it's worth keeping ready to send
+        prepared = library.packets('rimshot')
+        assert all(isinstance(packet, messages.PreparedUDPTunnel) for packet in prepared)
+        assert library.packets('rimshot') is prepared
+
+def test_ping_stats_measure_and_report_round_trips():
+    async def main():
+        stats = PingStats()
+        for rtt in (.01, .03):
+            ping = stats.ping()
+            await trio.sleep(rtt)
+            stats.on_ping(messages.Ping(timestamp=ping.timestamp, good=5))
+        # an echo of a ping that was already answered doesn't count twice
+        stats.on_ping(messages.Ping(timestamp=ping.timestamp))
+        return stats, stats.ping()
+    stats, ping = trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0))
+    assert stats.tcp.count == 2 and stats.remote_good == 5 and stats.outstanding == 1
+    assert ping.tcp_packets == 2
+    # in milliseconds, as the official client reports them
+    assert ping.tcp_ping_avg == pytest.approx(20., abs=.01) and ping.tcp_ping_var == pytest.approx(100., abs=.1)
+
+def test_metrics_count_messages_and_time_handlers():
+    class Listener:
+        def on_text_message(self, message):
+            return messages.TextMessage(message='pong')
+    async def main():
+        core = TrumbleCore('127.0.0.1', 0, metrics=True, flight_recorder=False)
+        core.add_listener(Listener())
+        core.metrics.message_received(messages.get_id_by_class(messages.TextMessage), 12)
+        await core._dispatch_event('text_message', messages.TextMessage(message='ping'))
+        return core.metrics.render()
+    text = trio.run(main)
+    assert 'trumble_messages_received_total{type="TextMessage",transport="tcp"} 1\n' in text
+    assert 'trumble_handler_seconds_count{listener="Listener",handler="on_text_message"} 1\n' in text
+    # the reply is still waiting to be sent
+    assert 'trumble_send_queue_depth 1\n' in text
+
+def test_slow_handlers_are_caught_blocking_the_event_loop(caplog):
+    class Listener:
+        def on_text_message(self, message):
+            time.sleep(.1)
+    async def main():
+        detector = SlowHandlerDetector(budget=.02)
+        core = TrumbleCore('127.0.0.1', 0, slow_handlers=detector, flight_recorder=False)
+        core.add_listener(Listener())
+        async with trio.open_nursery() as nursery:
+            nursery.spawn(detector.monitor)
+            await detector.watching.wait()
+            await core._dispatch_event('text_message', messages.TextMessage(message='ping'))
+            nursery.cancel_scope.cancel()
+        return detector.stats['Listener', 'on_text_message']
+    stats = trio.run(main)
+    assert stats.calls == 1 and stats.slow == 1 and stats.held >= .1
+    # the watchdog logged where the handler was stuck while it was still stuck there
+    assert 'time.sleep(.1)' in caplog.text
+
+def test_flight_recorder_dumps_each_time_to_a_new_file(tmpdir):
+    recorder = FlightRecorder(4, directory=str(tmpdir))
+    for length in range(6):
+        recorder.record(RECEIVED, messages.get_id_by_class(messages.Ping), length)
+    first, second = recorder.dump(), recorder.dump()
+    assert first != second and sorted(os.listdir(str(tmpdir))) == sorted(os.path.basename(path) for path in (first, second))
+    with open(first) as f:
+        lines = f.read().splitlines()
+    assert lines[0].startswith('# trumble flight recorder: last 4 of 6 events')
+    assert [int(line.split()[3]) for line in lines[1:]] == [2, 3, 4, 5]
+
+def test_flight_recorder_is_dumped_when_the_connection_crashes(tmpdir):
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+    core = TrumbleCore('127.0.0.1', port, flight_recorder=FlightRecorder(directory=str(tmpdir)))
+    with pytest.raises(OSError):
+        core.run()
+    assert os.listdir(str(tmpdir)) == [os.path.basename(core.flight_recorder.last_dump)]
+
+def _crypt_pair(iv=bytes(range(16))):
+    """ Two ends of a connection, with both nonces starting at `iv` """
+    # Murmur's nonces are random, and as in Mumble one with a zero second byte would make
+    # packets skipping ahead look like replays to a history that hasn't seen any yet
+    pytest.importorskip('cryptography')
+    return CryptState(bytes(range(16)), iv, iv), CryptState(bytes(range(16)), iv, iv)
+
+def test_crypt_state_round_trip():
+    sender, receiver = _crypt_pair()
+    plains = [b'', b'\x78', bytes(range(1, 17)), bytes(range(1, 101))]
+    datagrams = sender.encrypt_many(plains)
+    assert [datagram[0] for datagram in datagrams] == [1, 2, 3, 4]
+    assert receiver.decrypt_many(datagrams) == plains
+    assert receiver.decrypt_iv == sender.encrypt_iv
+
+def test_crypt_state_known_vectors():
+    # Mumble's TestCrypt vectors, with key and nonce both 00 01 .. 0f; the nonce is incremented
+    # before it's used, carrying into the second byte
+    for plain, header, encrypted in [
+        (b'', '00bf3108', ''),
+        (bytes(range(40)), '009db0cd', 'f75d6bc8b4dc8d66b836a2b08b32a6369f1cd3c5228d79fd6c267f5f6aa7b231c7dfb9d59951ae9c'),
+    ]:
+        sender, receiver = _crypt_pair(bytes([0xff, 0]) + bytes(range(2, 16)))
+        datagram = sender.encrypt(plain)
+        assert datagram == bytes.fromhex(header + encrypted)
+        assert receiver.decrypt(datagram) == plain
+
+def test_crypt_state_rejects_tampering():
+    sender, receiver = _crypt_pair()
+    first, second, third = sender.encrypt_many([b'\x78' * 20] * 3)
+    bad_tag = second[:1] + bytes([second[1] ^ 1]) + second[2:]
+    bad_data = second[:-1] + bytes([second[-1] ^ 1])
+    assert receiver.decrypt_many([first, bad_tag, bad_data, third]) == [b'\x78' * 20, None, None, b'\x78' * 20]
+    # neither forgery used up the nonce, so the real one still gets through, late
+    assert receiver.decrypt(second) == b'\x78' * 20
+    assert (receiver.good, receiver.late, receiver.lost) == (3, 1, 0)
+
+def test_crypt_state_accepts_late_packets_across_the_wraparound():
+    sender, receiver = _crypt_pair(bytes([0xfd]) + bytes(range(1, 16)))
+    datagrams = sender.encrypt_many([bytes([n]) for n in range(1, 5)])
+    assert [datagram[0] for datagram in datagrams] == [0xfe, 0xff, 0, 1]
+    order = [0, 2, 1, 3] # 0xff turns up after the low byte has wrapped around
+    assert receiver.decrypt_many([datagrams[n] for n in order]) == [bytes([n + 1]) for n in order]
+    assert receiver.decrypt_iv == sender.encrypt_iv
+    # one lost when 0x00 skipped past 0xff, then found again
+    assert (receiver.good, receiver.late, receiver.lost) == (4, 1, 0)
+
+def test_crypt_state_counts_lost_packets():
+    sender, receiver = _crypt_pair()
+    datagrams = sender.encrypt_many([b'\x78'] * 5)
+    assert receiver.decrypt_many(datagrams[::2]) == [b'\x78'] * 3
+    assert (receiver.good, receiver.late, receiver.lost) == (3, 0, 2)
+
+def test_crypt_state_rejects_replays():
+    sender, receiver = _crypt_pair(bytes([0xfd]) + bytes(range(1, 16)))
+    datagrams = sender.encrypt_many([b'\x78'] * 4)
+    receiver.decrypt_many(datagrams)
+    # the same packet again, whether it would look in order, late, or late from before the wraparound
+    assert receiver.decrypt_many([datagrams[3], datagrams[2], datagrams[0]]) == [None] * 3
+    assert receiver.decrypt_iv == sender.encrypt_iv
+    assert (receiver.good, receiver.late, receiver.lost) == (4, 0, 0)
+
+def test_replies_over_udp_are_traced(tmpdir):
+    async def main():
+        tracer = Tracer(str(tmpdir.join('trace')))
+        core = TrumbleCore('127.0.0.1', 0, udp=True, trace=tracer, flight_recorder=False)
+        udp = core.udp
+        udp.active = True
+        udp.crypt = CryptState(bytes(16), bytes(16), bytes(16))
+        udp._socket, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        udp._socket.setblocking(False)
+        udp._trio_socket = trio.socket.from_stdlib_socket(udp._socket)
+        trace = Trace(messages.get_id_by_class(messages.UDPTunnel), 60, 0.)
+        await core._send_reply(messages.UDPTunnel(voice_frames=[b'\x78']), trace)
+        async with trio.open_nursery() as nursery:
+            core._nursery = nursery
+            nursery.spawn(udp._send_loop)
+            while udp._queue.qsize():
+                await trio.sleep(0)
+            await trio.sleep(0)
+            nursery.cancel_scope.cancel()
+        tracer.flush()
+        assert receiver.recv(1024)
+        udp._socket.close()
+        receiver.close()
+    trio.run(main)
+    (record,) = read_trace(str(tmpdir.join('trace')))
+    assert record[4][SENT - 1] is not None
+
+def test_replay_feeds_a_capture_into_handlers(tmpdir):
+    path = str(tmpdir.join('capture'))
+    with CaptureWriter(path) as writer:
+        for timestamp, text in ((10., 'hi'), (10.5, 'there')):
+            message = messages.TextMessage(actor=1, message=text)
+            writer.write(messages.get_id_by_class(messages.TextMessage), message.SerializeToString(), message, timestamp)
+        writer.write(messages.get_id_by_class(messages.UserState), b'\x08', None, 11.) # cut off mid-field
+    class Bot(TrumbleCore):
+        def on_text_message(self, message):
+            self.heard.append((trio.current_time(), message.message))
+            return messages.TextMessage(message='echo')
+    async def main():
+        bot = Bot('127.0.0.1', 0, flight_recorder=False)
+        bot.heard = []
+        return bot, await Replay(bot, path).run()
+    bot, replay = trio.run(main, clock=trio.testing.MockClock(autojump_threshold=0))
+    # as far apart as they were captured
+    assert bot.heard == [(0., 'hi'), (.5, 'there')]
+    assert replay.replayed == 2 and replay.skipped == 1 and replay.sink.messages == 2
+
+def _write_capture(path, count):
+    with CaptureWriter(path) as writer:
+        for number in range(count):
+            message = messages.UserState(session=number % 7, name='User {}'.format(number))
+            writer.write(messages.get_id_by_class(messages.UserState), message.SerializeToString(), message, float(number))
+
+def test_capture_index(tmpdir):
+    path = str(tmpdir.join('capture'))
+    _write_capture(path, INDEX_BLOCK + 10)
+    with CaptureReader(path) as reader:
+        assert len(reader) == INDEX_BLOCK + 10
+        frames = list(reader.frames(start=100., end=200., sessions=[3]))
+        assert [frame.timestamp for frame in frames] == [float(n) for n in range(100, 200) if n % 7 == 3]
+        assert messages.UserState.FromString(bytes(frames[0].body)).name == 'User 101'
+        del frames # bodies are views of the map, which can't be closed while they're around
+
+def test_capture_index_can_lag_behind(tmpdir):
+    path = str(tmpdir.join('capture'))
+    _write_capture(path, INDEX_BLOCK + 10)
+    # as if the last block hadn't made it to disk yet, so those frames have to be scanned
+    with open(path + '.idx', 'r+b') as f:
+        f.truncate(os.path.getsize(path + '.idx') - 5)
+    with CaptureReader(path) as reader:
+        assert len(reader) == INDEX_BLOCK + 10
+        assert [frame.timestamp for frame in reader.frames(sessions=[3], start=float(INDEX_BLOCK))] == [
+            float(n) for n in range(INDEX_BLOCK, INDEX_BLOCK + 10) if n % 7 == 3
+        ]
+
+def test_capture_index_can_get_ahead_of_a_frame_body(tmpdir):
+    path = str(tmpdir.join('capture'))
+    _write_capture(path, 10)
+    # the index got to disk, but the end of the last frame didn't
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+    with CaptureReader(path) as reader:
+        assert len(reader) == 9
+        assert [frame.timestamp for frame in reader.frames(sessions=[1])] == [1., 8.]
+        assert messages.UserState.FromString(bytes(reader[8].body)).name == 'User 8'
+
+class _Synced:
+    def __init__(self):
+        self.event = trio.Event()
+
+    def on_server_sync(self, message):
+        self.event.set()
+
+def _sync_with_fake_server(make_server, make_bot, then=None):
+    """
+    Connects the bot `make_bot(port)` to `make_server()`, returning both once it's in sync,
+    and once `then(server, bot)` has finished if it's given
+    """
+    pytest.importorskip('cryptography')
+    async def main():
+        server = make_server()
+        async with trio.open_nursery() as nursery:
+            port = await server.start(nursery)
+            bot = make_bot(port)
+            synced = _Synced()
+            bot.add_listener(synced)
+            nursery.spawn(bot.run_async)
+            with trio.fail_after(10):
+                await synced.event.wait()
+            # for the handlers of everything before `ServerSync` to finish too
+            await trio.sleep(.1)
+            if then is not None:
+                await then(server, bot)
+            nursery.cancel_scope.cancel()
+        return server, bot
+    return trio.run(main)
+
+def test_fake_server_syncs_a_bot():
+    server, bot = _sync_with_fake_server(
+        lambda: FakeServer(users=20, channels=3),
+        lambda port: SimpleTrumble('127.0.0.1', port, verify=False, username='bot'),
+    )
+    assert len(bot.channels) == 3
+    # everyone the server made up, and the bot itself
+    assert len(bot.sessions) == 21 and bot.sessions[21]['name'] == 'bot'
+
+def test_flight_recorder_is_dumped_when_the_server_hangs_up(tmpdir):
+    recorder = FlightRecorder(directory=str(tmpdir))
+    class Disconnected:
+        def __init__(self):
+            self.event = trio.Event()
+        def on_disconnect(self):
+            self.event.set()
+    disconnected = Disconnected()
+    def make_bot(port):
+        bot = SimpleTrumble('127.0.0.1', port, verify=False, flight_recorder=recorder)
+        bot.add_listener(disconnected)
+        return bot
+    async def hang_up(server, bot):
+        await server.hang_up(server.clients[0])
+        with trio.fail_after(10):
+            await disconnected.event.wait()
+    with pytest.raises(EOFError):
+        _sync_with_fake_server(FakeServer, make_bot, then=hang_up)
+    assert os.listdir(str(tmpdir)) == [os.path.basename(recorder.last_dump)]
+    with open(recorder.last_dump) as f:
+        assert f.readline().endswith('(disconnect)\n')
+
+def test_moderation_fails_on_the_fake_server_denials():
+    results = []
+    async def moderate(server, bot):
+        results.append(await bot.moderation.mute([1, 2]))
+        results.append(await bot.moderation.kick([3]))
+    _sync_with_fake_server(
+        lambda: FakeServer(users=3, deny=[messages.UserState, messages.UserRemove]),
+        lambda port: SimpleTrumble('127.0.0.1', port, verify=False), then=moderate,
+    )
+    assert [op.error for result in results for op in result.operations] == ['permission denied: Permission'] * 3
+
+def test_streamed_voice_reaches_the_fake_server_on_time():
+    arrivals = []
+    async def stream(server, bot):
+        client = server.clients[0]
+        await bot.stream_audio(iterate([b'\x78' + bytes(59)] * 25)) # half a second
+        await trio.sleep(.1)
+        arrivals.extend(client.voice_arrivals)
+    _sync_with_fake_server(FakeServer, lambda port: SimpleTrumble('127.0.0.1', port, verify=False), then=stream)
+    # the last packet may or may not have had to be followed by a terminator of its own
+    assert len(arrivals) in (25, 26)
+    # loosely, this is real time over loopback
+    assert .4 < arrivals[24] - arrivals[0] < 1.
+
+def test_fast_sync_hands_state_to_listeners_without_on_synced():
+    class Stateful:
+        def __init__(self):
+            self.events = []
+        def on_user_state(self, message):
+            self.events.append(('user_state', message.session, message.self_mute))
+        def on_server_sync(self, message):
+            self.events.append(('server_sync', message.session))
+    class Synced:
+        def on_synced(self, snapshot):
+            self.users = sorted(snapshot.users)
+        def on_user_state(self, message):
+            raise AssertionError('users in the snapshot came in on_synced')
+    async def main():
+        core = TrumbleCore('127.0.0.1', 0, fast_sync=True, flight_recorder=False)
+        core._syncing = SyncSnapshot() # as the receive loop starts out
+        stateful, synced = Stateful(), Synced()
+        core.add_listener(stateful)
+        core.add_listener(synced)
+        async with trio.open_nursery() as nursery:
+            for message in (
+                messages.UserState(session=1, channel_id=0), messages.ChannelState(channel_id=0, name='Root'),
+                messages.UserState(session=2), messages.UserState(session=1, self_mute=True), messages.ServerSync(session=2),
+            ):
+                core._dispatch_received(nursery, message)
+        return stateful, synced
+    stateful, synced = trio.run(main)
+    assert stateful.events == [('user_state', 1, True), ('user_state', 2, False), ('server_sync', 2)]
+    assert synced.users == [1, 2]
@@ -0,0 +1,147 @@
+"""
+Lifecycle tracing: when each received message was read, parsed and dispatched, and when
+each message sent in reply to it was produced, queued, picked up and written out.
+
+Trace files start with a header, followed by fixed-size records, one per reply sent
+(or per received message that got no reply):
+
+    header:  magic (8s) | version (H) | stage count (H) | wall clock (d) | monotonic clock (d)
+    record:  start (d) | message id (H) | reply id (H) | length (I) | stage offsets (I * 7)
+
+`start` is the monotonic time the message's header was read, and each stage offset is the
+microseconds from then until that stage (or 0xffffffff if it never happened). The reply id
+is 0xffff for records without a reply. All integers are little-endian.
+"""
+
+import collections
+import struct
+import time
+
+from . import messages
+
+
+MAGIC = b'TRMBTRCE'
+VERSION = 1
+
+# READ to PARSED is parsing, PARSED to DISPATCHED is waiting for the dispatch task to start,
+# DISPATCHED to HANDLED is the handler, HANDLED to QUEUED is waiting for room in the send queue,
+# QUEUED to DEQUEUED is waiting in it, and DEQUEUED to SENT is serializing and `send_all`
+STAGES = ('header', 'read', 'parsed', 'dispatched', 'handled', 'queued', 'dequeued', 'sent')
+HEADER, READ, PARSED, DISPATCHED, HANDLED, QUEUED, DEQUEUED, SENT = range(len(STAGES))
+
+NO_REPLY = 0xffff
+_ABSENT = 0xffffffff
+
+_FILE_HEADER = struct.Struct('<8sHHdd')
+_RECORD = struct.Struct('<dHHI{}I'.format(len(STAGES) - 1))
+
+class Trace:
+    """ Timestamps of one received message, or of one reply to it """
+
+    __slots__ = ('message_id', 'reply_id', 'length', 'stamps')
+
+    def __init__(self, message_id, length, start):
+        self.message_id = message_id
+        self.reply_id = NO_REPLY
+        self.length = length
+        self.stamps = [start] + [None] * (len(STAGES) - 1)
+
+    def stamp(self, stage):
+        self.stamps[stage] = time.perf_counter()
+
+    def reply(self, message):
+        """ A copy of this trace for a reply to the message, stamped as produced now """
+        reply = Trace(self.message_id, self.length, None)
+        reply.stamps = self.stamps[:]
+        reply.reply_id = messages.get_id_by_class(message.__class__)
+        reply.stamp(HANDLED)
+        return reply
+
+class Traced:
+    """ A message in the send queue, and its trace """
+
+    __slots__ = ('message', 'trace')
+
+    def __init__(self, message, trace):
+        self.message = message
+        self.trace = trace
+
+class Tracer:
+    """
+    Collects traces for `TrumbleCore` (created with `trace='path'`, or given an instance of
+    this) and appends them to a trace file, a block of `buffer_size` bytes at a time.
+    Replies are traced through to `SENT` whether they go out over TCP or UDP.
+    """
+
+    def __init__(self, path, *, buffer_size=65536):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.inbound = {} # id(message) -> Trace, until it's dispatched
+        self._buffer = bytearray()
+        with open(path, 'wb') as f:
+            f.write(_FILE_HEADER.pack(MAGIC, VERSION, len(STAGES), time.time(), time.perf_counter()))
+
+    def received(self, message, message_id, length, header_time, read_time):
+        trace = Trace(message_id, length, header_time)
+        trace.stamps[READ] = read_time
+        trace.stamp(PARSED)
+        self.inbound[id(message)] = trace
+
+    def dispatched(self, message):
+        trace = self.inbound.pop(id(message), None)
+        if trace is not None:
+            trace.stamp(DISPATCHED)
+        return trace
+
+    def finish(self, trace):
+        start = trace.stamps[HEADER]
+        self._buffer += _RECORD.pack(
+            start, trace.message_id, trace.reply_id, trace.length,
+            *(_ABSENT if stamp is None else min(_ABSENT - 1, int((stamp - start) * 1000000)) for stamp in trace.stamps[1:])
+        )
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        with open(self.path, 'ab') as f:
+            f.write(self._buffer)
+        self._buffer.clear()
+
+def read_trace(path):
+    """ Yields `(start, message_id, reply_id, length, offsets)` for every record in a trace file """
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, stages, _, _ = _FILE_HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or stages != len(STAGES):
+        raise ValueError('{} is not a version {} trace file'.format(path, VERSION))
+    for start, message_id, reply_id, length, *offsets in _RECORD.iter_unpack(data[_FILE_HEADER.size:]):
+        yield start, message_id, reply_id, length, [None if offset == _ABSENT else offset for offset in offsets]
+
+def summarize(path, percentiles=(50, 90, 99)):
+    """
+    Per `(message type, reply type)`, the number of records and the given percentiles of
+    microseconds spent in each stage (from the previous stage that was recorded)
+    """
+    durations = collections.defaultdict(lambda: collections.defaultdict(list))
+    counts = collections.Counter()
+    for _, message_id, reply_id, _, offsets in read_trace(path):
+        key = (
+            messages.get_class_by_id(message_id).__name__,
+            messages.get_class_by_id(reply_id).__name__ if reply_id != NO_REPLY else None,
+        )
+        counts[key] += 1
+        previous = 0
+        for stage, offset in zip(STAGES[1:], offsets):
+            if offset is None:
+                continue
+            durations[key][stage].append(offset - previous)
+            previous = offset
+    summary = {}
+    for key, stages in durations.items():
+        summary[key] = {'count': counts[key]}
+        for stage, values in stages.items():
+            values.sort()
+            summary[key][stage] = {
+                p: values[min(len(values) - 1, len(values) * p // 100)] for p in percentiles
+            }
+    return summary
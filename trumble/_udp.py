@@ -0,0 +1,470 @@
+"""
+Voice over UDP, encrypted the way Mumble does it: OCB2 with AES-128, keyed and synchronised
+through `CryptSetup` messages on the control channel. Each datagram is the usual `UDPTunnel`
+payload, encrypted, behind a 4 byte header of the low byte of the nonce and the first
+three bytes of the authentication tag.
+"""
+
+import logging
+import socket
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+import trio
+
+from . import messages
+from . import _trace
+from ._ping import RunningStats
+
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 16
+
+_MASK = (1 << 128) - 1
+
+def _times2(block):
+    """ Doubling in GF(2^128), as OCB2 uses it to derive the offset of each block """
+    return ((block << 1) & _MASK) ^ (0x87 if block >> 127 else 0)
+
+def _to_int(data):
+    return int.from_bytes(data, 'big')
+
+def _to_bytes(block):
+    return block.to_bytes(BLOCK_SIZE, 'big')
+
+def _increment(iv, start=0):
+    for i in range(start, BLOCK_SIZE):
+        iv[i] = (iv[i] + 1) & 0xff
+        if iv[i]:
+            break
+
+def _decrement(iv, start=0):
+    for i in range(start, BLOCK_SIZE):
+        old = iv[i]
+        iv[i] = (old - 1) & 0xff
+        if old:
+            break
+
+class CryptState:
+    """
+    OCB2-AES128 state for one connection, packet for packet compatible with Mumble's
+    `CryptState`, including its tolerance for late and lost packets and its countermeasure
+    against the 2019 OCB2 forgery attack.
+
+    OCB2 only ever needs the block cipher on independent blocks in three rounds (the nonce,
+    then every data block and the final pad, then the tag), so `encrypt_many` and
+    `decrypt_many` run each round once for a whole batch of packets: one call into OpenSSL
+    per round instead of one per block.
+    """
+
+    # how many packets back a late packet may be and still be accepted
+    LATE_WINDOW = 30
+
+    def __init__(self, key, encrypt_iv, decrypt_iv):
+        if Cipher is None:
+            raise ImportError('UDP voice requires the cryptography package')
+        if not len(key) == len(encrypt_iv) == len(decrypt_iv) == BLOCK_SIZE:
+            raise ValueError('Key and nonces must be {} bytes'.format(BLOCK_SIZE))
+        cipher = Cipher(algorithms.AES(bytes(key)), modes.ECB(), backend=default_backend())
+        self._encrypt_block = cipher.encryptor().update
+        self._decrypt_block = cipher.decryptor().update
+        self.encrypt_iv = bytearray(encrypt_iv)
+        self.decrypt_iv = bytearray(decrypt_iv)
+        self._history = bytearray(256)
+        self.good = 0
+        self.late = 0
+        self.lost = 0
+        self.resync = 0
+        self.last_good = None
+
+    def set_decrypt_iv(self, decrypt_iv):
+        """ Takes a new nonce from the server after we asked to resynchronise """
+        self.decrypt_iv = bytearray(decrypt_iv)
+        self.resync += 1
+
+    def _aes(self, blocks, decrypt=False):
+        if not blocks:
+            return []
+        data = (self._decrypt_block if decrypt else self._encrypt_block)(b''.join(map(_to_bytes, blocks)))
+        return [_to_int(data[i:i + BLOCK_SIZE]) for i in range(0, len(data), BLOCK_SIZE)]
+
+    def _offsets(self, nonces, lengths):
+        """ Round one: each packet's block offsets, and the offset of its final partial block """
+        offsets = []
+        for delta, length in zip(self._aes([_to_int(nonce) for nonce in nonces]), lengths):
+            full_blocks = max(0, length - 1) // BLOCK_SIZE
+            deltas = []
+            for _ in range(full_blocks):
+                delta = _times2(delta)
+                deltas.append(delta)
+            offsets.append((deltas, _times2(delta)))
+        return offsets
+
+    def _tags(self, final_deltas, checksums):
+        """ Round three: the authentication tags """
+        return self._aes([
+            _times2(delta) ^ delta ^ checksum for delta, checksum in zip(final_deltas, checksums)
+        ])
+
+    def _ocb_encrypt_many(self, plains, nonces):
+        offsets = self._offsets(nonces, [len(plain) for plain in plains])
+        # round two: every full block, plus the pad for every final block
+        blocks = []
+        for plain, (deltas, final_delta) in zip(plains, offsets):
+            for idx, delta in enumerate(deltas):
+                block = _to_int(plain[idx * BLOCK_SIZE:(idx + 1) * BLOCK_SIZE])
+                if idx == len(deltas) - 1 and not block >> 8:
+                    # the forgery needs this block to be zero but for its last byte; Mumble
+                    # flips a bit instead of refusing, since digital silence does it all the time
+                    block ^= 1 << 120
+                blocks.append(block ^ delta)
+            final_length = len(plain) - len(deltas) * BLOCK_SIZE
+            blocks.append(final_delta ^ (final_length * 8))
+        encrypted_blocks = iter(self._aes(blocks))
+
+        results, checksums = [], []
+        for plain, (deltas, final_delta) in zip(plains, offsets):
+            encrypted = bytearray()
+            checksum = 0
+            for idx, delta in enumerate(deltas):
+                block = _to_int(plain[idx * BLOCK_SIZE:(idx + 1) * BLOCK_SIZE])
+                if idx == len(deltas) - 1 and not block >> 8:
+                    block ^= 1 << 120
+                encrypted += _to_bytes(next(encrypted_blocks) ^ delta)
+                checksum ^= block
+            pad = _to_bytes(next(encrypted_blocks))
+            final_length = len(plain) - len(deltas) * BLOCK_SIZE
+            final = _to_int(bytes(plain[len(plain) - final_length:]) + pad[final_length:])
+            checksum ^= final
+            encrypted += _to_bytes(final ^ _to_int(pad))[:final_length]
+            results.append(bytes(encrypted))
+            checksums.append(checksum)
+        tags = self._tags([final_delta for _, final_delta in offsets], checksums)
+        return results, tags
+
+    def _ocb_decrypt_many(self, ciphertexts, nonces):
+        offsets = self._offsets(nonces, [len(data) for data in ciphertexts])
+        blocks, pads = [], []
+        for data, (deltas, final_delta) in zip(ciphertexts, offsets):
+            for idx, delta in enumerate(deltas):
+                blocks.append(_to_int(data[idx * BLOCK_SIZE:(idx + 1) * BLOCK_SIZE]) ^ delta)
+            pads.append(final_delta ^ ((len(data) - len(deltas) * BLOCK_SIZE) * 8))
+        decrypted_blocks = iter(self._aes(blocks, decrypt=True))
+        pads = iter(self._aes(pads))
+
+        results, checksums, attacked = [], [], []
+        for data, (deltas, final_delta) in zip(ciphertexts, offsets):
+            plain = bytearray()
+            checksum = 0
+            for delta in deltas:
+                block = next(decrypted_blocks) ^ delta
+                plain += _to_bytes(block)
+                checksum ^= block
+            pad = next(pads)
+            final_length = len(data) - len(deltas) * BLOCK_SIZE
+            final = _to_int(bytes(data[len(data) - final_length:]) + bytes(BLOCK_SIZE - final_length)) ^ pad
+            checksum ^= final
+            plain += _to_bytes(final)[:final_length]
+            results.append(bytes(plain))
+            checksums.append(checksum)
+            # the other half of the countermeasure: a forged final block would equal its offset
+            attacked.append(final >> 8 == final_delta >> 8)
+        tags = self._tags([final_delta for _, final_delta in offsets], checksums)
+        return results, tags, attacked
+
+    def encrypt_many(self, plains):
+        """ Encrypts a batch of packets, returning the datagrams to send """
+        nonces = []
+        for _ in plains:
+            _increment(self.encrypt_iv)
+            nonces.append(bytes(self.encrypt_iv))
+        encrypted, tags = self._ocb_encrypt_many(plains, nonces)
+        return [
+            bytes([nonce[0]]) + _to_bytes(tag)[:3] + data
+            for nonce, tag, data in zip(nonces, tags, encrypted)
+        ]
+
+    def encrypt(self, plain):
+        return self.encrypt_many([plain])[0]
+
+    def _next_decrypt_iv(self, data):
+        """
+        Works out the nonce of a received datagram from its first byte, as Mumble does,
+        updating `decrypt_iv`. Returns `(late, lost, restore)`, or `None` for a datagram
+        that is a replay or too far out of order.
+        """
+        iv = self.decrypt_iv
+        saved = bytes(iv)
+        iv_byte = data[0]
+        late = lost = 0
+        restore = False
+        if (iv[0] + 1) & 0xff == iv_byte:
+            # in order, as expected
+            if iv_byte > iv[0]:
+                iv[0] = iv_byte
+            elif iv_byte < iv[0]:
+                iv[0] = iv_byte
+                _increment(iv, 1)
+            else:
+                return None
+        else:
+            diff = iv_byte - iv[0]
+            if diff > 128:
+                diff -= 256
+            elif diff < -128:
+                diff += 256
+            if iv_byte < iv[0] and -self.LATE_WINDOW < diff < 0:
+                # late, no wraparound
+                late, lost, restore = 1, -1, True
+                iv[0] = iv_byte
+            elif iv_byte > iv[0] and -self.LATE_WINDOW < diff < 0:
+                # late, from before the low byte wrapped around
+                late, lost, restore = 1, -1, True
+                iv[0] = iv_byte
+                _decrement(iv, 1)
+            elif iv_byte > iv[0] and diff > 0:
+                # a few lost, no wraparound
+                lost = iv_byte - iv[0] - 1
+                iv[0] = iv_byte
+            elif iv_byte < iv[0] and diff > 0:
+                # a few lost, and the low byte wrapped around
+                lost = 256 - iv[0] + iv_byte - 1
+                iv[0] = iv_byte
+                _increment(iv, 1)
+            else:
+                return None
+            if self._history[iv[0]] == iv[1]:
+                # replay
+                iv[:] = saved
+                return None
+        return late, lost, restore
+
+    def decrypt_many(self, datagrams, now=None):
+        """
+        Decrypts a batch of received datagrams, returning the plaintext of each, or `None`
+        for those that didn't decrypt. Nonces are tracked in order as if every datagram will
+        authenticate; if one doesn't, the state is rolled back to just before it and the
+        rest of the batch is done again.
+        """
+        results = [None] * len(datagrams)
+        start = 0
+        while start < len(datagrams):
+            pending = []
+            for idx in range(start, len(datagrams)):
+                data = datagrams[idx]
+                if len(data) < 4:
+                    continue
+                before = bytes(self.decrypt_iv)
+                step = self._next_decrypt_iv(data)
+                if step is None:
+                    continue
+                late, lost, restore = step
+                nonce = bytes(self.decrypt_iv)
+                history = (nonce[0], self._history[nonce[0]])
+                self._history[nonce[0]] = nonce[1]
+                if restore:
+                    self.decrypt_iv[:] = before
+                pending.append((idx, before, nonce, late, lost, history))
+            if not pending:
+                break
+            plains, tags, attacked = self._ocb_decrypt_many(
+                [memoryview(datagrams[idx])[4:] for idx, *_ in pending],
+                [nonce for _, _, nonce, *_ in pending],
+            )
+            failed = None
+            for position, ((idx, _, _, late, lost, _), plain, tag, attack) in enumerate(zip(pending, plains, tags, attacked)):
+                if attack or _to_bytes(tag)[:3] != bytes(datagrams[idx][1:4]):
+                    failed = position
+                    break
+                results[idx] = plain
+                self.good += 1
+                self.late += late
+                self.lost += lost
+                self.last_good = now
+            if failed is None:
+                break
+            for _, _, _, _, _, (position, value) in reversed(pending[failed:]):
+                self._history[position] = value
+            self.decrypt_iv[:] = pending[failed][1]
+            start = pending[failed][0] + 1
+        return results
+
+    def decrypt(self, datagram, now=None):
+        return self.decrypt_many([datagram], now)[0]
+
+class UDPTransport:
+    """
+    Sends and receives voice over UDP once the server has sent a `CryptSetup`, checking
+    that UDP gets through with a ping every `ping_interval` seconds (every second until the
+    first reply). Voice only goes over UDP while replies keep coming back; after `timeout`
+    seconds without any, it falls back to the TCP tunnel until they do again.
+    Received datagrams, and voice waiting to be sent, are handled in batches of up to `batch`.
+
+    `TrumbleCore` creates one when passed `udp=True`.
+    """
+
+    MAX_DATAGRAM = 1024
+    # how long decryption has to keep failing before we ask the server to resynchronise
+    RESYNC_AFTER = 5.
+
+    def __init__(self, core, *, ping_interval=5., timeout=None, batch=32):
+        self.core = core
+        self.ping_interval = ping_interval
+        self.timeout = timeout if timeout is not None else 3 * ping_interval
+        self.batch = batch
+        self.crypt = None
+        self.active = False
+        self.last_receive = None
+        self.rtt = RunningStats()
+        self.packets_sent = 0
+        self.packets_received = 0
+        self._socket = None
+        self._trio_socket = None
+        self._queue = trio.Queue(1024)
+        self._resync_requested = None
+
+    def carries(self, message):
+        """ Whether `message` should go over UDP rather than the TCP tunnel right now """
+        if not self.active:
+            return False
+        if isinstance(message, messages.UDPTunnel):
+            return message.type != messages.UDPTunnel.Ping
+        return isinstance(message, messages.PreparedUDPTunnel)
+
+    async def send(self, message):
+        await self._queue.put(message)
+
+    async def on_crypt_setup(self, message):
+        if all(len(field) == BLOCK_SIZE for field in (message.key, message.client_nonce, message.server_nonce)):
+            self.crypt = CryptState(message.key, message.client_nonce, message.server_nonce)
+            self.crypt.last_good = trio.current_time()
+            self.rtt = RunningStats()
+            if self._socket is None:
+                await self._open()
+        elif self.crypt is None:
+            return
+        elif len(message.server_nonce) == BLOCK_SIZE:
+            logger.debug('Resynchronised UDP decryption')
+            self.crypt.set_decrypt_iv(message.server_nonce)
+        else:
+            # the server lost track of our nonce
+            reply = messages.CryptSetup()
+            reply.client_nonce = bytes(self.crypt.encrypt_iv)
+            return reply
+
+    def on_disconnect(self):
+        if self._socket is not None:
+            self._trio_socket.close()
+        self._socket = self._trio_socket = None
+        self.crypt = None
+        self.active = False
+
+    async def _open(self):
+        family, type_, proto, _, address = (await trio.socket.getaddrinfo(
+            self.core.host, self.core.port, type=socket.SOCK_DGRAM,
+        ))[0]
+        self._socket = socket.socket(family, type_, proto)
+        self._socket.setblocking(False)
+        # connected, so the kernel drops anything that isn't from the server
+        self._socket.connect(address)
+        self._trio_socket = trio.socket.from_stdlib_socket(self._socket)
+        self.core.spawn(self._receive_loop)
+        self.core.spawn(self._send_loop)
+        self.core.spawn(self._ping_loop)
+
+    async def _send_datagrams(self, outgoing):
+        datagrams = self.crypt.encrypt_many([message.SerializeToString() for message in outgoing])
+        metrics = self.core.metrics
+        for datagram in datagrams:
+            try:
+                try:
+                    self._socket.send(datagram)
+                except BlockingIOError:
+                    await self._trio_socket.send(datagram)
+            except OSError as exc:
+                # e.g. an ICMP port unreachable for an earlier datagram
+                logger.debug('UDP send failed: %s', exc)
+            else:
+                self.packets_sent += 1
+                if metrics is not None:
+                    metrics.message_sent(messages.get_id_by_class(messages.UDPTunnel), len(datagram), 'udp')
+
+    async def _send_loop(self):
+        while True:
+            outgoing = [await self._queue.get()]
+            while len(outgoing) < self.batch:
+                try:
+                    outgoing.append(self._queue.get_nowait())
+                except trio.WouldBlock:
+                    break
+            traces = []
+            for number, message in enumerate(outgoing):
+                if isinstance(message, _trace.Traced):
+                    message.trace.stamp(_trace.DEQUEUED)
+                    traces.append(message.trace)
+                    outgoing[number] = message.message
+            await self._send_datagrams(outgoing)
+            for trace in traces:
+                trace.stamp(_trace.SENT)
+                self.core.tracer.finish(trace)
+
+    async def _ping_loop(self):
+        while True:
+            ping = messages.UDPTunnel(type=messages.UDPTunnel.Ping, timestamp=int(trio.current_time() * 1000000))
+            await self._send_datagrams([ping])
+            now = trio.current_time()
+            if self.active and now - self.last_receive > self.timeout:
+                logger.warning('No UDP replies for %.1f seconds, falling back to the TCP tunnel', now - self.last_receive)
+                self.active = False
+            await trio.sleep(self.ping_interval if self.active else min(1., self.ping_interval))
+
+    async def _receive_loop(self):
+        while True:
+            try:
+                datagrams = [await self._trio_socket.recv(self.MAX_DATAGRAM)]
+            except OSError as exc:
+                logger.debug('UDP receive failed: %s', exc)
+                continue
+            while len(datagrams) < self.batch:
+                try:
+                    datagrams.append(self._socket.recv(self.MAX_DATAGRAM))
+                except OSError:
+                    break
+            now = trio.current_time()
+            for plain in self.crypt.decrypt_many(datagrams, now):
+                if plain is None:
+                    await self._decrypt_failed(now)
+                    continue
+                self.last_receive = now
+                self.packets_received += 1
+                if self.core.metrics is not None:
+                    self.core.metrics.message_received(messages.get_id_by_class(messages.UDPTunnel), len(plain) + 4, 'udp')
+                if not self.active:
+                    logger.info('UDP is working, sending voice over UDP')
+                    self.active = True
+                try:
+                    message = messages._deserialize(messages.get_id_by_class(messages.UDPTunnel), plain)
+                except Exception:
+                    logger.debug('Undecodable UDP packet %r', plain)
+                    message = None
+                if self.core.capture is not None:
+                    self.core.capture.write(messages.get_id_by_class(messages.UDPTunnel), plain, message)
+                if message is None:
+                    continue
+                if message.type == messages.UDPTunnel.Ping:
+                    self.rtt.add((now - message.timestamp / 1000000) * 1000)
+                else:
+                    self.core.spawn(self.core._dispatch_event, 'udp_tunnel', message)
+
+    async def _decrypt_failed(self, now):
+        if now - self.crypt.last_good < self.RESYNC_AFTER:
+            return
+        if self._resync_requested is not None and now - self._resync_requested < self.RESYNC_AFTER:
+            return
+        logger.debug('UDP decryption keeps failing, asking the server to resynchronise')
+        self._resync_requested = now
+        await self.core.send(messages.CryptSetup())
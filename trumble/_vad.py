@@ -0,0 +1,94 @@
+import collections
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ._opus import SAMPLE_RATE
+
+
+class SilenceGate:
+    """
+    Energy-based voice activity gate for outgoing PCM, to pass as `AudioStream`'s `gate`.
+
+    The gate opens when a frame's level goes above `open_threshold` and closes once the level
+    has stayed below the lower `close_threshold` for `hangover` seconds, so it doesn't flutter
+    around a single threshold or chop off the ends of words. While closed, the last `preroll`
+    frames are held back rather than dropped, and sent ahead of the frame that reopens the
+    gate, so the start of speech isn't clipped either. Levels are in dBFS.
+    """
+
+    def __init__(self, *, open_threshold=-40., close_threshold=-50., hangover=0.3, preroll=2, rate=SAMPLE_RATE):
+        if numpy is None:
+            raise ImportError('Silence gating requires numpy')
+        self.open_threshold = open_threshold
+        self.close_threshold = close_threshold
+        self.hangover = hangover
+        self.rate = rate
+        self.is_open = False
+        self.frames_passed = 0
+        self.frames_gated = 0
+        self._quiet = 0.
+        self._held = collections.deque(maxlen=preroll) if preroll else None
+        self._scratch = numpy.zeros(0, numpy.float32)
+
+    def level(self, frame):
+        """ RMS level of a frame of int16 (array or bytes) or float32 PCM, in dBFS """
+        if isinstance(frame, (bytes, bytearray, memoryview)):
+            frame = numpy.frombuffer(frame, numpy.int16)
+        if len(self._scratch) != len(frame):
+            self._scratch = numpy.zeros(len(frame), numpy.float32)
+        numpy.copyto(self._scratch, frame, casting='unsafe')
+        energy = float(numpy.dot(self._scratch, self._scratch)) / max(1, len(frame))
+        if frame.dtype.kind != 'f':
+            energy /= 32768. ** 2
+        return 10 * math.log10(energy) if energy > 0 else -math.inf
+
+    @staticmethod
+    def samples(frame):
+        """ Number of samples in a frame of PCM """
+        if isinstance(frame, (bytes, bytearray, memoryview)):
+            return len(frame) // 2
+        return len(frame)
+
+    def process(self, frame):
+        """
+        Returns a list of `(frame, voiced)` pairs to send in place of `frame`: voiced frames
+        are to be encoded and sent, the rest only take up time. A `(None, False)` pair marks
+        the end of speech, where the transmission should be ended.
+        """
+        level = self.level(frame)
+        if self.is_open:
+            self.frames_passed += 1
+            if level >= self.close_threshold:
+                self._quiet = 0.
+                return [(frame, True)]
+            self._quiet += self.samples(frame) / self.rate
+            if self._quiet < self.hangover:
+                return [(frame, True)]
+            self.is_open = False
+            return [(frame, True), (None, False)]
+
+        if level > self.open_threshold:
+            self.is_open = True
+            self._quiet = 0.
+            held = list(self._held or ())
+            if self._held is not None:
+                self._held.clear()
+            self.frames_gated -= len(held)
+            self.frames_passed += len(held) + 1
+            return [(f, True) for f in held] + [(frame, True)]
+
+        self.frames_gated += 1
+        if self._held is None:
+            return [(frame, False)]
+        released = [(self._held[0], False)] if len(self._held) == self._held.maxlen else []
+        # the source may reuse its buffers, so hold on to a copy (of the bytes, for int16 PCM
+        # in a bytearray or memoryview, rather than an array of each byte)
+        if isinstance(frame, (bytes, bytearray, memoryview)):
+            self._held.append(bytes(frame))
+        else:
+            self._held.append(numpy.array(frame))
+        return released
@@ -0,0 +1,148 @@
+import collections
+import contextlib
+import logging
+
+import attr
+
+from . import messages
+
+
+logger = logging.getLogger(__name__)
+
+class VoiceTargetsFull(Exception):
+    """ Every slot is in use by a whisper or stream that's still going """
+
+@attr.s(frozen=True)
+class WhisperChannel:
+    """ A channel to whisper to, optionally including its linked channels and/or subchannels """
+
+    channel_id = attr.ib()
+    links = attr.ib(default=False)
+    children = attr.ib(default=False)
+    group = attr.ib(default='')
+
+class VoiceTargets:
+    """
+    Maps sets of whisper recipients onto the small number of VoiceTarget slots the server allows.
+    Identical recipient sets share a slot, and when all slots are taken the least recently used
+    one is re-registered for the new set. Slots that audio is still being sent to are never
+    re-registered: `whisper` holds on to its slot until a packet ends the transmission, and
+    `pinned` holds on to one for a stream. With every slot held, `VoiceTargetsFull` is raised.
+    Add an instance as a listener on a `TrumbleCore` so slots are forgotten when the
+    connection (and the server's copy of them) goes away.
+    """
+
+    # 0 is normal talking and 31 is server loopback, everything in between is ours
+    FIRST_SLOT = 1
+    LAST_SLOT = 30
+
+    def __init__(self, first_slot=FIRST_SLOT, last_slot=LAST_SLOT):
+        self.first_slot = first_slot
+        self.last_slot = last_slot
+        self.reset()
+
+    def reset(self):
+        """ Forget every registration, e.g. because the server has forgotten them """
+        self._slots = collections.OrderedDict() # key -> slot, least recently used first
+        self._free = list(range(self.last_slot, self.first_slot - 1, -1))
+        self._pins = collections.Counter() # slot -> streams using it
+        self._whispering = set() # slots `whisper` is in the middle of a transmission to
+
+    def _in_use(self, slot):
+        return slot in self._pins or slot in self._whispering
+
+    @staticmethod
+    def _key(sessions, channels):
+        channels = (c if isinstance(c, WhisperChannel) else WhisperChannel(c) for c in channels)
+        return frozenset(sessions), frozenset(channels)
+
+    @staticmethod
+    def _voice_target(slot, key):
+        sessions, channels = key
+        voice_target = messages.VoiceTarget()
+        voice_target.id = slot
+        if sessions:
+            target = voice_target.targets.add()
+            target.session.extend(sorted(sessions))
+        for channel in sorted(channels, key=attr.astuple):
+            target = voice_target.targets.add()
+            target.channel_id = channel.channel_id
+            target.links = channel.links
+            target.children = channel.children
+            if channel.group:
+                target.group = channel.group
+        return voice_target
+
+    def register(self, sessions=(), channels=()):
+        """
+        Returns a `(slot, message)` pair for the given recipients. `message` is the `VoiceTarget`
+        that has to be sent before any audio using the slot, or `None` if it already was.
+        """
+        key = self._key(sessions, channels)
+        if key in self._slots:
+            self._slots.move_to_end(key)
+            return self._slots[key], None
+        if self._free:
+            slot = self._free.pop()
+        else:
+            evicted_key = next((k for k, s in self._slots.items() if not self._in_use(s)), None)
+            if evicted_key is None:
+                raise VoiceTargetsFull('All {} voice target slots are in use'.format(len(self._slots)))
+            slot = self._slots.pop(evicted_key)
+            logger.debug('Evicting voice target %d for %r', slot, evicted_key)
+        self._slots[key] = slot
+        return slot, self._voice_target(slot, key)
+
+    @contextlib.contextmanager
+    def pinned(self, sessions=(), channels=()):
+        """
+        Registers a slot for these recipients and keeps it theirs for the duration of the block,
+        e.g. for an `AudioStream(target=slot)`. Yields `(slot, messages)`, `messages` being what
+        has to be sent before the audio, as from `prepare`.
+        """
+        slot, voice_target = self.register(sessions, channels)
+        self._pins[slot] += 1
+        try:
+            yield slot, [voice_target] if voice_target else []
+        finally:
+            self._pins[slot] -= 1
+            if not self._pins[slot]:
+                del self._pins[slot]
+
+    def prepare(self, sessions=(), channels=()):
+        """
+        Returns the messages needed to register a slot for these recipients ahead of time,
+        so that later audio to them doesn't have to wait for the registration.
+        """
+        _, voice_target = self.register(sessions, channels)
+        return [voice_target] if voice_target else []
+
+    def whisper(self, tunnel, sessions=(), channels=()):
+        """
+        Addresses a `UDPTunnel` to the given recipients, yielding the slot registration first
+        if needed. `TrumbleCore.send` keeps audio to a slot in the TCP tunnel, behind its
+        registration, until the registration has gone out, so the server sees it first
+        even when the audio would otherwise go over UDP.
+        """
+        slot, voice_target = self.register(sessions, channels)
+        if tunnel.end_transmission:
+            self._whispering.discard(slot)
+        else:
+            self._whispering.add(slot)
+        if voice_target:
+            yield voice_target
+        tunnel.target = slot
+        yield tunnel
+
+    def slot_for(self, sessions=(), channels=()):
+        """ Returns the slot currently registered for these recipients, or `None` """
+        return self._slots.get(self._key(sessions, channels))
+
+    def on_connect(self):
+        self.reset()
+
+    def on_user_remove(self, message):
+        """ Free up slots whose only recipient is a session that just left """
+        for key in [k for k in self._slots if k == (frozenset([message.session]), frozenset())]:
+            if not self._in_use(self._slots[key]):
+                self._free.append(self._slots.pop(key))